@@ -1,17 +1,44 @@
-from flask import Flask, jsonify, send_from_directory, request
+from flask import Flask, Response, jsonify, send_from_directory, request, stream_with_context
+import click
 from flask_cors import CORS
 from apscheduler.schedulers.background import BackgroundScheduler
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 import warnings
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal, ROUND_HALF_UP
+import csv
+import io
 import json
+import gzip
+import hashlib
+import mimetypes
+import re
+import struct
+import numpy as np
 import os
 import atexit
 import threading
+import time
+import random
 import asyncio
+from bisect import bisect_left, bisect_right, insort
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from functools import wraps
 from dotenv import load_dotenv
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:  # sin brotli se comprime solo con gzip
+    brotli = None
+
 # Cargar variables de entorno
 load_dotenv()
 
@@ -24,186 +51,1132 @@ CORS(app)
 DATABASE_URL = os.environ.get('DATABASE_URL')
 BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 BRECHA_CHANGE_THRESHOLD = 5.0
+PRICE_UPDATE_SECONDS = 60
+
+# Modo de almacenamiento del historial: 'full' guarda cada tick, 'changes' solo
+# guarda un registro cuando algun valor cambia mas de HISTORY_CHANGE_EPSILON o
+# cuando pasan HISTORY_HEARTBEAT_MINUTES desde el ultimo registro
+HISTORY_STORAGE_MODE = os.environ.get('HISTORY_STORAGE_MODE', 'full')
+HISTORY_CHANGE_EPSILON = float(os.environ.get('HISTORY_CHANGE_EPSILON', 0.01))
+HISTORY_HEARTBEAT_MINUTES = int(os.environ.get('HISTORY_HEARTBEAT_MINUTES', 60))
+
+# Cache columnar del historial en disco (memory-mapped, compartido entre procesos)
+HISTORY_CACHE_ENABLED = os.environ.get('HISTORY_CACHE_ENABLED', '1') != '0'
+HISTORY_CACHE_DIR = os.environ.get('HISTORY_CACHE_DIR', 'history_cache')
+
+# Cada cuanto se recarga de la base de datos el set de suscriptores en memoria
+SUBSCRIBERS_RELOAD_SECONDS = int(os.environ.get('SUBSCRIBERS_RELOAD_SECONDS', '300'))
+
+# Envio masivo de Telegram: mensajes por segundo en total, segundos minimos
+# entre mensajes al mismo chat, envios simultaneos y reintentos por RetryAfter
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', '25'))
+TELEGRAM_CHAT_INTERVAL = float(os.environ.get('TELEGRAM_CHAT_INTERVAL', '1'))
+TELEGRAM_BROADCAST_CONCURRENCY = int(os.environ.get('TELEGRAM_BROADCAST_CONCURRENCY', '20'))
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', '3'))
+
+# Reglas de alerta por usuario: maximo por chat y espera minima entre avisos de una regla
+ALERT_RULES_PER_CHAT = int(os.environ.get('ALERT_RULES_PER_CHAT', '10'))
+ALERT_RULE_COOLDOWN_MINUTES = int(os.environ.get('ALERT_RULE_COOLDOWN_MINUTES', '60'))
+
+# Eleccion del proceso que corre el scheduler de precios y el bot (ver LeaderLock)
+LEADER_RETRY_SECONDS = int(os.environ.get('LEADER_RETRY_SECONDS', '30'))
+# Los seguidores reciben cada snapshot por el canal (ver SnapshotChannel) y
+# ademas releen el ultimo registro guardado cada SNAPSHOT_REFRESH_SECONDS
+SNAPSHOT_REFRESH_SECONDS = int(os.environ.get('SNAPSHOT_REFRESH_SECONDS', '300'))
+SNAPSHOT_POLL_SECONDS = float(os.environ.get('SNAPSHOT_POLL_SECONDS', '2'))
+SNAPSHOT_CHANNEL = 'price_snapshot'
+
+# Rol del proceso: 'all' (HTTP + scheduler y bot si gana la eleccion de lider),
+# 'worker' (scheduler y bot, ver worker.py) o 'web' (solo HTTP)
+APP_ROLE = os.environ.get('APP_ROLE', 'all')
+
+# Fuentes de precios (configurables para pruebas locales)
+BCV_URL = os.environ.get('BCV_URL', 'https://www.bcv.org.ve/')
+BINANCE_P2P_URL = os.environ.get('BINANCE_P2P_URL', 'https://p2p.binance.com/bapi/c2c/v2/friendly/c2c/adv/search')
+
+# /api/stream: snapshots guardados para Last-Event-ID, segundos entre
+# heartbeats y duracion maxima de una conexion (0 = sin limite)
+SSE_BUFFER_SIZE = int(os.environ.get('SSE_BUFFER_SIZE', '32'))
+SSE_HEARTBEAT_SECONDS = int(os.environ.get('SSE_HEARTBEAT_SECONDS', '15'))
+SSE_MAX_STREAM_SECONDS = int(os.environ.get('SSE_MAX_STREAM_SECONDS', '0'))
+
+# Segundos que /api/stats reutiliza sus conteos antes de volver a consultarlos
+STATS_CACHE_SECONDS = int(os.environ.get('STATS_CACHE_SECONDS', '30'))
+
+# Respuestas JSON serializadas que se guardan por proceso hasta el proximo snapshot
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '256'))
+
+# Respuestas JSON desde este tamano (bytes) se comprimen con brotli o gzip
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '1024'))
+
+# Registros por lote que /api/export pide al cursor del servidor
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '5000'))
+# Exportaciones simultaneas por proceso; cada una usa su propia conexion a PostgreSQL
+EXPORT_MAX_CONCURRENT = int(os.environ.get('EXPORT_MAX_CONCURRENT', '2'))
 
 # Archivos JSON (fallback si no hay PostgreSQL)
-HISTORY_FILE = 'price_history.json'
+HISTORY_FILE = 'price_history.json'  # formato anterior, ver `flask --app app migrate-history-json`
+HISTORY_LOG_FILE = 'price_history.jsonl'
+HISTORY_INDEX_FILE = 'price_history.idx'
 SUBSCRIBERS_FILE = 'telegram_subscribers.json'
 LAST_BRECHA_FILE = 'last_brecha.json'
+PRUNED_SUBSCRIBERS_FILE = 'pruned_subscribers.json'
+ALERT_RULES_FILE = 'alert_rules.json'
+SCHEDULER_LOCK_FILE = 'scheduler.lock'
+SNAPSHOT_FILE = 'latest_snapshot.json'
+TICK_STATS_FILE = 'tick_stats.json'
+
+# Con el worker gevent de gunicorn (ver Procfile), psycopg2 debe ceder el
+# control mientras espera a PostgreSQL para no bloquear las demas conexiones
+try:
+    from gevent import monkey as _gevent_monkey
+    GEVENT_PATCHED = _gevent_monkey.is_module_patched('socket')
+except ImportError:
+    GEVENT_PATCHED = False
+
+if GEVENT_PATCHED:
+    try:
+        import psycopg2.extensions
+        import psycopg2.extras
+        psycopg2.extensions.set_wait_callback(psycopg2.extras.wait_select)
+    except ImportError:
+        pass
+
+# Con los workers sync de gunicorn cada conexion abierta ocupa un worker entero;
+# ahi /api/stream responde 204 y el navegador se queda con el polling
+SSE_ENABLED = GEVENT_PATCHED or 'gunicorn' not in os.environ.get('SERVER_SOFTWARE', '')
 
 # ============== CONEXION POSTGRESQL ==============
 
-def get_db_connection():
-    """Obtiene conexion a PostgreSQL"""
+# Pool compartido por los workers de Flask, el scheduler y el bot de Telegram
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+# Conexiones inactivas por mas de este tiempo se verifican antes de prestarlas
+DB_POOL_PING_AFTER = int(os.environ.get('DB_POOL_PING_AFTER', 60))
+# Espera antes de reintentar crear el pool si PostgreSQL no responde
+DB_POOL_RETRY_SECONDS = 30
+
+_db_pool = None
+_db_pool_slots = None
+_db_pool_lock = threading.Lock()
+_db_pool_retry_at = 0
+_db_pool_last_used = {}
+
+def database_dsn():
+    """DATABASE_URL en el formato que acepta psycopg2"""
+    # Render usa postgres:// pero psycopg2 necesita postgresql://
+    return DATABASE_URL.replace('postgres://', 'postgresql://')
+
+def get_db_pool():
+    """Retorna el pool de conexiones a PostgreSQL, creandolo la primera vez"""
+    global _db_pool, _db_pool_slots, _db_pool_retry_at
     if not DATABASE_URL:
         return None
+    if _db_pool is not None:
+        return _db_pool
+    with _db_pool_lock:
+        if _db_pool is None and time.monotonic() >= _db_pool_retry_at:
+            try:
+                from psycopg2.pool import ThreadedConnectionPool
+                _db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+                _db_pool = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, database_dsn(), connect_timeout=10)
+                atexit.register(close_db_pool)
+                print(f"Pool de PostgreSQL creado ({DB_POOL_MIN}-{DB_POOL_MAX} conexiones)")
+            except Exception as e:
+                print(f"Error conectando a PostgreSQL: {e}")
+                _db_pool_retry_at = time.monotonic() + DB_POOL_RETRY_SECONDS
+    return _db_pool
+
+def _connection_is_healthy(conn):
+    """Verifica una conexion del pool sin ir a la base de datos salvo que lleve tiempo inactiva"""
+    from psycopg2 import extensions
+    if conn.closed or conn.info.transaction_status == extensions.TRANSACTION_STATUS_UNKNOWN:
+        return False
+    last_used = _db_pool_last_used.get(id(conn))
     try:
-        import psycopg2
-        # Render usa postgres:// pero psycopg2 necesita postgresql://
-        db_url = DATABASE_URL.replace('postgres://', 'postgresql://')
-        conn = psycopg2.connect(db_url)
-        return conn
-    except Exception as e:
-        print(f"Error conectando a PostgreSQL: {e}")
-        return None
+        if not conn.autocommit:
+            conn.autocommit = True
+        if last_used is None or time.monotonic() - last_used < DB_POOL_PING_AFTER:
+            return True
+        cur = conn.cursor()
+        cur.execute('SELECT 1')
+        cur.close()
+        return True
+    except Exception:
+        return False
+
+@contextmanager
+def db_cursor(transaction=False):
+    """Presta una conexion del pool y entrega un cursor en modo autocommit.
+
+    Con `transaction=True` todo lo ejecutado con el cursor va en una sola
+    transaccion: se hace commit al salir del bloque y rollback si hay un error.
+
+    Si la conexion falla se descarta, y el pool abre una nueva en el siguiente uso.
+    """
+    import psycopg2
+    pool = get_db_pool()
+    if pool is None:
+        raise RuntimeError("PostgreSQL no disponible")
+
+    _db_pool_slots.acquire()
+    conn = None
+    discard = False
+    try:
+        for _ in range(DB_POOL_MAX + 1):
+            conn = pool.getconn()
+            if _connection_is_healthy(conn):
+                break
+            _db_pool_last_used.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+            conn = None
+        if conn is None:
+            raise psycopg2.OperationalError("No se pudo obtener una conexion sana del pool")
+
+        if transaction:
+            conn.autocommit = False
+        cur = conn.cursor()
+        try:
+            yield cur
+            if transaction:
+                conn.commit()
+        finally:
+            cur.close()
+            if transaction:
+                # Sin efecto si ya se hizo commit
+                conn.rollback()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        discard = True
+        raise
+    finally:
+        if conn is not None:
+            if discard or conn.closed:
+                _db_pool_last_used.pop(id(conn), None)
+                pool.putconn(conn, close=True)
+            else:
+                _db_pool_last_used[id(conn)] = time.monotonic()
+                pool.putconn(conn)
+        _db_pool_slots.release()
+
+@contextmanager
+def db_stream_cursor(name):
+    """Cursor del lado del servidor (DECLARE ... CURSOR) en una conexion propia.
+
+    Las filas se traen por lotes con fetchmany mientras el cliente descarga,
+    lo que puede tardar minutos; por eso la conexion no sale del pool y se
+    cierra al terminar. El cursor vive dentro de una transaccion de solo
+    lectura que se descarta con la conexion.
+    """
+    import psycopg2
+    conn = psycopg2.connect(database_dsn(), connect_timeout=10)
+    try:
+        conn.set_session(readonly=True)
+        with conn.cursor(name=name) as cur:
+            yield cur
+    finally:
+        conn.close()
+
+def close_db_pool():
+    """Cierra todas las conexiones del pool"""
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None:
+            _db_pool.closeall()
+            _db_pool = None
 
 def init_database():
     """Crea las tablas si no existen"""
-    conn = get_db_connection()
-    if not conn:
+    if not get_db_pool():
         print("PostgreSQL no disponible, usando archivos JSON")
         return False
 
     try:
-        cur = conn.cursor()
+        with db_cursor() as cur:
+            # Tabla de historial de precios
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS price_history (
+                    id SERIAL PRIMARY KEY,
+                    timestamp TIMESTAMPTZ NOT NULL,
+                    bcv_usd DECIMAL(10,2),
+                    bcv_eur DECIMAL(10,2),
+                    usdt_avg DECIMAL(10,2),
+                    brecha_usdt_usd DECIMAL(10,2),
+                    brecha_usdt_eur DECIMAL(10,2),
+                    brecha_eur_usd DECIMAL(10,2),
+                    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
 
-        # Tabla de historial de precios
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS price_history (
-                id SERIAL PRIMARY KEY,
-                timestamp TIMESTAMPTZ NOT NULL,
-                bcv_usd DECIMAL(10,2),
-                bcv_eur DECIMAL(10,2),
-                usdt_avg DECIMAL(10,2),
-                brecha_usdt_usd DECIMAL(10,2),
-                brecha_usdt_eur DECIMAL(10,2),
-                brecha_eur_usd DECIMAL(10,2),
-                created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Tabla de suscriptores de Telegram
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS telegram_subscribers (
-                id SERIAL PRIMARY KEY,
-                chat_id BIGINT UNIQUE NOT NULL,
-                subscribed_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Tabla de configuracion (para guardar ultima brecha)
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS app_settings (
-                key VARCHAR(50) PRIMARY KEY,
-                value TEXT,
-                updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+            # Tabla de suscriptores de Telegram
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS telegram_subscribers (
+                    id SERIAL PRIMARY KEY,
+                    chat_id BIGINT UNIQUE NOT NULL,
+                    subscribed_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
 
-        # Indice para busquedas por fecha
-        cur.execute('''
-            CREATE INDEX IF NOT EXISTS idx_price_history_timestamp
-            ON price_history(timestamp DESC)
-        ''')
+            # Tabla de configuracion (para guardar ultima brecha)
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS app_settings (
+                    key VARCHAR(50) PRIMARY KEY,
+                    value TEXT,
+                    updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
 
-        conn.commit()
-        cur.close()
-        conn.close()
+            # Reglas de alerta personalizadas (ver AlertRuleEngine)
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS alert_rules (
+                    id SERIAL PRIMARY KEY,
+                    chat_id BIGINT NOT NULL,
+                    metric VARCHAR(32) NOT NULL,
+                    kind VARCHAR(10) NOT NULL,
+                    threshold DECIMAL(12,2) NOT NULL,
+                    reference DECIMAL(12,2),
+                    cooldown_minutes INTEGER NOT NULL DEFAULT 60,
+                    last_fired_at TIMESTAMPTZ,
+                    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cur.execute('''
+                CREATE INDEX IF NOT EXISTS idx_alert_rules_chat_id
+                ON alert_rules(chat_id)
+            ''')
+
+            # Indice para busquedas por fecha
+            cur.execute('''
+                CREATE INDEX IF NOT EXISTS idx_price_history_timestamp
+                ON price_history(timestamp DESC)
+            ''')
+
+            # Rollups por hora y por dia (ver update_rollups)
+            for table in ROLLUP_TABLES.values():
+                cur.execute(rollup_table_ddl(table))
         print("PostgreSQL inicializado correctamente")
         return True
     except Exception as e:
         print(f"Error inicializando PostgreSQL: {e}")
         return False
 
+# ============== HISTORIAL EN ARCHIVO (JSONL) ==============
+
+class JsonlHistoryStore:
+    """Historial append-only en JSON Lines, usado cuando no hay PostgreSQL.
+
+    Cada registro es una linea; agregar uno es un write + fsync al final del
+    archivo. Un indice binario aparte guarda (epoch, offset) cada
+    `stride` registros, de modo que el registro numero k*stride empieza en el
+    offset k del indice. Con eso las busquedas por fecha y por posicion solo
+    leen unas pocas lineas. Si el proceso muere a mitad de una escritura, la
+    linea incompleta se ignora al leer y el escritor la descarta antes de su
+    siguiente append().
+
+    Otros procesos pueden leer el mismo archivo: antes de cada lectura se
+    revisa si el archivo crecio y se incorporan las lineas nuevas. Solo el
+    proceso que escribe (el lider) modifica el archivo o el indice; una linea
+    sin terminar puede ser un append en curso del lider.
+    """
+
+    INDEX_RECORD = struct.Struct('<qq')
+
+    def __init__(self, path, index_path, stride=64):
+        self.path = path
+        self.index_path = index_path
+        self.stride = stride
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._size = 0
+        self._count = 0
+        self._index_epochs = []
+        self._index_offsets = []
+        self._first = None
+        self._last = None
+
+    @staticmethod
+    def _epoch(entry):
+        return datetime_to_epoch(entry_datetime(entry))
+
+    def _load(self):
+        """Abre el archivo ignorando una linea incompleta al final y carga el indice"""
+        self._loaded = True
+        self._size = 0
+        self._count = 0
+        self._index_epochs = []
+        self._index_offsets = []
+        self._first = None
+        self._last = None
+        if not os.path.exists(self.path):
+            if os.path.exists(HISTORY_FILE):
+                print(f"Existe {HISTORY_FILE} del formato anterior; "
+                      f"ejecuta `flask --app app migrate-history-json` para migrarlo")
+            return
+
+        with open(self.path, 'rb') as f:
+            size = f.seek(0, os.SEEK_END)
+            if size:
+                f.seek(max(size - 65536, 0))
+                tail = f.read()
+                if not tail.endswith(b'\n'):
+                    size = size - len(tail) + tail.rfind(b'\n') + 1
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+            usable = len(data) - len(data) % self.INDEX_RECORD.size
+            for epoch, offset in self.INDEX_RECORD.iter_unpack(data[:usable]):
+                if offset >= size:
+                    break
+                self._index_epochs.append(epoch)
+                self._index_offsets.append(offset)
+
+        # Contar desde el ultimo punto indexado hasta el final del archivo
+        if self._index_offsets:
+            self._count = (len(self._index_offsets) - 1) * self.stride
+            self._scan(self._index_offsets[-1], size, indexed=True)
+        else:
+            self._scan(0, size, indexed=False)
+        if self._count:
+            self._first = self.read_rows(0, 1)[0]
+
+    def _scan(self, offset, size, indexed):
+        """Recorre las lineas desde `offset` actualizando cuenta, ultimo registro e indice"""
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            position = offset
+            first_line = indexed
+            last_line = None
+            while position < size:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    break
+                if first_line:
+                    # Linea ya contada por el indice
+                    first_line = False
+                    self._count += 1
+                else:
+                    if self._count % self.stride == 0:
+                        self._index_epochs.append(self._epoch(json.loads(line)))
+                        self._index_offsets.append(position)
+                    self._count += 1
+                position += len(line)
+                last_line = line
+            if last_line is not None:
+                self._last = json.loads(last_line)
+        self._size = position
+
+    def _rewrite_index_if_needed(self):
+        """Reescribe el indice si no coincide con el de memoria (solo desde append)"""
+        expected = len(self._index_offsets) * self.INDEX_RECORD.size
+        current = os.path.getsize(self.index_path) if os.path.exists(self.index_path) else -1
+        if current == expected:
+            return
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for epoch, offset in zip(self._index_epochs, self._index_offsets):
+                f.write(self.INDEX_RECORD.pack(epoch, offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_path)
+
+    def _sync(self):
+        """Carga el archivo la primera vez e incorpora lo que otro proceso haya agregado"""
+        if not self._loaded:
+            self._load()
+            return
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if size < self._size:
+            self._load()
+        elif size > self._size:
+            self._scan(self._size, size, indexed=False)
+            if self._first is None and self._count:
+                self._first = self.read_rows(0, 1)[0]
+
+    def _repair(self):
+        """Descarta la linea que dejo a medias un escritor anterior y pone al dia el indice"""
+        if os.path.exists(self.path) and os.path.getsize(self.path) > self._size:
+            # _sync() ya leyo todas las lineas completas: lo que sobra esta a medias
+            with open(self.path, 'rb+') as f:
+                f.truncate(self._size)
+            print(f"Descartada linea incompleta al final de {self.path}")
+        self._rewrite_index_if_needed()
+
+    def append(self, entry):
+        """Agrega un registro al final del archivo con fsync"""
+        line = (json.dumps(entry, separators=(',', ':')) + '\n').encode()
+        with self._lock:
+            self._sync()
+            self._repair()
+            with open(self.path, 'ab') as f:
+                offset = f.tell()
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            if self._count % self.stride == 0:
+                epoch = self._epoch(entry)
+                with open(self.index_path, 'ab') as f:
+                    f.write(self.INDEX_RECORD.pack(epoch, offset))
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._index_epochs.append(epoch)
+                self._index_offsets.append(offset)
+            self._count += 1
+            self._size = offset + len(line)
+            self._last = entry
+            if self._first is None:
+                self._first = entry
+
+    def __len__(self):
+        with self._lock:
+            self._sync()
+            return self._count
+
+    def first(self):
+        with self._lock:
+            self._sync()
+            return self._first
+
+    def last(self):
+        with self._lock:
+            self._sync()
+            return self._last
+
+    def read_rows(self, lo, hi):
+        """Registros en las posiciones [lo, hi)"""
+        lo = max(lo, 0)
+        with self._lock:
+            if not self._loaded:
+                self._sync()
+            hi = min(hi, self._count)
+            if lo >= hi:
+                return []
+            block = lo // self.stride
+            offset = self._index_offsets[block]
+        rows = []
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for _ in range(lo - block * self.stride):
+                f.readline()
+            for _ in range(hi - lo):
+                rows.append(json.loads(f.readline()))
+        return rows
+
+    def iter_rows(self, lo, hi, batch_size=1000):
+        """Igual que read_rows pero por lotes, para rangos grandes"""
+        for batch_start in range(lo, hi, batch_size):
+            yield from self.read_rows(batch_start, min(batch_start + batch_size, hi))
+
+    def position(self, moment, inclusive=False):
+        """Cantidad de registros con fecha < moment (o <= moment si inclusive)"""
+        with self._lock:
+            self._sync()
+            epoch = datetime_to_epoch(moment)
+            block = max(bisect_left(self._index_epochs, epoch) - 1, 0)
+            count = self._count
+            if not self._index_offsets:
+                return 0
+            offset = self._index_offsets[block]
+        position = block * self.stride
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            while position < count:
+                entry_dt = entry_datetime(json.loads(f.readline()))
+                if entry_dt > moment or (entry_dt == moment and not inclusive):
+                    break
+                position += 1
+        return position
+
+    def load_all(self):
+        with self._lock:
+            self._sync()
+            count = self._count
+        return self.read_rows(0, count)
+
+history_store = JsonlHistoryStore(HISTORY_LOG_FILE, HISTORY_INDEX_FILE)
+
+def migrate_history_json(force=False):
+    """Convierte price_history.json (lista JSON) al historial JSONL. Retorna los registros migrados"""
+    if not os.path.exists(HISTORY_FILE):
+        raise click.ClickException(f"No existe {HISTORY_FILE}")
+    if len(history_store) and not force:
+        raise click.ClickException(f"{HISTORY_LOG_FILE} ya tiene registros; usa --force para reemplazarlo")
+
+    with open(HISTORY_FILE, 'r') as f:
+        history = json.load(f)
+    history = sorted((e for e in history if e.get('timestamp')), key=entry_datetime)
+
+    os.replace(HISTORY_FILE, HISTORY_FILE + '.bak')
+    for path in (HISTORY_LOG_FILE, HISTORY_INDEX_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+    history_store._loaded = False
+    for entry in history:
+        history_store.append(entry)
+    return len(history)
+
+# ============== CACHE COLUMNAR DEL HISTORIAL ==============
+
+_EPOCH = datetime(1970, 1, 1)
+
+def datetime_to_epoch_us(dt):
+    """Microsegundos epoch de un datetime UTC sin timezone"""
+    return (dt - _EPOCH) // timedelta(microseconds=1)
+
+def entries_to_arrays(entries):
+    """(timestamps en microsegundos, {metrica: float64 con NaN para None}) de una lista de registros"""
+    timestamps = np.array([datetime_to_epoch_us(entry_datetime(e)) for e in entries], dtype=np.int64)
+    columns = {
+        metric: np.array(
+            [e.get(metric) if e.get(metric) is not None else np.nan for e in entries],
+            dtype=np.float64
+        )
+        for metric in METRICS
+    }
+    return timestamps, columns
+
+def epoch_us_to_iso(value):
+    return (_EPOCH + timedelta(microseconds=int(value))).isoformat() + 'Z'
+
+class ColumnarHistoryCache:
+    """Copia columnar del historial en archivos memory-mapped.
+
+    Guarda un arreglo int64 de microsegundos epoch y un arreglo float64 por
+    metrica (NaN donde no hay dato), mas un archivo meta con
+    [registros, capacidad, sincronizado]. Los archivos sobreviven reinicios y
+    todos los procesos de la maquina los mapean, asi que los workers de
+    gunicorn comparten una sola copia en memoria.
+
+    Solo se escribe con un flock tomado: catch_up() trae de la fuente de
+    verdad (PostgreSQL o JSONL) los registros que falten y append() agrega el
+    registro que acaba de guardar save_history_entry(). Los lectores ven
+    los primeros `registros` elementos, que nunca se modifican, y solo si
+    el cache esta marcado como sincronizado: mientras se construye o se
+    reconstruye, view() devuelve None y se lee de la fuente de verdad.
+    """
+
+    META_LENGTH = 0
+    META_CAPACITY = 1
+    META_SYNCED = 2
+
+    def __init__(self, directory, initial_capacity=1 << 16):
+        self.directory = directory
+        self.initial_capacity = initial_capacity
+        self._lock = threading.RLock()
+        # Protege el mapeo (no el flock), para que view() no espere a catch_up()
+        self._map_lock = threading.RLock()
+        self._meta = None
+        self._timestamps = None
+        self._columns = {}
+        self._mapped_capacity = 0
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _files(self):
+        yield 'timestamps.i8', np.int64
+        for metric in METRICS:
+            yield f'{metric}.f8', np.float64
+
+    @contextmanager
+    def _write_lock(self):
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._path('.lock'), 'a') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _ensure_mapped(self, create=False):
+        """Mapea los archivos, o los vuelve a mapear si otro proceso los agrando"""
+        with self._map_lock:
+            return self._map_files(create)
+
+    def _map_files(self, create):
+        meta_path = self._path('meta.i8')
+        if self._meta is None:
+            if not os.path.exists(meta_path):
+                if not create:
+                    return False
+                with open(meta_path, 'wb') as f:
+                    f.write(np.array([0, self.initial_capacity, 0, 0], dtype=np.int64).tobytes())
+            self._meta = np.memmap(meta_path, dtype=np.int64, mode='r+', shape=(4,))
+
+        capacity = int(self._meta[self.META_CAPACITY])
+        if capacity != self._mapped_capacity:
+            arrays = []
+            for name, dtype in self._files():
+                path = self._path(name)
+                size = capacity * np.dtype(dtype).itemsize
+                if not os.path.exists(path) or os.path.getsize(path) < size:
+                    if not create:
+                        return False
+                    with open(path, 'ab') as f:
+                        f.truncate(size)
+                arrays.append(np.memmap(path, dtype=dtype, mode='r+', shape=(capacity,)))
+            self._timestamps = arrays[0]
+            self._columns = dict(zip(METRICS, arrays[1:]))
+            self._mapped_capacity = capacity
+        return True
+
+    def _reserve(self, needed):
+        """Duplica la capacidad de los archivos hasta que quepan `needed` registros"""
+        capacity = int(self._meta[self.META_CAPACITY])
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name, dtype in self._files():
+            with open(self._path(name), 'ab') as f:
+                f.truncate(capacity * np.dtype(dtype).itemsize)
+        self._meta[self.META_CAPACITY] = capacity
+        self._ensure_mapped(create=True)
+
+    def _write(self, timestamps, columns):
+        """Agrega registros ya convertidos a arreglos; se publica al actualizar la longitud"""
+        length = int(self._meta[self.META_LENGTH])
+        count = len(timestamps)
+        if not count:
+            return
+        self._reserve(length + count)
+        self._timestamps[length:length + count] = timestamps
+        for metric in METRICS:
+            self._columns[metric][length:length + count] = columns[metric]
+        self._timestamps.flush()
+        for column in self._columns.values():
+            column.flush()
+        self._meta[self.META_LENGTH] = length + count
+        self._meta.flush()
+
+    def _write_after_last(self, entries):
+        """Escribe los registros posteriores al ultimo publicado; devuelve cuantos"""
+        length = int(self._meta[self.META_LENGTH])
+        timestamps, columns = entries_to_arrays(entries)
+        if length:
+            keep = timestamps > self._timestamps[length - 1]
+            timestamps = timestamps[keep]
+            columns = {metric: values[keep] for metric, values in columns.items()}
+        self._write(timestamps, columns)
+        return len(timestamps)
+
+    def _last_datetime(self):
+        length = int(self._meta[self.META_LENGTH])
+        if not length:
+            return None
+        return _EPOCH + timedelta(microseconds=int(self._timestamps[length - 1]))
+
+    def catch_up(self):
+        """Trae de la fuente de verdad los registros que le faltan al cache"""
+        if not HISTORY_CACHE_ENABLED:
+            return
+        try:
+            added = 0
+            with self._write_lock():
+                self._ensure_mapped(create=True)
+                after = self._last_datetime()
+                if after is not None:
+                    latest = load_latest_entry()
+                    if latest is None or entry_datetime(latest) < after:
+                        # La fuente tiene menos datos que el cache: reconstruir.
+                        # Primero se desmarca, para que nadie lea el cache vacio
+                        self._meta[self.META_SYNCED] = 0
+                        self._meta.flush()
+                        self._meta[self.META_LENGTH] = 0
+                        self._meta.flush()
+                        after = None
+                if self._meta[self.META_SYNCED]:
+                    # Incremental: pocos registros, se traen con el lock tomado
+                    for batch in iter_history_after(after):
+                        added += self._write_after_last(batch)
+                    bulk = False
+                else:
+                    bulk = True
+
+            if bulk:
+                # Carga completa: la consulta larga corre sin locks y cada lote
+                # se escribe con el flock tomado. Nadie lee el cache hasta el
+                # final y append() no escribe mientras no este sincronizado
+                for batch in iter_history_after(after):
+                    with self._write_lock():
+                        added += self._write_after_last(batch)
+                with self._write_lock():
+                    # Lo que se guardo mientras tanto y append() dejo pasar
+                    for batch in iter_history_after(self._last_datetime()):
+                        added += self._write_after_last(batch)
+                    self._meta[self.META_SYNCED] = 1
+                    self._meta.flush()
+
+            if added:
+                print(f"Cache columnar del historial: {added} registros nuevos "
+                      f"({int(self._meta[self.META_LENGTH])} en total)")
+        except Exception as e:
+            print(f"Error sincronizando cache columnar: {e}")
+
+    def append(self, entry):
+        """Agrega un registro recien guardado, si el cache ya esta sincronizado"""
+        if not HISTORY_CACHE_ENABLED:
+            return
+        try:
+            with self._write_lock():
+                if not self._ensure_mapped() or not self._meta[self.META_SYNCED]:
+                    return
+                length = int(self._meta[self.META_LENGTH])
+                timestamps, columns = entries_to_arrays([entry])
+                if length and timestamps[0] <= self._timestamps[length - 1]:
+                    return
+                self._write(timestamps, columns)
+        except Exception as e:
+            print(f"Error agregando al cache columnar: {e}")
+
+    def view(self):
+        """(timestamps, columnas) con los registros publicados, o None si el cache no esta listo"""
+        if not HISTORY_CACHE_ENABLED:
+            return None
+        with self._map_lock:
+            try:
+                if not self._ensure_mapped() or not self._meta[self.META_SYNCED]:
+                    return None
+            except Exception as e:
+                print(f"Error abriendo cache columnar: {e}")
+                return None
+            length = int(self._meta[self.META_LENGTH])
+            if not self._meta[self.META_SYNCED]:
+                # Una reconstruccion empezo entre las dos lecturas
+                return None
+            return self._timestamps[:length], {m: c[:length] for m, c in self._columns.items()}
+
+    @staticmethod
+    def entry_at(view, index):
+        timestamps, columns = view
+        entry = {"timestamp": epoch_us_to_iso(timestamps[index])}
+        for metric in METRICS:
+            value = columns[metric][index]
+            entry[metric] = None if np.isnan(value) else float(value)
+        return entry
+
+    @staticmethod
+    def bounds(view, start=None, end=None):
+        """Indices [lo, hi) del rango de fechas, con searchsorted"""
+        timestamps = view[0]
+        lo = int(np.searchsorted(timestamps, datetime_to_epoch_us(start), 'left')) if start else 0
+        hi = int(np.searchsorted(timestamps, datetime_to_epoch_us(end), 'right')) if end else len(timestamps)
+        return lo, hi
+
+history_cache = ColumnarHistoryCache(HISTORY_CACHE_DIR)
+
+def iter_history_after(after=None, batch_size=50000):
+    """Registros del historial posteriores a `after`, en lotes ordenados"""
+    if get_db_pool():
+        while True:
+            with db_cursor() as cur:
+                if after is None:
+                    cur.execute('''
+                        SELECT timestamp, bcv_usd, bcv_eur, usdt_avg,
+                               brecha_usdt_usd, brecha_usdt_eur, brecha_eur_usd
+                        FROM price_history
+                        ORDER BY timestamp ASC
+                        LIMIT %s
+                    ''', (batch_size,))
+                else:
+                    cur.execute('''
+                        SELECT timestamp, bcv_usd, bcv_eur, usdt_avg,
+                               brecha_usdt_usd, brecha_usdt_eur, brecha_eur_usd
+                        FROM price_history
+                        WHERE timestamp > %s
+                        ORDER BY timestamp ASC
+                        LIMIT %s
+                    ''', (after, batch_size))
+                rows = cur.fetchall()
+            if not rows:
+                return
+            batch = [row_to_entry(row) for row in rows]
+            yield batch
+            if len(rows) < batch_size:
+                return
+            after = entry_datetime(batch[-1])
+        return
+
+    # Fallback a JSON
+    lo = history_store.position(after, inclusive=True) if after else 0
+    hi = len(history_store)
+    for batch_start in range(lo, hi, batch_size):
+        yield history_store.read_rows(batch_start, min(batch_start + batch_size, hi))
+
 # ============== FUNCIONES DE DATOS ==============
 
+# Columnas numericas de price_history, en el orden en que se guardan
+METRICS = ('bcv_usd', 'bcv_eur', 'usdt_avg', 'brecha_usdt_usd', 'brecha_usdt_eur', 'brecha_eur_usd')
+
+def format_timestamp(ts):
+    """Convierte un timestamp de PostgreSQL a formato ISO sin timezone info + Z"""
+    if not ts:
+        return None
+    if ts.tzinfo is not None:
+        ts = ts.replace(tzinfo=None)
+    return ts.isoformat() + 'Z'
+
+def row_to_entry(row):
+    """Convierte una fila de price_history en un registro del historial"""
+    return {
+        "timestamp": format_timestamp(row[0]),
+        "bcv_usd": float(row[1]) if row[1] else None,
+        "bcv_eur": float(row[2]) if row[2] else None,
+        "usdt_avg": float(row[3]) if row[3] else None,
+        "brecha_usdt_usd": float(row[4]) if row[4] else None,
+        "brecha_usdt_eur": float(row[5]) if row[5] else None,
+        "brecha_eur_usd": float(row[6]) if row[6] else None
+    }
+
 def load_history():
     """Carga historial de precios"""
-    conn = get_db_connection()
-    if conn:
+    if get_db_pool():
         try:
-            cur = conn.cursor()
-            cur.execute('''
-                SELECT timestamp, bcv_usd, bcv_eur, usdt_avg,
-                       brecha_usdt_usd, brecha_usdt_eur, brecha_eur_usd
-                FROM price_history
-                ORDER BY timestamp ASC
-            ''')
-            rows = cur.fetchall()
-            cur.close()
-            conn.close()
-
-            history = []
-            for row in rows:
-                # Convertir timestamp a formato ISO sin timezone info + Z
-                ts = row[0]
-                if ts:
-                    if ts.tzinfo is not None:
-                        ts = ts.replace(tzinfo=None)
-                    timestamp_str = ts.isoformat() + 'Z'
-                else:
-                    timestamp_str = None
-                history.append({
-                    "timestamp": timestamp_str,
-                    "bcv_usd": float(row[1]) if row[1] else None,
-                    "bcv_eur": float(row[2]) if row[2] else None,
-                    "usdt_avg": float(row[3]) if row[3] else None,
-                    "brecha_usdt_usd": float(row[4]) if row[4] else None,
-                    "brecha_usdt_eur": float(row[5]) if row[5] else None,
-                    "brecha_eur_usd": float(row[6]) if row[6] else None
-                })
-            return history
+            with db_cursor() as cur:
+                cur.execute('''
+                    SELECT timestamp, bcv_usd, bcv_eur, usdt_avg,
+                           brecha_usdt_usd, brecha_usdt_eur, brecha_eur_usd
+                    FROM price_history
+                    ORDER BY timestamp ASC
+                ''')
+                rows = cur.fetchall()
+            return [row_to_entry(row) for row in rows]
         except Exception as e:
             print(f"Error cargando historial de PostgreSQL: {e}")
             return []
 
     # Fallback a JSON
-    if os.path.exists(HISTORY_FILE):
+    try:
+        return history_store.load_all()
+    except Exception as e:
+        print(f"Error cargando historial de {HISTORY_LOG_FILE}: {e}")
+        return []
+
+def load_latest_entry():
+    """Carga solo el registro mas reciente del historial"""
+    if get_db_pool():
         try:
-            with open(HISTORY_FILE, 'r') as f:
-                return json.load(f)
-        except:
-            return []
-    return []
+            with db_cursor() as cur:
+                cur.execute('''
+                    SELECT timestamp, bcv_usd, bcv_eur, usdt_avg,
+                           brecha_usdt_usd, brecha_usdt_eur, brecha_eur_usd
+                    FROM price_history
+                    ORDER BY timestamp DESC
+                    LIMIT 1
+                ''')
+                row = cur.fetchone()
+            return row_to_entry(row) if row else None
+        except Exception as e:
+            print(f"Error cargando ultimo registro de PostgreSQL: {e}")
+            return None
+
+    # Fallback a JSON
+    return history_store.last()
+
+def history_store_bounds(start=None, end=None):
+    """Posiciones [lo, hi) del rango de fechas en el historial JSONL"""
+    lo = history_store.position(start) if start else 0
+    hi = history_store.position(end, inclusive=True) if end else len(history_store)
+    return lo, hi
+
+def query_history(start=None, end=None, limit=100, offset=0):
+    """Consulta una pagina del historial dentro de un rango de fechas.
+
+    Retorna (registros, total). Los registros van en orden ascendente y la
+    pagina se cuenta desde el mas reciente: offset=0 son los `limit` registros
+    mas nuevos del rango.
+    """
+    view = history_cache.view()
+    if view is not None:
+        lo, hi = history_cache.bounds(view, start, end)
+        total = max(hi - lo, 0)
+        page_end = hi - offset
+        page_start = max(lo, page_end - limit)
+        if page_end <= lo:
+            return [], total
+        return [history_cache.entry_at(view, i) for i in range(page_start, page_end)], total
+
+    if get_db_pool():
+        try:
+            conditions = []
+            params = []
+            if start:
+                conditions.append('timestamp >= %s')
+                params.append(start)
+            if end:
+                conditions.append('timestamp <= %s')
+                params.append(end)
+            where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+
+            with db_cursor() as cur:
+                cur.execute(f'SELECT COUNT(*) FROM price_history {where}', params)
+                total = cur.fetchone()[0]
+                cur.execute(f'''
+                    SELECT timestamp, bcv_usd, bcv_eur, usdt_avg,
+                           brecha_usdt_usd, brecha_usdt_eur, brecha_eur_usd
+                    FROM price_history
+                    {where}
+                    ORDER BY timestamp DESC
+                    LIMIT %s OFFSET %s
+                ''', params + [limit, offset])
+                rows = cur.fetchall()
+            return [row_to_entry(row) for row in reversed(rows)], total
+        except Exception as e:
+            print(f"Error consultando historial de PostgreSQL: {e}")
+            return [], 0
+
+    # Fallback a JSON: solo se leen las lineas de la pagina
+    lo, hi = history_store_bounds(start, end)
+    total = max(hi - lo, 0)
+    page_end = hi - offset
+    page_start = max(lo, page_end - limit)
+    if page_end <= lo:
+        return [], total
+    return history_store.read_rows(page_start, page_end), total
+
+def query_history_columns(start=None, end=None, limit=100, offset=0):
+    """Igual que query_history() pero retorna (timestamps, columnas, total) en arreglos.
+
+    Con el cache columnar la pagina es un corte de los arreglos, sin armar un
+    dict por registro; sin el cache se convierten los registros de la pagina.
+    """
+    view = history_cache.view()
+    if view is not None:
+        lo, hi = history_cache.bounds(view, start, end)
+        total = max(hi - lo, 0)
+        page_end = max(hi - offset, lo)
+        page_start = max(lo, page_end - limit)
+        timestamps, columns = view
+        return (timestamps[page_start:page_end],
+                {m: columns[m][page_start:page_end] for m in METRICS}, total)
+
+    history, total = query_history(start=start, end=end, limit=limit, offset=offset)
+    return entries_to_arrays(history) + (total,)
+
+def iter_history_range(start=None, end=None, after=None, batch_size=EXPORT_BATCH_SIZE):
+    """Registros del rango [start, end] (o posteriores a `after`) en lotes ascendentes.
+
+    En PostgreSQL usa un cursor del lado del servidor en una conexion fuera
+    del pool, asi la memoria no depende del tamano del rango y una descarga
+    lenta no deja al resto de la app sin conexiones. Sin PostgreSQL lee el
+    JSONL por posiciones.
+    """
+    if get_db_pool():
+        conditions = []
+        params = []
+        if start:
+            conditions.append('timestamp >= %s')
+            params.append(start)
+        if after:
+            conditions.append('timestamp > %s')
+            params.append(after)
+        if end:
+            conditions.append('timestamp <= %s')
+            params.append(end)
+        where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+        with db_stream_cursor('history_export') as cur:
+            cur.itersize = batch_size
+            cur.execute(f'''
+                SELECT timestamp, bcv_usd, bcv_eur, usdt_avg,
+                       brecha_usdt_usd, brecha_usdt_eur, brecha_eur_usd
+                FROM price_history
+                {where}
+                ORDER BY timestamp ASC
+            ''', params)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield [row_to_entry(row) for row in rows]
+
+    # Fallback a JSON
+    lo, hi = history_store_bounds(start, end)
+    if after:
+        lo = max(lo, history_store.position(after, inclusive=True))
+    for batch_start in range(lo, hi, batch_size):
+        yield history_store.read_rows(batch_start, min(batch_start + batch_size, hi))
+
+def round_to_columns(data):
+    """Copia de `data` con las metricas redondeadas como las columnas DECIMAL(10,2)"""
+    entry = dict(data)
+    for metric in METRICS:
+        if entry.get(metric) is not None:
+            entry[metric] = float(Decimal(repr(entry[metric])).quantize(Decimal('0.01'), ROUND_HALF_UP))
+    return entry
 
 def save_history_entry(data):
-    """Guarda un registro en el historial"""
-    conn = get_db_connection()
-    if conn:
+    """Guarda un registro en el historial.
+
+    En modo 'changes' el registro solo se inserta si should_store_entry() lo
+    pide; los rollups se actualizan con cada tick de todas formas.
+
+    Retorna el registro tal como quedo guardado (en PostgreSQL, con los
+    valores redondeados por la columna), que es el que se publica como
+    snapshot, o None si no se pudo guardar.
+    """
+    global _last_stored_entry
+    store = should_store_entry(data)
+
+    if get_db_pool():
         try:
-            cur = conn.cursor()
             timestamp = data.get('timestamp', '').replace('Z', '')
-            cur.execute('''
-                INSERT INTO price_history
-                (timestamp, bcv_usd, bcv_eur, usdt_avg, brecha_usdt_usd, brecha_usdt_eur, brecha_eur_usd)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                timestamp,
-                data.get('bcv_usd'),
-                data.get('bcv_eur'),
-                data.get('usdt_avg'),
-                data.get('brecha_usdt_usd'),
-                data.get('brecha_usdt_eur'),
-                data.get('brecha_eur_usd')
-            ))
-            conn.commit()
-            cur.close()
-            conn.close()
-            return True
+            stored = None
+            # Registro y rollups en una transaccion: o quedan los dos o ninguno
+            with db_cursor(transaction=True) as cur:
+                if store:
+                    # RETURNING: el cache columnar guarda los valores ya redondeados por la columna
+                    cur.execute('''
+                        INSERT INTO price_history
+                        (timestamp, bcv_usd, bcv_eur, usdt_avg, brecha_usdt_usd, brecha_usdt_eur, brecha_eur_usd)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s)
+                        RETURNING timestamp, bcv_usd, bcv_eur, usdt_avg,
+                                  brecha_usdt_usd, brecha_usdt_eur, brecha_eur_usd
+                    ''', (
+                        timestamp,
+                        data.get('bcv_usd'),
+                        data.get('bcv_eur'),
+                        data.get('usdt_avg'),
+                        data.get('brecha_usdt_usd'),
+                        data.get('brecha_usdt_eur'),
+                        data.get('brecha_eur_usd')
+                    ))
+                    stored = row_to_entry(cur.fetchone())
+                update_rollups(cur, data)
+            if not store:
+                # Mismos valores que tendria el registro si se hubiera guardado
+                return round_to_columns(data)
+            _last_stored_entry = stored
+            history_cache.append(stored)
+            return stored
         except Exception as e:
             print(f"Error guardando en PostgreSQL: {e}")
-            return False
+            return None
 
     # Fallback a JSON
-    history = load_history()
-    history.append(data)
-    with open(HISTORY_FILE, 'w') as f:
-        json.dump(history, f)
-    return True
+    if not store:
+        return data
+    try:
+        history_store.append(data)
+    except Exception as e:
+        print(f"Error guardando en {HISTORY_LOG_FILE}: {e}")
+        return None
+    _last_stored_entry = data
+    history_cache.append(data)
+    return data
 
-def load_subscribers():
-    """Carga lista de suscriptores de Telegram"""
-    conn = get_db_connection()
-    if conn:
+def fetch_subscribers():
+    """Lee los suscriptores de la base de datos, o None si la lectura falla"""
+    if get_db_pool():
         try:
-            cur = conn.cursor()
-            cur.execute('SELECT chat_id FROM telegram_subscribers')
-            rows = cur.fetchall()
-            cur.close()
-            conn.close()
+            with db_cursor() as cur:
+                cur.execute('SELECT chat_id FROM telegram_subscribers')
+                rows = cur.fetchall()
             return [row[0] for row in rows]
         except Exception as e:
             print(f"Error cargando suscriptores: {e}")
-            return []
+            return None
 
     # Fallback a JSON
     if os.path.exists(SUBSCRIBERS_FILE):
@@ -211,69 +1184,185 @@ def load_subscribers():
             with open(SUBSCRIBERS_FILE, 'r') as f:
                 return json.load(f)
         except:
-            return []
+            return None
     return []
 
+# Set en memoria de suscriptores, la referencia dentro del proceso. Las altas
+# y bajas se escriben primero en la base de datos y luego en el set, y
+# reload_subscribers() lo reemplaza cada SUBSCRIBERS_RELOAD_SECONDS.
+_subscribers = None
+_subscribers_lock = threading.Lock()
+
+def reload_subscribers():
+    """Recarga el set de suscriptores; si la lectura falla se conserva el actual"""
+    global _subscribers
+    subscribers = fetch_subscribers()
+    if subscribers is None:
+        return False
+    with _subscribers_lock:
+        _subscribers = set(subscribers)
+    return True
+
+def load_subscribers():
+    """Carga lista de suscriptores de Telegram"""
+    if _subscribers is None:
+        reload_subscribers()
+    with _subscribers_lock:
+        return list(_subscribers or ())
+
+def is_subscriber(chat_id):
+    if _subscribers is None:
+        reload_subscribers()
+    return chat_id in (_subscribers or ())
+
+def count_subscribers():
+    if _subscribers is None:
+        reload_subscribers()
+    return len(_subscribers or ())
+
+def _write_subscriber(chat_id, subscribed):
+    with _subscribers_lock:
+        if _subscribers is not None:
+            if subscribed:
+                _subscribers.add(chat_id)
+            else:
+                _subscribers.discard(chat_id)
+
 def add_subscriber(chat_id):
     """Agrega un suscriptor"""
-    conn = get_db_connection()
-    if conn:
+    if get_db_pool():
         try:
-            cur = conn.cursor()
-            cur.execute('''
-                INSERT INTO telegram_subscribers (chat_id)
-                VALUES (%s)
-                ON CONFLICT (chat_id) DO NOTHING
-            ''', (chat_id,))
-            conn.commit()
-            cur.close()
-            conn.close()
-            return True
+            with db_cursor() as cur:
+                cur.execute('''
+                    INSERT INTO telegram_subscribers (chat_id)
+                    VALUES (%s)
+                    ON CONFLICT (chat_id) DO NOTHING
+                ''', (chat_id,))
         except Exception as e:
             print(f"Error agregando suscriptor: {e}")
             return False
+        _write_subscriber(chat_id, True)
+        return True
 
     # Fallback a JSON
-    subscribers = load_subscribers()
+    subscribers = fetch_subscribers() or []
     if chat_id not in subscribers:
         subscribers.append(chat_id)
         with open(SUBSCRIBERS_FILE, 'w') as f:
             json.dump(subscribers, f)
+    _write_subscriber(chat_id, True)
     return True
 
 def remove_subscriber(chat_id):
     """Remueve un suscriptor"""
-    conn = get_db_connection()
-    if conn:
+    if get_db_pool():
         try:
-            cur = conn.cursor()
-            cur.execute('DELETE FROM telegram_subscribers WHERE chat_id = %s', (chat_id,))
-            conn.commit()
-            cur.close()
-            conn.close()
-            return True
+            with db_cursor() as cur:
+                cur.execute('DELETE FROM telegram_subscribers WHERE chat_id = %s', (chat_id,))
         except Exception as e:
             print(f"Error removiendo suscriptor: {e}")
             return False
+        _write_subscriber(chat_id, False)
+        return True
 
     # Fallback a JSON
-    subscribers = load_subscribers()
+    subscribers = fetch_subscribers() or []
     if chat_id in subscribers:
         subscribers.remove(chat_id)
         with open(SUBSCRIBERS_FILE, 'w') as f:
             json.dump(subscribers, f)
+    _write_subscriber(chat_id, False)
     return True
 
+def remove_subscribers(chat_ids):
+    """Remueve varios suscriptores de una vez; devuelve cuantos se eliminaron"""
+    chat_ids = list(dict.fromkeys(chat_ids))
+    if not chat_ids:
+        return 0
+
+    if get_db_pool():
+        try:
+            with db_cursor() as cur:
+                cur.execute(
+                    'DELETE FROM telegram_subscribers WHERE chat_id = ANY(%s) RETURNING chat_id',
+                    (chat_ids,)
+                )
+                removed = [row[0] for row in cur.fetchall()]
+        except Exception as e:
+            print(f"Error removiendo suscriptores: {e}")
+            return 0
+    else:
+        # Fallback a JSON
+        subscribers = fetch_subscribers() or []
+        dead = set(chat_ids)
+        removed = [chat_id for chat_id in subscribers if chat_id in dead]
+        if removed:
+            with open(SUBSCRIBERS_FILE, 'w') as f:
+                json.dump([chat_id for chat_id in subscribers if chat_id not in dead], f)
+
+    for chat_id in chat_ids:
+        _write_subscriber(chat_id, False)
+    return len(removed)
+
+def load_pruned_subscribers():
+    """Total de suscriptores eliminados por bloquear el bot o no existir"""
+    if get_db_pool():
+        try:
+            with db_cursor() as cur:
+                cur.execute("SELECT value FROM app_settings WHERE key = 'pruned_subscribers'")
+                row = cur.fetchone()
+            return int(row[0]) if row else 0
+        except Exception as e:
+            print(f"Error cargando suscriptores eliminados: {e}")
+            return 0
+
+    # Fallback a JSON
+    if os.path.exists(PRUNED_SUBSCRIBERS_FILE):
+        try:
+            with open(PRUNED_SUBSCRIBERS_FILE, 'r') as f:
+                return json.load(f)
+        except:
+            return 0
+    return 0
+
+def add_pruned_subscribers(count):
+    """Suma `count` al total de suscriptores eliminados"""
+    if get_db_pool():
+        try:
+            with db_cursor() as cur:
+                cur.execute('''
+                    INSERT INTO app_settings (key, value, updated_at)
+                    VALUES ('pruned_subscribers', %s, CURRENT_TIMESTAMP)
+                    ON CONFLICT (key) DO UPDATE
+                    SET value = (app_settings.value::bigint + %s)::text, updated_at = CURRENT_TIMESTAMP
+                ''', (str(count), count))
+            return True
+        except Exception as e:
+            print(f"Error guardando suscriptores eliminados: {e}")
+            return False
+
+    # Fallback a JSON
+    total = load_pruned_subscribers() + count
+    with open(PRUNED_SUBSCRIBERS_FILE, 'w') as f:
+        json.dump(total, f)
+    return True
+
+def prune_subscribers(chat_ids):
+    """Elimina chats muertos detectados en una difusion y actualiza el contador"""
+    removed = remove_subscribers(chat_ids)
+    delete_alert_rules_for_chats(chat_ids)
+    if removed:
+        add_pruned_subscribers(removed)
+        print(f"[{datetime.now()}] {removed} suscriptores eliminados (bot bloqueado o chat inexistente)")
+    return removed
+
 def load_last_brecha():
     """Carga la ultima brecha guardada"""
-    conn = get_db_connection()
-    if conn:
+    if get_db_pool():
         try:
-            cur = conn.cursor()
-            cur.execute("SELECT value FROM app_settings WHERE key = 'last_brecha'")
-            row = cur.fetchone()
-            cur.close()
-            conn.close()
+            with db_cursor() as cur:
+                cur.execute("SELECT value FROM app_settings WHERE key = 'last_brecha'")
+                row = cur.fetchone()
             if row:
                 return json.loads(row[0])
             return None
@@ -293,14 +1382,11 @@ def load_last_brecha():
 def load_last_bcv():
     """Carga los ultimos valores del BCV guardados"""
     LAST_BCV_FILE = 'last_bcv.json'
-    conn = get_db_connection()
-    if conn:
+    if get_db_pool():
         try:
-            cur = conn.cursor()
-            cur.execute("SELECT value FROM app_settings WHERE key = 'last_bcv'")
-            row = cur.fetchone()
-            cur.close()
-            conn.close()
+            with db_cursor() as cur:
+                cur.execute("SELECT value FROM app_settings WHERE key = 'last_bcv'")
+                row = cur.fetchone()
             if row:
                 return json.loads(row[0])
             return None
@@ -320,18 +1406,14 @@ def load_last_bcv():
 def save_last_bcv(bcv_data):
     """Guarda los ultimos valores del BCV"""
     LAST_BCV_FILE = 'last_bcv.json'
-    conn = get_db_connection()
-    if conn:
+    if get_db_pool():
         try:
-            cur = conn.cursor()
-            cur.execute('''
-                INSERT INTO app_settings (key, value, updated_at)
-                VALUES ('last_bcv', %s, CURRENT_TIMESTAMP)
-                ON CONFLICT (key) DO UPDATE SET value = %s, updated_at = CURRENT_TIMESTAMP
-            ''', (json.dumps(bcv_data), json.dumps(bcv_data)))
-            conn.commit()
-            cur.close()
-            conn.close()
+            with db_cursor() as cur:
+                cur.execute('''
+                    INSERT INTO app_settings (key, value, updated_at)
+                    VALUES ('last_bcv', %s, CURRENT_TIMESTAMP)
+                    ON CONFLICT (key) DO UPDATE SET value = %s, updated_at = CURRENT_TIMESTAMP
+                ''', (json.dumps(bcv_data), json.dumps(bcv_data)))
             return True
         except Exception as e:
             print(f"Error guardando ultimo BCV: {e}")
@@ -344,18 +1426,14 @@ def save_last_bcv(bcv_data):
 
 def save_last_brecha(brecha_data):
     """Guarda la ultima brecha"""
-    conn = get_db_connection()
-    if conn:
+    if get_db_pool():
         try:
-            cur = conn.cursor()
-            cur.execute('''
-                INSERT INTO app_settings (key, value, updated_at)
-                VALUES ('last_brecha', %s, CURRENT_TIMESTAMP)
-                ON CONFLICT (key) DO UPDATE SET value = %s, updated_at = CURRENT_TIMESTAMP
-            ''', (json.dumps(brecha_data), json.dumps(brecha_data)))
-            conn.commit()
-            cur.close()
-            conn.close()
+            with db_cursor() as cur:
+                cur.execute('''
+                    INSERT INTO app_settings (key, value, updated_at)
+                    VALUES ('last_brecha', %s, CURRENT_TIMESTAMP)
+                    ON CONFLICT (key) DO UPDATE SET value = %s, updated_at = CURRENT_TIMESTAMP
+                ''', (json.dumps(brecha_data), json.dumps(brecha_data)))
             return True
         except Exception as e:
             print(f"Error guardando ultima brecha: {e}")
@@ -366,68 +1444,961 @@ def save_last_brecha(brecha_data):
         json.dump(brecha_data, f)
     return True
 
+# ============== ALMACENAMIENTO POR CAMBIOS ==============
+
+# Ultimo registro guardado en price_history (no necesariamente el ultimo tick)
+_last_stored_entry = None
+
+def datetime_to_epoch(dt):
+    """Segundos epoch de un datetime UTC sin timezone"""
+    return int(dt.replace(tzinfo=timezone.utc).timestamp())
+
+def should_store_entry(data):
+    """Decide si un tick se guarda en el historial segun HISTORY_STORAGE_MODE"""
+    global _last_stored_entry
+    if HISTORY_STORAGE_MODE != 'changes':
+        return True
+    if _last_stored_entry is None:
+        _last_stored_entry = load_latest_entry()
+    last = _last_stored_entry
+    if last is None or not last.get('timestamp') or not data.get('timestamp'):
+        return True
+
+    # Heartbeat: guardar aunque nada cambie para que la serie no quede sin puntos
+    if entry_datetime(data) - entry_datetime(last) >= timedelta(minutes=HISTORY_HEARTBEAT_MINUTES):
+        return True
+
+    for metric in METRICS:
+        old, new = last.get(metric), data.get(metric)
+        if (old is None) != (new is None):
+            return True
+        if old is not None and abs(new - old) > HISTORY_CHANGE_EPSILON:
+            return True
+    return False
+
+def load_entry_before(moment):
+    """Ultimo registro guardado antes de `moment`, o None"""
+    view = history_cache.view()
+    if view is not None:
+        lo, _ = history_cache.bounds(view, start=moment)
+        return history_cache.entry_at(view, lo - 1) if lo > 0 else None
+
+    if get_db_pool():
+        try:
+            with db_cursor() as cur:
+                cur.execute('''
+                    SELECT timestamp, bcv_usd, bcv_eur, usdt_avg,
+                           brecha_usdt_usd, brecha_usdt_eur, brecha_eur_usd
+                    FROM price_history
+                    WHERE timestamp < %s
+                    ORDER BY timestamp DESC
+                    LIMIT 1
+                ''', (moment,))
+                row = cur.fetchone()
+            return row_to_entry(row) if row else None
+        except Exception as e:
+            print(f"Error cargando registro anterior de PostgreSQL: {e}")
+            return None
+
+    # Fallback a JSON
+    lo = history_store.position(moment)
+    return history_store.read_rows(lo - 1, lo)[0] if lo > 0 else None
+
+def step_series_end(end=None):
+    """Hasta donde se extiende una serie escalonada: `end` o el ultimo tick conocido"""
+    latest = get_latest_snapshot()
+    latest_dt = entry_datetime(latest) if latest and latest.get('timestamp') else None
+    if end and (latest_dt is None or end < latest_dt):
+        return end
+    return latest_dt
+
+def reconstruct_step_series(history, start=None, end=None, include_start=True, include_end=True):
+    """Completa un rango de registros guardados por cambios.
+
+    Agrega al inicio el valor vigente en `start` (el ultimo registro anterior)
+    y al final el ultimo valor extendido hasta el ultimo tick, para que la
+    serie escalonada cubra todo el rango pedido.
+    """
+    if include_start and start and (not history or entry_datetime(history[0]) > start):
+        before = load_entry_before(start)
+        if before:
+            history = [{**before, "timestamp": start.isoformat() + 'Z'}] + history
+    if include_end and history:
+        series_end = step_series_end(end)
+        if series_end and series_end > entry_datetime(history[-1]):
+            history = history + [{**history[-1], "timestamp": series_end.isoformat() + 'Z'}]
+    return history
+
+def reconstruct_step_columns(timestamps, columns, start=None, end=None, include_start=True, include_end=True):
+    """reconstruct_step_series() sobre arreglos de query_history_columns()"""
+    if include_start and start and (not len(timestamps) or timestamps[0] > datetime_to_epoch_us(start)):
+        before = load_entry_before(start)
+        if before:
+            head, head_columns = entries_to_arrays([{**before, "timestamp": start.isoformat() + 'Z'}])
+            timestamps = np.concatenate([head, timestamps])
+            columns = {m: np.concatenate([head_columns[m], columns[m]]) for m in METRICS}
+    if include_end and len(timestamps):
+        series_end = step_series_end(end)
+        if series_end and datetime_to_epoch_us(series_end) > timestamps[-1]:
+            timestamps = np.append(timestamps, datetime_to_epoch_us(series_end))
+            columns = {m: np.append(columns[m], columns[m][-1]) for m in METRICS}
+    return timestamps, columns
+
+def fill_step_gaps(buckets, resolution, start=None, end=None):
+    """Completa los buckets de una serie guardada por cambios.
+
+    Cada registro vale hasta el siguiente, asi que un bucket cuyo primer
+    registro ("first_at") llega despues de su inicio arranca con el valor
+    vigente: ese valor es su open y entra en high/low. Un bucket vacio toma
+    el ultimo valor conocido como open/high/low/close/avg y count=0. La serie
+    arranca en el bucket de `start` si habia un valor vigente y termina en el
+    bucket del ultimo tick.
+    """
+    last_values = None
+    if start:
+        before = load_entry_before(start)
+        if before:
+            last_values = {m: before.get(m) for m in METRICS}
+    if not buckets and last_values is None:
+        return buckets
+
+    by_epoch = {datetime_to_epoch(parse_iso_datetime(b["timestamp"])): b for b in buckets}
+    if start and last_values is not None:
+        first_epoch = datetime_to_epoch(start) // resolution * resolution
+    else:
+        first_epoch = min(by_epoch)
+    series_end = step_series_end(end)
+    last_epoch = max(by_epoch) if by_epoch else first_epoch
+    if series_end:
+        last_epoch = max(last_epoch, datetime_to_epoch(series_end) // resolution * resolution)
+
+    # Solo se emiten los MAX_AGGREGATE_BUCKETS mas recientes, pero los anteriores
+    # aportan el valor vigente al inicio de la ventana
+    window_start = max(first_epoch, last_epoch - (MAX_AGGREGATE_BUCKETS - 1) * resolution)
+    for epoch in sorted(by_epoch):
+        if epoch >= window_start:
+            break
+        last_values = _bucket_closes(by_epoch[epoch], last_values)
+
+    result = []
+    for epoch in range(window_start, last_epoch + resolution, resolution):
+        bucket = by_epoch.get(epoch)
+        if bucket:
+            first_at = bucket.pop("first_at", epoch)
+            if last_values and first_at > epoch:
+                _seed_bucket(bucket, last_values)
+            result.append(bucket)
+            last_values = _bucket_closes(bucket, last_values)
+        elif last_values:
+            result.append({
+                "timestamp": datetime.utcfromtimestamp(epoch).isoformat() + 'Z',
+                "count": 0,
+                **{
+                    m: {"open": v, "high": v, "low": v, "close": v, "avg": v}
+                    if v is not None else _empty_bucket_metric()
+                    for m, v in last_values.items()
+                }
+            })
+    return result
+
+def _seed_bucket(bucket, carried):
+    """Agrega al bucket el valor que venia del bucket anterior"""
+    for m, v in carried.items():
+        metric = bucket[m]
+        if v is None or metric["open"] is None:
+            continue
+        metric["open"] = v
+        metric["high"] = max(metric["high"], v)
+        metric["low"] = min(metric["low"], v)
+
+def _bucket_closes(bucket, previous=None):
+    closes = dict(previous or {})
+    for m in METRICS:
+        if bucket[m]["close"] is not None:
+            closes[m] = bucket[m]["close"]
+        closes.setdefault(m, None)
+    return closes
+
+# ============== AGREGACION DEL HISTORIAL ==============
+
+# Resoluciones disponibles para /api/history/aggregate, en segundos
+AGGREGATE_RESOLUTIONS = {
+    '1m': 60,
+    '5m': 300,
+    '15m': 900,
+    '1h': 3600,
+    '4h': 14400,
+    '1d': 86400,
+    '1w': 604800,
+}
+# Maximo de buckets por respuesta, sin importar el rango pedido
+MAX_AGGREGATE_BUCKETS = 1000
+
+def choose_resolution(requested, start=None, end=None):
+    """Elige la resolucion mas fina (a partir de la pedida) que no exceda MAX_AGGREGATE_BUCKETS"""
+    names = list(AGGREGATE_RESOLUTIONS)
+    index = names.index(requested) if requested else 0
+    if start:
+        span = ((end or datetime.utcnow()) - start).total_seconds()
+        while index < len(names) - 1 and span / AGGREGATE_RESOLUTIONS[names[index]] > MAX_AGGREGATE_BUCKETS:
+            index += 1
+    return names[index]
+
+def _empty_bucket_metric():
+    return {"open": None, "high": None, "low": None, "close": None, "avg": None}
+
+def aggregate_arrays(timestamps, columns, resolution, with_first=False):
+    """Agrupa series ordenadas en buckets OHLC usando NumPy.
+
+    timestamps es un arreglo int64 de segundos epoch y columns un dict
+    metrica -> arreglo float con NaN donde no hay dato. Con `with_first` cada
+    bucket lleva en "first_at" el epoch de su primer registro (lo usa
+    fill_step_gaps()).
+    """
+    if len(timestamps) == 0:
+        return []
+    buckets = (timestamps // resolution) * resolution
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+
+    # Solo los buckets mas recientes
+    if len(starts) > MAX_AGGREGATE_BUCKETS:
+        cut = starts[-MAX_AGGREGATE_BUCKETS]
+        buckets = buckets[cut:]
+        timestamps = timestamps[cut:]
+        columns = {metric: values[cut:] for metric, values in columns.items()}
+        starts = starts[-MAX_AGGREGATE_BUCKETS:] - cut
+
+    size = len(buckets)
+    counts = np.diff(np.r_[starts, size])
+    result = [
+        {"timestamp": datetime.utcfromtimestamp(int(bucket)).isoformat() + 'Z', "count": int(count)}
+        for bucket, count in zip(buckets[starts], counts)
+    ]
+    if with_first:
+        for bucket, first_at in zip(result, timestamps[starts]):
+            bucket["first_at"] = int(first_at)
+
+    positions = np.arange(size)
+    for metric, values in columns.items():
+        valid = ~np.isnan(values)
+        first = np.minimum.reduceat(np.where(valid, positions, size), starts)
+        last = np.maximum.reduceat(np.where(valid, positions, -1), starts)
+        high = np.fmax.reduceat(values, starts)
+        low = np.fmin.reduceat(values, starts)
+        samples = np.add.reduceat(valid.astype(np.int64), starts)
+        totals = np.add.reduceat(np.where(valid, values, 0.0), starts)
+
+        for i, bucket in enumerate(result):
+            if samples[i] == 0:
+                bucket[metric] = _empty_bucket_metric()
+                continue
+            bucket[metric] = {
+                "open": float(values[first[i]]),
+                "high": float(high[i]),
+                "low": float(low[i]),
+                "close": float(values[last[i]]),
+                "avg": round(float(totals[i] / samples[i]), 2),
+            }
+    return result
+
+def _bucket_metric_columns(time_column, first, high, low, last, avg):
+    """Columnas SQL open/high/low/close/avg de cada metrica para un GROUP BY por bucket"""
+    return ',\n'.join(
+        f"""(array_agg({first.format(m=m)} ORDER BY {time_column}) FILTER (WHERE {first.format(m=m)} IS NOT NULL))[1],
+            MAX({high.format(m=m)}), MIN({low.format(m=m)}),
+            (array_agg({last.format(m=m)} ORDER BY {time_column} DESC) FILTER (WHERE {last.format(m=m)} IS NOT NULL))[1],
+            {avg.format(m=m)}"""
+        for m in METRICS
+    )
+
+def _aggregate_source(resolution, start):
+    """Tabla, columnas y limite inferior para agregar a `resolution` segundos.
+
+    Usa el rollup mas grueso cuya resolucion divide a la pedida; si ninguno
+    sirve, agrega directamente sobre price_history.
+    """
+    for rollup_resolution in sorted(ROLLUP_TABLES, reverse=True):
+        if rollup_resolution <= resolution and resolution % rollup_resolution == 0:
+            columns = _bucket_metric_columns(
+                'bucket', '{m}_first', '{m}_max', '{m}_min', '{m}_last',
+                'SUM({m}_sum) / NULLIF(SUM({m}_count), 0)'
+            )
+            if start:
+                # Incluir el bucket del rollup que contiene a start
+                epoch = datetime_to_epoch(start)
+                start = datetime.utcfromtimestamp(epoch - epoch % rollup_resolution)
+            return ROLLUP_TABLES[rollup_resolution], 'bucket', 'SUM(samples)', columns, start
+
+    columns = _bucket_metric_columns('timestamp', '{m}', '{m}', '{m}', '{m}', 'AVG({m})')
+    return 'price_history', 'timestamp', 'COUNT(*)', columns, start
+
+def query_aggregated_history(resolution, start=None, end=None):
+    """Historial agrupado en buckets OHLC de `resolution` segundos"""
+    if HISTORY_STORAGE_MODE == 'changes':
+        buckets = _query_aggregated_buckets(resolution, start, end, with_first=True)
+        return fill_step_gaps(buckets, resolution, start=start, end=end)
+    return _query_aggregated_buckets(resolution, start, end)
+
+def _query_aggregated_buckets(resolution, start=None, end=None, with_first=False):
+    view = history_cache.view()
+    if view is not None:
+        lo, hi = history_cache.bounds(view, start, end)
+        timestamps, columns = view
+        return aggregate_arrays(
+            timestamps[lo:hi] // 1_000_000,
+            {metric: values[lo:hi] for metric, values in columns.items()},
+            resolution,
+            with_first=with_first
+        )
+
+    if get_db_pool():
+        try:
+            table, time_column, count_column, metric_columns, start = _aggregate_source(resolution, start)
+            conditions = []
+            params = [resolution, resolution]
+            if start:
+                conditions.append(f'{time_column} >= %s')
+                params.append(start)
+            if end:
+                conditions.append(f'{time_column} <= %s')
+                params.append(end)
+            where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+            params.append(MAX_AGGREGATE_BUCKETS)
+
+            with db_cursor() as cur:
+                cur.execute(f'''
+                    SELECT to_timestamp(floor(extract(epoch FROM {time_column}) / %s) * %s) AS period,
+                           {count_column},
+                           floor(extract(epoch FROM MIN({time_column}))),
+                           {metric_columns}
+                    FROM {table}
+                    {where}
+                    GROUP BY period
+                    ORDER BY period DESC
+                    LIMIT %s
+                ''', params)
+                rows = cur.fetchall()
+
+            result = []
+            for row in reversed(rows):
+                bucket = {"timestamp": format_timestamp(row[0]), "count": int(row[1])}
+                if with_first:
+                    bucket["first_at"] = int(row[2])
+                for i, metric in enumerate(METRICS):
+                    open_, high, low, close, avg = row[3 + i * 5:8 + i * 5]
+                    if avg is None:
+                        bucket[metric] = _empty_bucket_metric()
+                        continue
+                    bucket[metric] = {
+                        "open": float(open_),
+                        "high": float(high),
+                        "low": float(low),
+                        "close": float(close),
+                        "avg": round(float(avg), 2),
+                    }
+                result.append(bucket)
+            return result
+        except Exception as e:
+            print(f"Error agregando historial de PostgreSQL: {e}")
+            return []
+
+    # Fallback a JSON: agregacion vectorizada sobre el rango
+    lo, hi = history_store_bounds(start, end)
+    entries = history_store.read_rows(lo, hi)
+    timestamps = np.array([datetime_to_epoch(entry_datetime(e)) for e in entries], dtype=np.int64)
+    columns = {
+        metric: np.array([e.get(metric) if e.get(metric) is not None else np.nan for e in entries], dtype=np.float64)
+        for metric in METRICS
+    }
+    return aggregate_arrays(timestamps, columns, resolution, with_first=with_first)
+
+# ============== ROLLUPS ==============
+
+# Tablas de rollup por resolucion en segundos. Se actualizan en cada tick
+# desde save_history_entry() y se llenan con `flask --app app backfill-rollups`.
+ROLLUP_TABLES = {
+    3600: 'price_rollup_hourly',
+    86400: 'price_rollup_daily',
+}
+
+def rollup_table_ddl(table):
+    """CREATE TABLE de una tabla de rollup: first/last/min/max/sum/count por metrica"""
+    metric_columns = ',\n'.join(
+        f"""{m}_first DECIMAL(10,2),
+                {m}_last DECIMAL(10,2),
+                {m}_min DECIMAL(10,2),
+                {m}_max DECIMAL(10,2),
+                {m}_sum DECIMAL(18,2),
+                {m}_count INTEGER NOT NULL DEFAULT 0"""
+        for m in METRICS
+    )
+    return f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                bucket TIMESTAMPTZ PRIMARY KEY,
+                samples INTEGER NOT NULL DEFAULT 0,
+                {metric_columns}
+            )
+        '''
+
+def _rollup_upsert_sql(table, resolution):
+    columns = ', '.join(
+        f'{m}_first, {m}_last, {m}_min, {m}_max, {m}_sum, {m}_count' for m in METRICS
+    )
+    values = ', '.join(
+        f'%({m})s, %({m})s, %({m})s, %({m})s, %({m})s, (%({m})s::numeric IS NOT NULL)::int'
+        for m in METRICS
+    )
+    updates = ',\n'.join(
+        f"""{m}_first = COALESCE(t.{m}_first, EXCLUDED.{m}_first),
+                {m}_last = COALESCE(EXCLUDED.{m}_last, t.{m}_last),
+                {m}_min = LEAST(t.{m}_min, EXCLUDED.{m}_min),
+                {m}_max = GREATEST(t.{m}_max, EXCLUDED.{m}_max),
+                {m}_sum = COALESCE(t.{m}_sum, 0) + COALESCE(EXCLUDED.{m}_sum, 0),
+                {m}_count = t.{m}_count + EXCLUDED.{m}_count"""
+        for m in METRICS
+    )
+    return f'''
+        INSERT INTO {table} AS t (bucket, samples, {columns})
+        VALUES (
+            to_timestamp(floor(extract(epoch FROM %(timestamp)s::timestamptz) / {resolution}) * {resolution}),
+            1, {values}
+        )
+        ON CONFLICT (bucket) DO UPDATE SET
+            samples = t.samples + 1,
+            {updates}
+    '''
+
+def update_rollups(cur, data):
+    """Suma un tick a los rollups de su hora y su dia sin recalcular nada"""
+    params = {m: data.get(m) for m in METRICS}
+    params['timestamp'] = data.get('timestamp', '').replace('Z', '')
+    for resolution, table in ROLLUP_TABLES.items():
+        cur.execute(_rollup_upsert_sql(table, resolution), params)
+
+def backfill_rollups():
+    """Reconstruye los rollups a partir de todo price_history"""
+    columns = ', '.join(
+        f'{m}_first, {m}_last, {m}_min, {m}_max, {m}_sum, {m}_count' for m in METRICS
+    )
+    aggregates = ',\n'.join(
+        f"""(array_agg({m} ORDER BY timestamp) FILTER (WHERE {m} IS NOT NULL))[1],
+                   (array_agg({m} ORDER BY timestamp DESC) FILTER (WHERE {m} IS NOT NULL))[1],
+                   MIN({m}), MAX({m}), SUM({m}), COUNT({m})"""
+        for m in METRICS
+    )
+    updates = ', '.join(
+        f'{column} = EXCLUDED.{column}'
+        for m in METRICS
+        for column in (f'{m}_first', f'{m}_last', f'{m}_min', f'{m}_max', f'{m}_sum', f'{m}_count')
+    )
+    counts = {}
+    with db_cursor() as cur:
+        for resolution, table in ROLLUP_TABLES.items():
+            cur.execute(f'''
+                INSERT INTO {table} (bucket, samples, {columns})
+                SELECT to_timestamp(floor(extract(epoch FROM timestamp) / {resolution}) * {resolution}) AS bucket,
+                       COUNT(*),
+                       {aggregates}
+                FROM price_history
+                GROUP BY bucket
+                ON CONFLICT (bucket) DO UPDATE SET samples = EXCLUDED.samples, {updates}
+            ''')
+            counts[table] = cur.rowcount
+    return counts
+
+# ============== CACHE DEL ULTIMO SNAPSHOT ==============
+
+# Ultimo snapshot publicado por update_prices_job(). Se lee de la base de datos
+# solo en arranque en frio; despues se mantiene en memoria.
+_latest_snapshot = None
+_latest_snapshot_lock = threading.Lock()
+
+def set_latest_snapshot(data):
+    """Publica un nuevo snapshot en el cache del proceso"""
+    global _latest_snapshot
+    with _latest_snapshot_lock:
+        _latest_snapshot = data
+    response_cache.invalidate()
+    snapshot_stream.push(data)
+
+def get_latest_snapshot():
+    """Retorna el ultimo snapshot, cargandolo de la base de datos si el cache esta vacio"""
+    global _latest_snapshot
+    snapshot = _latest_snapshot
+    if snapshot is not None:
+        return snapshot
+    with _latest_snapshot_lock:
+        if _latest_snapshot is None:
+            _latest_snapshot = load_latest_entry()
+        return _latest_snapshot
+
+# ============== EVENTOS DE SNAPSHOTS ==============
+
+class SnapshotEventBus:
+    """Publica cada snapshot nuevo a los suscriptores del proceso.
+
+    Los callbacks corren en el thread que publica (el scheduler); un callback
+    que falla no impide que se ejecuten los demas.
+    """
+
+    def __init__(self):
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        with self._lock:
+            if callback not in self._subscribers:
+                self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def publish(self, snapshot):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(snapshot)
+            except Exception as e:
+                print(f"Error procesando snapshot en {getattr(callback, '__name__', callback)}: {e}")
+
+snapshot_events = SnapshotEventBus()
+
+# ============== STREAM DE SNAPSHOTS (SSE) ==============
+
+def snapshot_event_id(snapshot):
+    """Id de evento SSE: milisegundos epoch del timestamp del snapshot"""
+    return datetime_to_epoch_us(entry_datetime(snapshot)) // 1000
+
+class SnapshotStream:
+    """Difunde los snapshots a las conexiones de /api/stream.
+
+    Guarda los ultimos `size` eventos ya serializados en un ring buffer, asi
+    un cliente que reconecta con Last-Event-ID recibe lo que se perdio. Todas
+    las conexiones esperan sobre una sola Condition; cada snapshot se
+    serializa una vez, no una vez por cliente.
+    """
+
+    def __init__(self, size=SSE_BUFFER_SIZE):
+        self._events = deque(maxlen=size)
+        self._condition = threading.Condition()
+
+    def push(self, snapshot):
+        if not snapshot or not snapshot.get('timestamp'):
+            return
+        try:
+            event_id = snapshot_event_id(snapshot)
+        except Exception:
+            return
+        with self._condition:
+            if self._events and event_id <= self._events[-1][0]:
+                return
+            self._events.append((event_id, json.dumps(snapshot)))
+            self._condition.notify_all()
+
+    def latest(self):
+        with self._condition:
+            return self._events[-1] if self._events else None
+
+    def _after(self, last_id):
+        return [event for event in self._events if event[0] > last_id]
+
+    def wait(self, last_id, timeout):
+        """Eventos posteriores a `last_id`, esperando hasta `timeout` segundos si no hay"""
+        with self._condition:
+            events = self._after(last_id)
+            if not events:
+                self._condition.wait(timeout)
+                events = self._after(last_id)
+            return events
+
+snapshot_stream = SnapshotStream()
+
+# ============== CANAL DE SNAPSHOTS ENTRE PROCESOS ==============
+
+class SnapshotChannel:
+    """Lleva cada snapshot del proceso lider a los procesos que solo sirven HTTP.
+
+    Con PostgreSQL usa NOTIFY/LISTEN: el lider publica el snapshot como
+    payload y cada seguidor lo escucha en un thread con su propia conexion.
+    Sin PostgreSQL el lider reemplaza SNAPSHOT_FILE de forma atomica y los
+    seguidores lo releen cuando cambia su mtime.
+    """
+
+    def __init__(self, channel=SNAPSHOT_CHANNEL, path=SNAPSHOT_FILE, poll_seconds=SNAPSHOT_POLL_SECONDS):
+        self.channel = channel
+        self.path = path
+        self.poll_seconds = poll_seconds
+        self._listener = None
+
+    def publish(self, snapshot):
+        payload = json.dumps(snapshot)
+        if get_db_pool():
+            try:
+                with db_cursor() as cur:
+                    cur.execute('SELECT pg_notify(%s, %s)', (self.channel, payload))
+            except Exception as e:
+                print(f"Error publicando snapshot: {e}")
+            return
+
+        # Fallback a archivo
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(payload)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Error publicando snapshot en {self.path}: {e}")
+
+    def start_listener(self, callback):
+        """Llama a callback(snapshot) con cada snapshot publicado; callback(None) tras reconectar"""
+        if self._listener is not None:
+            return
+        target = self._listen_pg if DATABASE_URL else self._poll_file
+        self._listener = threading.Thread(target=target, args=(callback,), daemon=True)
+        self._listener.start()
+
+    def _listen_pg(self, callback):
+        import psycopg2
+        import select
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(
+                    DATABASE_URL.replace('postgres://', 'postgresql://'),
+                    connect_timeout=10, keepalives=1, keepalives_idle=30,
+                    keepalives_interval=10, keepalives_count=3
+                )
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f'LISTEN {self.channel}')
+                # Lo publicado mientras no escuchabamos se recupera del historial
+                callback(None)
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        cur.execute('SELECT 1')
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        callback(json.loads(notify.payload))
+            except Exception as e:
+                print(f"Canal de snapshots desconectado: {e}")
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                time.sleep(5)
+
+    def _poll_file(self, callback):
+        last_mtime = None
+        while True:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime is not None and mtime != last_mtime:
+                last_mtime = mtime
+                try:
+                    with open(self.path, 'r') as f:
+                        callback(json.load(f))
+                except (OSError, ValueError) as e:
+                    print(f"Error leyendo {self.path}: {e}")
+            time.sleep(self.poll_seconds)
+
+snapshot_channel = SnapshotChannel()
+
+# ============== CLIENTES DE FUENTES EXTERNAS ==============
+
+class CircuitOpenError(Exception):
+    """La fuente tiene el circuito abierto y no se consulta"""
+
+class CircuitBreaker:
+    """Deja de consultar una fuente despues de varios fallos seguidos.
+
+    Tras `failure_threshold` fallos el circuito se abre; pasados `reset_timeout`
+    segundos deja pasar una sola prueba. Si la prueba sale bien se cierra, si
+    no vuelve a abrirse.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=120):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.probing or time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+class UpstreamClient:
+    """Cliente HTTP de una fuente externa.
+
+    Mantiene una sesion keep-alive propia, reintenta errores de red y
+    respuestas 5xx/429 con backoff exponencial con jitter, corta las
+    consultas con un circuit breaker y lleva contadores de latencia y errores.
+    """
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, name, retries=2, backoff=0.5, backoff_max=4.0,
+                 failure_threshold=5, reset_timeout=120, pool_maxsize=4):
+        self.name = name
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "errors": 0,
+            "retries": 0,
+            "rejected": 0,
+            "latency_total_ms": 0.0,
+            "last_latency_ms": None,
+            "last_error": None,
+        }
+
+    def _count(self, **changes):
+        with self._lock:
+            for key, value in changes.items():
+                if key in ("last_latency_ms", "last_error"):
+                    self._stats[key] = value
+                else:
+                    self._stats[key] += value
+
+    def request(self, method, url, deadline=None, timeout=10, **kwargs):
+        """Hace la peticion con reintentos. `deadline` es un time.monotonic() limite"""
+        if not self.breaker.allow():
+            self._count(rejected=1)
+            raise CircuitOpenError(f"Circuito abierto para {self.name}")
+
+        last_error = None
+        for attempt in range(self.retries + 1):
+            attempt_timeout = timeout
+            if deadline is not None:
+                attempt_timeout = min(timeout, deadline - time.monotonic())
+                if attempt_timeout <= 0:
+                    break
+            if attempt > 0:
+                self._count(retries=1)
+
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, timeout=attempt_timeout, **kwargs)
+                latency_ms = (time.monotonic() - started) * 1000
+                self._count(requests=1, latency_total_ms=latency_ms, last_latency_ms=round(latency_ms, 1))
+                if response.status_code not in self.RETRY_STATUS:
+                    self.breaker.record_success()
+                    return response
+                last_error = requests.HTTPError(f"HTTP {response.status_code}", response=response)
+            except requests.RequestException as e:
+                self._count(requests=1)
+                last_error = e
+            self._count(errors=1, last_error=str(last_error))
+
+            if attempt == self.retries:
+                break
+            delay = min(self.backoff_max, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                break
+            time.sleep(delay)
+
+        self.breaker.record_failure()
+        raise last_error or requests.Timeout(f"Sin tiempo para consultar {self.name}")
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        total_ms = stats.pop("latency_total_ms")
+        ok = stats["requests"] - stats["errors"]
+        stats["avg_latency_ms"] = round(total_ms / stats["requests"], 1) if stats["requests"] else None
+        stats["success_rate"] = round(ok / stats["requests"], 3) if stats["requests"] else None
+        stats["circuit"] = self.breaker.state
+        return stats
+
+bcv_client = UpstreamClient('bcv')
+binance_client = UpstreamClient('binance')
+
+def upstream_stats():
+    """Contadores de latencia y errores por fuente"""
+    return {client.name: client.stats() for client in (bcv_client, binance_client)}
+
 # ============== FUNCIONES DE PRECIOS ==============
 
-def get_bcv_prices():
+# Las tres consultas de un tick (BCV, Binance BUY y SELL) corren en paralelo
+_upstream_executor = ThreadPoolExecutor(max_workers=6, thread_name_prefix='upstream')
+
+# Tiempo maximo de un tick; las fuentes que no respondan a tiempo quedan en None
+FETCH_DEADLINE_SECONDS = int(os.environ.get('FETCH_DEADLINE_SECONDS', 20))
+
+# Ultima respuesta valida del BCV, para consultas condicionales (ETag/Last-Modified)
+_bcv_cache = {"etag": None, "last_modified": None, "digest": None, "prices": None}
+_bcv_cache_lock = threading.Lock()
+
+# Camino rapido: el valor esta en el primer <strong> despues de id="dolar" / id="euro"
+_BCV_RATE_PATTERNS = {
+    currency: re.compile(
+        r'id\s*=\s*["\']%s["\'].{0,2000}?<strong[^>]*>\s*([\d.,]+)\s*</strong>' % section_id,
+        re.S
+    )
+    for currency, section_id in (('usd', 'dolar'), ('eur', 'euro'))
+}
+
+def _parse_bcv_number(text):
+    return float(text.strip().replace('.', '').replace(',', '.'))
+
+def parse_bcv_prices_regex(html):
+    """Extrae las tasas con una expresion regular anclada a los bloques #dolar y #euro"""
+    prices = {'usd': None, 'eur': None}
+    for currency, pattern in _BCV_RATE_PATTERNS.items():
+        match = pattern.search(html)
+        if match:
+            try:
+                prices[currency] = _parse_bcv_number(match.group(1))
+            except ValueError:
+                pass
+    return prices
+
+def parse_bcv_prices_soup(html, strainer=True):
+    """Extrae las tasas con BeautifulSoup, limitando el parseo a #dolar y #euro"""
+    parse_only = SoupStrainer('div', id=['dolar', 'euro']) if strainer else None
+    soup = BeautifulSoup(html, 'html.parser', parse_only=parse_only)
+    prices = {'usd': None, 'eur': None}
+
+    dolar_section = soup.find('div', {'id': 'dolar'})
+    if dolar_section:
+        strong = dolar_section.find('strong')
+        if strong:
+            prices['usd'] = _parse_bcv_number(strong.get_text(strip=True))
+
+    euro_section = soup.find('div', {'id': 'euro'})
+    if euro_section:
+        strong = euro_section.find('strong')
+        if strong:
+            prices['eur'] = _parse_bcv_number(strong.get_text(strip=True))
+
+    return prices
+
+def parse_bcv_prices(html):
+    """Usa la expresion regular y recurre a BeautifulSoup si no encuentra ambas tasas"""
+    prices = parse_bcv_prices_regex(html)
+    if prices['usd'] is None or prices['eur'] is None:
+        prices = parse_bcv_prices_soup(html)
+    return prices
+
+def get_bcv_prices(deadline=None):
     try:
-        response = requests.get('https://www.bcv.org.ve/', verify=False, timeout=15)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        prices = {'usd': None, 'eur': None}
-
-        dolar_section = soup.find('div', {'id': 'dolar'})
-        if dolar_section:
-            strong = dolar_section.find('strong')
-            if strong:
-                valor = strong.get_text(strip=True).replace('.', '').replace(',', '.')
-                prices['usd'] = float(valor)
-
-        euro_section = soup.find('div', {'id': 'euro'})
-        if euro_section:
-            strong = euro_section.find('strong')
-            if strong:
-                valor = strong.get_text(strip=True).replace('.', '').replace(',', '.')
-                prices['eur'] = float(valor)
+        with _bcv_cache_lock:
+            cached = dict(_bcv_cache)
+
+        headers = {}
+        if cached["prices"]:
+            if cached["etag"]:
+                headers['If-None-Match'] = cached["etag"]
+            if cached["last_modified"]:
+                headers['If-Modified-Since'] = cached["last_modified"]
+
+        response = bcv_client.get(
+            BCV_URL, verify=False, timeout=15, deadline=deadline, headers=headers
+        )
 
+        # Pagina sin cambios: no hace falta parsear
+        if response.status_code == 304 and cached["prices"]:
+            return dict(cached["prices"])
+        digest = hashlib.sha1(response.content).hexdigest()
+        if digest == cached["digest"] and cached["prices"]:
+            return dict(cached["prices"])
+
+        prices = parse_bcv_prices(response.text)
+        if prices['usd'] is not None and prices['eur'] is not None:
+            with _bcv_cache_lock:
+                _bcv_cache.update({
+                    "etag": response.headers.get('ETag'),
+                    "last_modified": response.headers.get('Last-Modified'),
+                    "digest": digest,
+                    "prices": dict(prices),
+                })
         return prices
     except Exception as e:
         print(f"Error obteniendo BCV: {e}")
         return {'usd': None, 'eur': None}
 
-def get_binance_p2p_prices():
-    url = "https://p2p.binance.com/bapi/c2c/v2/friendly/c2c/adv/search"
+def get_binance_p2p_ads(trade_type, deadline=None):
+    """Anuncios de Binance P2P para un lado del mercado (BUY o SELL)"""
+    url = BINANCE_P2P_URL
     headers = {
         "Content-Type": "application/json",
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
     }
-    results = {"buy": [], "sell": []}
-
-    for trade_type in ["BUY", "SELL"]:
-        payload = {
-            "fiat": "VES",
-            "page": 1,
-            "rows": 10,
-            "tradeType": trade_type,
-            "asset": "USDT",
-            "countries": [],
-            "proMerchantAds": False,
-            "publisherType": "merchant",
-            "payTypes": []
-        }
-        try:
-            response = requests.post(url, json=payload, headers=headers, timeout=10)
-            data = response.json()
-            for ad in data.get("data", [])[1:]:
-                adv = ad.get("adv", {})
-                price = float(adv.get("price", 0))
-                available = float(adv.get("surplusAmount", 0))
-                if available >= 50 and 300 < price < 1000:
-                    results[trade_type.lower()].append({
-                        "price": price,
-                        "available": available
-                    })
-        except Exception as e:
-            print(f"Error obteniendo Binance {trade_type}: {e}")
-    return results
+    payload = {
+        "fiat": "VES",
+        "page": 1,
+        "rows": 10,
+        "tradeType": trade_type,
+        "asset": "USDT",
+        "countries": [],
+        "proMerchantAds": False,
+        "publisherType": "merchant",
+        "payTypes": []
+    }
+    ads = []
+    try:
+        response = binance_client.post(url, json=payload, headers=headers, timeout=10, deadline=deadline)
+        data = response.json()
+        for ad in data.get("data", [])[1:]:
+            adv = ad.get("adv", {})
+            price = float(adv.get("price", 0))
+            available = float(adv.get("surplusAmount", 0))
+            if available >= 50 and 300 < price < 1000:
+                ads.append({
+                    "price": price,
+                    "available": available
+                })
+    except Exception as e:
+        print(f"Error obteniendo Binance {trade_type}: {e}")
+    return ads
 
 def calculate_weighted_average(ads):
     if not ads:
@@ -438,11 +2409,25 @@ def calculate_weighted_average(ads):
     return sum(ad["price"] * ad["available"] for ad in ads) / total_weight
 
 def fetch_and_calculate_prices():
-    bcv_prices = get_bcv_prices()
-    binance_data = get_binance_p2p_prices()
+    # Consultar las tres fuentes a la vez; si alguna no responde antes del
+    # plazo, el tick sale igual con esos valores en None
+    deadline = time.monotonic() + FETCH_DEADLINE_SECONDS
+    futures = {
+        "bcv": _upstream_executor.submit(get_bcv_prices, deadline),
+        "buy": _upstream_executor.submit(get_binance_p2p_ads, "BUY", deadline),
+        "sell": _upstream_executor.submit(get_binance_p2p_ads, "SELL", deadline),
+    }
+    done, pending = wait(futures.values(), timeout=FETCH_DEADLINE_SECONDS)
+    for name, future in futures.items():
+        if future in pending:
+            print(f"Fuente {name} no respondio en {FETCH_DEADLINE_SECONDS}s, se omite en este tick")
 
-    buy_avg = calculate_weighted_average(binance_data["buy"])
-    sell_avg = calculate_weighted_average(binance_data["sell"])
+    bcv_prices = futures["bcv"].result() if futures["bcv"] in done else {'usd': None, 'eur': None}
+    buy_ads = futures["buy"].result() if futures["buy"] in done else []
+    sell_ads = futures["sell"].result() if futures["sell"] in done else []
+
+    buy_avg = calculate_weighted_average(buy_ads)
+    sell_avg = calculate_weighted_average(sell_ads)
     usdt_avg = (buy_avg + sell_avg) / 2 if buy_avg and sell_avg else None
 
     brecha_usdt_usd = None
@@ -470,14 +2455,166 @@ def fetch_and_calculate_prices():
     }
 
 def get_latest_data():
-    history = load_history()
-    if history:
-        return history[-1]
+    snapshot = get_latest_snapshot()
+    if snapshot:
+        return snapshot
     return fetch_and_calculate_prices()
 
+# ============== ENVIO MASIVO DE TELEGRAM ==============
+
+class TokenBucket:
+    """Token bucket para asyncio.
+
+    `rate` es el maximo de tokens en cualquier ventana de un segundo. El
+    bucket arranca lleno, asi que se recarga a `rate - capacity` tokens por
+    segundo: la rafaga inicial mas lo recargado en la ventana no pasa de
+    `rate`.
+
+    acquire() reserva un token y duerme lo que falte para que exista; el
+    saldo puede quedar negativo (tokens ya prometidos a otras corrutinas), asi
+    que no hace falta un lock mientras todo corra en el mismo event loop.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        # Con limites muy bajos la rafaga se achica para que quede recarga
+        self.capacity = min(capacity, rate / 2)
+        self.refill_rate = rate - self.capacity
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_rate)
+        self.updated = now
+
+    async def acquire(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.refill_rate)
+
+    def pause(self, seconds):
+        """Vacia el bucket para que nadie envie durante `seconds` (flood control)"""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, -seconds * self.refill_rate)
+
+class TelegramBroadcaster:
+    """Envia un mismo mensaje a muchos chats con concurrencia acotada.
+
+    Respeta un limite global (TokenBucket) y un intervalo minimo por chat, que
+    se mantiene entre difusiones. Un RetryAfter de Telegram pausa el bucket
+    global y devuelve el chat a la cola. Los chats que bloquearon el bot o ya
+    no existen se pasan juntos a `prune` al final de la difusion; cualquier
+    otro error cuenta como fallido.
+    """
+
+    def __init__(self, rate=TELEGRAM_GLOBAL_RATE, chat_interval=TELEGRAM_CHAT_INTERVAL,
+                 concurrency=TELEGRAM_BROADCAST_CONCURRENCY, max_retries=TELEGRAM_MAX_RETRIES,
+                 prune=None):
+        self.prune = prune
+        self.bucket = TokenBucket(rate)
+        self.chat_interval = chat_interval
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._chat_next_send = {}
+
+    async def _wait_for_chat(self, chat_id):
+        now = time.monotonic()
+        next_send = self._chat_next_send.get(chat_id, now)
+        self._chat_next_send[chat_id] = max(now, next_send) + self.chat_interval
+        if next_send > now:
+            await asyncio.sleep(next_send - now)
+
+    def _forget_idle_chats(self):
+        now = time.monotonic()
+        self._chat_next_send = {c: t for c, t in self._chat_next_send.items() if t > now}
+
+    async def broadcast(self, bot, chat_ids, message, label='Mensaje', **send_kwargs):
+        """Envia `message` a `chat_ids` y devuelve estadisticas de entrega"""
+        messages = ((chat_id, message) for chat_id in dict.fromkeys(chat_ids))
+        return await self.deliver(bot, messages, label=label, **send_kwargs)
+
+    async def deliver(self, bot, messages, label='Mensaje', **send_kwargs):
+        """Envia pares (chat_id, texto) con los mismos limites que broadcast()"""
+        try:
+            from telegram.error import RetryAfter, Forbidden, BadRequest
+        except ImportError:
+            RetryAfter = Forbidden = BadRequest = ()
+
+        stats = {"total": 0, "sent": 0, "failed": 0, "retried": 0, "rate_limited": 0, "dead": 0, "pruned": 0}
+        dead_chats = []
+        started = time.monotonic()
+        queue = asyncio.Queue()
+        for chat_id, text in messages:
+            queue.put_nowait((chat_id, text, 0))
+            stats["total"] += 1
+        if not stats["total"]:
+            return stats
+
+        send_kwargs.setdefault('parse_mode', 'Markdown')
+
+        async def worker():
+            while True:
+                chat_id, text, attempt = await queue.get()
+                try:
+                    await self._wait_for_chat(chat_id)
+                    await self.bucket.acquire()
+                    await bot.send_message(chat_id=chat_id, text=text, **send_kwargs)
+                    stats["sent"] += 1
+                except RetryAfter as e:
+                    retry_after = e.retry_after
+                    if isinstance(retry_after, timedelta):
+                        retry_after = retry_after.total_seconds()
+                    stats["rate_limited"] += 1
+                    self.bucket.pause(retry_after)
+                    if attempt < self.max_retries:
+                        stats["retried"] += 1
+                        queue.put_nowait((chat_id, text, attempt + 1))
+                    else:
+                        stats["failed"] += 1
+                        print(f"Error enviando mensaje a {chat_id}: {e}")
+                except (Forbidden, BadRequest) as e:
+                    if isinstance(e, Forbidden) or is_dead_chat_error(e):
+                        stats["dead"] += 1
+                        dead_chats.append(chat_id)
+                    else:
+                        stats["failed"] += 1
+                        print(f"Error enviando mensaje a {chat_id}: {e}")
+                except Exception as e:
+                    stats["failed"] += 1
+                    print(f"Error enviando mensaje a {chat_id}: {e}")
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(self.concurrency, stats["total"]))]
+        try:
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self._forget_idle_chats()
+
+        if dead_chats and self.prune:
+            stats["pruned"] = await asyncio.to_thread(self.prune, dead_chats)
+
+        stats["elapsed_seconds"] = round(time.monotonic() - started, 2)
+        print(f"[{datetime.now()}] {label}: {stats['sent']}/{stats['total']} enviados, "
+              f"{stats['failed']} fallidos, {stats['dead']} chats muertos, {stats['retried']} reintentos "
+              f"en {stats['elapsed_seconds']}s")
+        return stats
+
+def is_dead_chat_error(error):
+    """BadRequest que indica que el chat ya no existe (no tiene sentido reintentar)"""
+    message = str(error).lower()
+    return 'chat not found' in message or 'user is deactivated' in message
+
+telegram_broadcaster = TelegramBroadcaster(prune=prune_subscribers)
+
 # ============== FUNCIONES DE TELEGRAM ==============
 
-def format_telegram_message(data, is_alert=False):
+def venezuela_timestamp(data):
+    """Fecha del snapshot en hora de Venezuela (UTC-4) para los mensajes"""
     try:
         timestamp_str = data.get("timestamp", "")
         if timestamp_str:
@@ -485,11 +2622,29 @@ def format_telegram_message(data, is_alert=False):
                 timestamp_str = timestamp_str[:-1]
             dt = datetime.fromisoformat(timestamp_str)
             dt_venezuela = dt - timedelta(hours=4)
-            timestamp = dt_venezuela.strftime("%d/%m/%Y %H:%M:%S")
-        else:
-            timestamp = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+            return dt_venezuela.strftime("%d/%m/%Y %H:%M:%S")
     except:
-        timestamp = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+        pass
+    return datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+
+# Mensajes ya renderizados del ultimo snapshot: {is_alert: (timestamp, texto)}.
+# update_prices_job() los prepara al publicar cada snapshot y los botones y
+# difusiones los reutilizan hasta el siguiente.
+_rendered_messages = {}
+
+def render_snapshot_message(data, is_alert=False):
+    """format_telegram_message() del snapshot, renderizado una vez por timestamp"""
+    key = data.get("timestamp")
+    cached = _rendered_messages.get(is_alert)
+    if key and cached and cached[0] == key:
+        return cached[1]
+    message = format_telegram_message(data, is_alert=is_alert)
+    if key:
+        _rendered_messages[is_alert] = (key, message)
+    return message
+
+def format_telegram_message(data, is_alert=False):
+    timestamp = venezuela_timestamp(data)
 
     alert_header = "🚨 *ALERTA DE CAMBIO*\n" if is_alert else ""
 
@@ -524,7 +2679,7 @@ _Información con fines educativos/informativos_
 """
 
 def format_alert_message(data, old_brecha, new_brecha, change):
-    base_msg = format_telegram_message(data, is_alert=True)
+    base_msg = render_snapshot_message(data, is_alert=True)
     direction = "subio" if change > 0 else "bajo"
     alert_info = f"""
 ⚠️ *La brecha USDT vs $ BCV {direction}*
@@ -536,18 +2691,7 @@ def format_alert_message(data, old_brecha, new_brecha, change):
 
 def format_bcv_update_message(data, old_bcv, changes):
     """Formatea mensaje de actualizacion del BCV"""
-    try:
-        timestamp_str = data.get("timestamp", "")
-        if timestamp_str:
-            if timestamp_str.endswith('Z'):
-                timestamp_str = timestamp_str[:-1]
-            dt = datetime.fromisoformat(timestamp_str)
-            dt_venezuela = dt - timedelta(hours=4)
-            timestamp = dt_venezuela.strftime("%d/%m/%Y %H:%M:%S")
-        else:
-            timestamp = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-    except:
-        timestamp = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+    timestamp = venezuela_timestamp(data)
 
     bcv_usd = data.get('bcv_usd') or 0
     bcv_eur = data.get('bcv_eur') or 0
@@ -593,14 +2737,6 @@ _Información con fines educativos/informativos_
 🌐 https://brecha-cambiaria.com
 """
 
-async def send_telegram_message(bot, chat_id, message):
-    try:
-        await bot.send_message(chat_id=chat_id, text=message, parse_mode='Markdown')
-        return True
-    except Exception as e:
-        print(f"Error enviando mensaje a {chat_id}: {e}")
-        return False
-
 async def send_scheduled_notification(bot):
     subscribers = load_subscribers()
     if not subscribers:
@@ -613,119 +2749,528 @@ async def send_scheduled_notification(bot):
             print(f"[{datetime.now()}] No hay datos disponibles")
             return
 
-        message = format_telegram_message(data)
+        message = render_snapshot_message(data)
 
-        for chat_id in subscribers:
-            await send_telegram_message(bot, chat_id, message)
-            print(f"[{datetime.now()}] Notificacion enviada a {chat_id}")
+        await telegram_broadcaster.broadcast(bot, subscribers, message, label="Notificacion programada")
 
-        if data.get("brecha_usdt_usd") is not None:
-            save_last_brecha({
-                "brecha_usdt_usd": data["brecha_usdt_usd"],
-                "timestamp": data.get("timestamp")
-            })
+        brecha_alerts.remember(data)
 
     except Exception as e:
         print(f"[{datetime.now()}] Error en notificacion: {e}")
 
-async def check_brecha_change(bot):
-    subscribers = load_subscribers()
-    if not subscribers:
-        return
-
-    try:
-        data = get_latest_data()
-        current_brecha = data.get("brecha_usdt_usd")
+# ============== ALERTAS POR EVENTOS ==============
+
+class BrechaAlertEvaluator:
+    """Detecta cambios de la brecha USDT vs $ BCV mayores a `threshold`.
+
+    Recuerda en memoria la ultima brecha notificada; solo lee el estado
+    guardado (app_settings) la primera vez y lo persiste cuando cambia.
+    """
+
+    def __init__(self, threshold=BRECHA_CHANGE_THRESHOLD, load_state=load_last_brecha, save_state=save_last_brecha):
+        self.threshold = threshold
+        self.load_state = load_state
+        self.save_state = save_state
+        self._state = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _last(self):
+        if not self._loaded:
+            self._state = self.load_state() if self.load_state else None
+            self._loaded = True
+        return self._state
+
+    def _remember(self, data):
+        self._state = {
+            "brecha_usdt_usd": data["brecha_usdt_usd"],
+            "timestamp": data.get("timestamp")
+        }
+        self._loaded = True
+        if self.save_state:
+            self.save_state(self._state)
 
-        if current_brecha is None:
+    def remember(self, data):
+        """Toma `data` como nueva referencia (p.ej. tras la notificacion programada)"""
+        if data.get("brecha_usdt_usd") is None:
             return
+        with self._lock:
+            self._remember(data)
 
-        last_brecha_data = load_last_brecha()
+    def evaluate(self, data, deliver=None):
+        """Mensaje de alerta si la brecha cambio mas del umbral, o None.
 
-        if last_brecha_data is None:
-            save_last_brecha({
-                "brecha_usdt_usd": current_brecha,
-                "timestamp": data.get("timestamp")
-            })
-            return
+        Con `deliver` el mensaje se le pasa y la brecha solo se toma como
+        notificada si deliver() devuelve algo verdadero; si no (p.ej. aun no
+        hay suscriptores) la alerta queda pendiente para el proximo snapshot.
+        """
+        current_brecha = data.get("brecha_usdt_usd")
+        if current_brecha is None:
+            return None
 
-        old_brecha = last_brecha_data.get("brecha_usdt_usd", 0)
-        change = current_brecha - old_brecha
+        with self._lock:
+            last_brecha_data = self._last()
+            if last_brecha_data is None:
+                self._remember(data)
+                return None
 
-        if abs(change) >= BRECHA_CHANGE_THRESHOLD:
-            print(f"[{datetime.now()}] Cambio detectado: {old_brecha:.2f}% -> {current_brecha:.2f}%")
+            old_brecha = last_brecha_data.get("brecha_usdt_usd", 0)
+            change = current_brecha - old_brecha
+            if abs(change) < self.threshold:
+                return None
 
             message = format_alert_message(data, old_brecha, current_brecha, change)
+            if deliver is not None and not deliver(message):
+                return None
+            print(f"[{datetime.now()}] Cambio detectado: {old_brecha:.2f}% -> {current_brecha:.2f}%")
+            self._remember(data)
+        return message
+
+class BcvUpdateEvaluator:
+    """Detecta cuando el BCV publica nuevas tasas de dolar o euro"""
+
+    def __init__(self, load_state=load_last_bcv, save_state=save_last_bcv):
+        self.load_state = load_state
+        self.save_state = save_state
+        self._state = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _remember(self, data):
+        self._state = {
+            "bcv_usd": data.get("bcv_usd"),
+            "bcv_eur": data.get("bcv_eur"),
+            "timestamp": data.get("timestamp")
+        }
+        self._loaded = True
+        if self.save_state:
+            self.save_state(self._state)
 
-            for chat_id in subscribers:
-                await send_telegram_message(bot, chat_id, message)
-                print(f"[{datetime.now()}] Alerta enviada a {chat_id}")
+    def evaluate(self, data, deliver=None):
+        """Mensaje de actualizacion si cambio alguna tasa del BCV, o None.
 
-            save_last_brecha({
-                "brecha_usdt_usd": current_brecha,
-                "timestamp": data.get("timestamp")
-            })
+        `deliver` funciona igual que en BrechaAlertEvaluator.evaluate().
+        """
+        current_usd = data.get("bcv_usd")
+        current_eur = data.get("bcv_eur")
+        if current_usd is None and current_eur is None:
+            return None
 
-    except Exception as e:
-        print(f"[{datetime.now()}] Error verificando brecha: {e}")
+        with self._lock:
+            if not self._loaded:
+                self._state = self.load_state() if self.load_state else None
+                self._loaded = True
+            last_bcv_data = self._state
+
+            if last_bcv_data is None:
+                # Primera vez, guardar y salir
+                self._remember(data)
+                print(f"[{datetime.now()}] BCV inicial guardado: USD={current_usd}, EUR={current_eur}")
+                return None
+
+            old_usd = last_bcv_data.get("bcv_usd")
+            old_eur = last_bcv_data.get("bcv_eur")
+
+            changes = {}
+
+            # Verificar cambio en dolar
+            if old_usd and current_usd and old_usd != current_usd:
+                changes['usd'] = {'old': old_usd, 'new': current_usd}
+
+            # Verificar cambio en euro
+            if old_eur and current_eur and old_eur != current_eur:
+                changes['eur'] = {'old': old_eur, 'new': current_eur}
+
+            if not changes:
+                return None
 
-async def check_bcv_update(bot):
-    """Verifica si el BCV actualizo sus tasas y notifica"""
+            message = format_bcv_update_message(data, last_bcv_data, changes)
+            if deliver is not None and not deliver(message):
+                return None
+            print(f"[{datetime.now()}] Actualizacion BCV detectada: {changes}")
+            self._remember(data)
+        return message
+
+brecha_alerts = BrechaAlertEvaluator()
+bcv_alerts = BcvUpdateEvaluator()
+
+# Bot y event loop del thread de Telegram, para difundir desde otros threads
+_telegram_bot = None
+_telegram_loop = None
+_telegram_stop = None
+
+def attach_telegram_bot(bot, loop):
+    """Registra el bot ya iniciado y suscribe las alertas a los snapshots"""
+    global _telegram_bot, _telegram_loop
+    _telegram_bot = bot
+    _telegram_loop = loop
+    alert_rule_engine.load(load_alert_rules(), previous=get_latest_snapshot())
+    snapshot_events.subscribe(dispatch_snapshot_alerts)
+    snapshot_events.subscribe(dispatch_rule_alerts)
+
+def detach_telegram_bot():
+    """Desuscribe las alertas y pide al bot que se detenga (el proceso dejo de ser lider)"""
+    global _telegram_bot, _telegram_loop
+    snapshot_events.unsubscribe(dispatch_snapshot_alerts)
+    snapshot_events.unsubscribe(dispatch_rule_alerts)
+    loop, stop = _telegram_loop, _telegram_stop
+    _telegram_bot = None
+    _telegram_loop = None
+    if loop is not None and stop is not None:
+        loop.call_soon_threadsafe(stop.set)
+
+def dispatch_broadcast(message, label):
+    """Programa una difusion en el event loop del bot; retorna el Future o None"""
+    if _telegram_bot is None or _telegram_loop is None:
+        return None
     subscribers = load_subscribers()
     if not subscribers:
-        return
+        return None
+    return asyncio.run_coroutine_threadsafe(
+        telegram_broadcaster.broadcast(_telegram_bot, subscribers, message, label=label),
+        _telegram_loop
+    )
+
+def dispatch_snapshot_alerts(snapshot):
+    """Evalua las alertas con cada snapshot publicado, en el mismo tick.
+
+    Una alerta solo se da por enviada si dispatch_broadcast() la programo;
+    sin suscriptores queda pendiente para el primero que llegue.
+    """
+    brecha_alerts.evaluate(snapshot, deliver=lambda message: dispatch_broadcast(message, "Alerta de brecha"))
+    bcv_alerts.evaluate(snapshot, deliver=lambda message: dispatch_broadcast(message, "Notificacion BCV"))
+
+# ============== REGLAS DE ALERTA POR USUARIO ==============
+
+# Metricas sobre las que un usuario puede crear reglas
+RULE_METRICS = {
+    'usdt_avg': 'USDT Binance',
+    'bcv_usd': 'Dólar BCV',
+    'bcv_eur': 'Euro BCV',
+    'brecha_usdt_usd': 'Brecha USDT vs $ BCV',
+    'brecha_usdt_eur': 'Brecha USDT vs € BCV',
+}
+RULE_KINDS = ('above', 'below', 'change')
+
+def _rule_from_row(row):
+    return {
+        "id": row[0],
+        "chat_id": row[1],
+        "metric": row[2],
+        "kind": row[3],
+        "threshold": float(row[4]),
+        "reference": float(row[5]) if row[5] is not None else None,
+        "cooldown_minutes": row[6],
+        "last_fired_at": row[7].replace(tzinfo=None) if row[7] else None,
+    }
 
-    try:
-        data = get_latest_data()
-        current_usd = data.get("bcv_usd")
-        current_eur = data.get("bcv_eur")
+def _load_alert_rules_file():
+    if os.path.exists(ALERT_RULES_FILE):
+        try:
+            with open(ALERT_RULES_FILE, 'r') as f:
+                rules = json.load(f)
+            for rule in rules:
+                if rule.get("last_fired_at"):
+                    rule["last_fired_at"] = parse_iso_datetime(rule["last_fired_at"])
+            return rules
+        except:
+            return []
+    return []
 
-        if current_usd is None and current_eur is None:
-            return
+def _save_alert_rules_file(rules):
+    with open(ALERT_RULES_FILE, 'w') as f:
+        json.dump([
+            dict(rule, last_fired_at=rule["last_fired_at"].isoformat() + 'Z' if rule.get("last_fired_at") else None)
+            for rule in rules
+        ], f)
 
-        last_bcv_data = load_last_bcv()
+def load_alert_rules(chat_id=None):
+    """Carga las reglas de alerta, todas o las de un chat"""
+    if get_db_pool():
+        try:
+            with db_cursor() as cur:
+                query = '''
+                    SELECT id, chat_id, metric, kind, threshold, reference, cooldown_minutes, last_fired_at
+                    FROM alert_rules
+                '''
+                if chat_id is None:
+                    cur.execute(query + ' ORDER BY id')
+                else:
+                    cur.execute(query + ' WHERE chat_id = %s ORDER BY id', (chat_id,))
+                return [_rule_from_row(row) for row in cur.fetchall()]
+        except Exception as e:
+            print(f"Error cargando reglas de alerta: {e}")
+            return []
 
-        if last_bcv_data is None:
-            # Primera vez, guardar y salir
-            save_last_bcv({
-                "bcv_usd": current_usd,
-                "bcv_eur": current_eur,
-                "timestamp": data.get("timestamp")
-            })
-            print(f"[{datetime.now()}] BCV inicial guardado: USD={current_usd}, EUR={current_eur}")
-            return
+    # Fallback a JSON
+    rules = _load_alert_rules_file()
+    if chat_id is not None:
+        rules = [rule for rule in rules if rule["chat_id"] == chat_id]
+    return rules
+
+def add_alert_rule(chat_id, metric, kind, threshold, reference=None,
+                   cooldown_minutes=ALERT_RULE_COOLDOWN_MINUTES):
+    """Crea una regla y la retorna con su id, o None si falla"""
+    rule = {
+        "chat_id": chat_id,
+        "metric": metric,
+        "kind": kind,
+        "threshold": round(float(threshold), 2),
+        "reference": round(float(reference), 2) if reference is not None else None,
+        "cooldown_minutes": cooldown_minutes,
+        "last_fired_at": None,
+    }
+    if get_db_pool():
+        try:
+            with db_cursor() as cur:
+                cur.execute('''
+                    INSERT INTO alert_rules (chat_id, metric, kind, threshold, reference, cooldown_minutes)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    RETURNING id
+                ''', (chat_id, metric, kind, rule["threshold"], rule["reference"], cooldown_minutes))
+                rule["id"] = cur.fetchone()[0]
+            return rule
+        except Exception as e:
+            print(f"Error agregando regla de alerta: {e}")
+            return None
 
-        old_usd = last_bcv_data.get("bcv_usd")
-        old_eur = last_bcv_data.get("bcv_eur")
+    # Fallback a JSON
+    rules = _load_alert_rules_file()
+    rule["id"] = max((r["id"] for r in rules), default=0) + 1
+    rules.append(rule)
+    _save_alert_rules_file(rules)
+    return rule
+
+def delete_alert_rule(chat_id, rule_id):
+    """Elimina una regla del chat; retorna True si existia"""
+    if get_db_pool():
+        try:
+            with db_cursor() as cur:
+                cur.execute('DELETE FROM alert_rules WHERE id = %s AND chat_id = %s', (rule_id, chat_id))
+                return cur.rowcount > 0
+        except Exception as e:
+            print(f"Error eliminando regla de alerta: {e}")
+            return False
 
-        changes = {}
+    # Fallback a JSON
+    rules = _load_alert_rules_file()
+    remaining = [r for r in rules if not (r["id"] == rule_id and r["chat_id"] == chat_id)]
+    if len(remaining) == len(rules):
+        return False
+    _save_alert_rules_file(remaining)
+    return True
 
-        # Verificar cambio en dolar
-        if old_usd and current_usd and old_usd != current_usd:
-            changes['usd'] = {'old': old_usd, 'new': current_usd}
+def delete_alert_rules_for_chats(chat_ids):
+    """Elimina todas las reglas de los chats dados (chats bloqueados o inexistentes)"""
+    chat_ids = list(dict.fromkeys(chat_ids))
+    if not chat_ids:
+        return
+    alert_rule_engine.remove_chats(chat_ids)
+    if get_db_pool():
+        try:
+            with db_cursor() as cur:
+                cur.execute('DELETE FROM alert_rules WHERE chat_id = ANY(%s)', (chat_ids,))
+        except Exception as e:
+            print(f"Error eliminando reglas de alerta: {e}")
+        return
 
-        # Verificar cambio en euro
-        if old_eur and current_eur and old_eur != current_eur:
-            changes['eur'] = {'old': old_eur, 'new': current_eur}
+    # Fallback a JSON
+    dead = set(chat_ids)
+    rules = _load_alert_rules_file()
+    remaining = [r for r in rules if r["chat_id"] not in dead]
+    if len(remaining) != len(rules):
+        _save_alert_rules_file(remaining)
+
+def save_alert_rules_fired(rules):
+    """Guarda last_fired_at (y la nueva referencia de las reglas de cambio)"""
+    if not rules:
+        return
+    if get_db_pool():
+        try:
+            with db_cursor() as cur:
+                cur.executemany(
+                    'UPDATE alert_rules SET last_fired_at = %s, reference = %s WHERE id = %s',
+                    [(rule["last_fired_at"], rule["reference"], rule["id"]) for rule in rules]
+                )
+        except Exception as e:
+            print(f"Error guardando reglas disparadas: {e}")
+        return
 
-        if changes:
-            print(f"[{datetime.now()}] Actualizacion BCV detectada: {changes}")
+    # Fallback a JSON
+    fired = {rule["id"]: rule for rule in rules}
+    stored = _load_alert_rules_file()
+    for rule in stored:
+        if rule["id"] in fired:
+            rule["last_fired_at"] = fired[rule["id"]]["last_fired_at"]
+            rule["reference"] = fired[rule["id"]]["reference"]
+    _save_alert_rules_file(stored)
+
+class AlertRuleEngine:
+    """Evalua reglas de alerta por usuario sin recorrerlas todas en cada tick.
+
+    Cada metrica tiene dos listas ordenadas de (umbral, id): los limites que
+    se disparan al subir ('above') y los que se disparan al bajar ('below').
+    Con el valor anterior p y el actual c solo se tocan, via bisect, los
+    limites del intervalo cruzado: [p, c) al subir y (c, p] al bajar.
+
+    Una regla 'change' (moverse mas de N desde la referencia) se guarda como
+    la banda [referencia - N, referencia + N]; al dispararse se vuelve a
+    armar alrededor del valor actual. Cada regla respeta su cooldown.
+    """
+
+    def __init__(self):
+        self._rules = {}
+        self._index = {metric: {'above': [], 'below': []} for metric in RULE_METRICS}
+        self._previous = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _bounds(rule):
+        if rule["kind"] == 'above':
+            return [('above', rule["threshold"])]
+        if rule["kind"] == 'below':
+            return [('below', rule["threshold"])]
+        if rule.get("reference") is None:
+            return []
+        return [
+            ('above', round(rule["reference"] + rule["threshold"], 2)),
+            ('below', round(rule["reference"] - rule["threshold"], 2)),
+        ]
 
-            message = format_bcv_update_message(data, last_bcv_data, changes)
+    def _insert(self, rule):
+        index = self._index[rule["metric"]]
+        for side, bound in self._bounds(rule):
+            insort(index[side], (bound, rule["id"]))
+
+    def _discard(self, rule):
+        index = self._index[rule["metric"]]
+        for side, bound in self._bounds(rule):
+            entries = index[side]
+            i = bisect_left(entries, (bound, rule["id"]))
+            if i < len(entries) and entries[i] == (bound, rule["id"]):
+                del entries[i]
+
+    def load(self, rules, previous=None):
+        """Reemplaza todas las reglas; `previous` es el ultimo snapshot conocido"""
+        with self._lock:
+            self._rules = {}
+            self._index = {metric: {'above': [], 'below': []} for metric in RULE_METRICS}
+            for rule in rules:
+                if rule["metric"] in self._index:
+                    self._rules[rule["id"]] = rule
+                    for side, bound in self._bounds(rule):
+                        self._index[rule["metric"]][side].append((bound, rule["id"]))
+            for sides in self._index.values():
+                sides['above'].sort()
+                sides['below'].sort()
+            if previous:
+                self._previous = {m: previous.get(m) for m in RULE_METRICS if previous.get(m) is not None}
+
+    def add(self, rule):
+        with self._lock:
+            self._rules[rule["id"]] = rule
+            self._insert(rule)
+
+    def remove(self, rule_id):
+        with self._lock:
+            rule = self._rules.pop(rule_id, None)
+            if rule:
+                self._discard(rule)
+
+    def remove_chats(self, chat_ids):
+        dead = set(chat_ids)
+        with self._lock:
+            for rule in [r for r in self._rules.values() if r["chat_id"] in dead]:
+                del self._rules[rule["id"]]
+                self._discard(rule)
+
+    def __len__(self):
+        return len(self._rules)
+
+    def crossed(self, metric, previous, current):
+        """Ids de las reglas cuyo limite se cruzo entre `previous` y `current`"""
+        index = self._index[metric]
+        if current > previous:
+            entries = index['above']
+            lo = bisect_left(entries, (previous,))
+            hi = bisect_left(entries, (current,))
+        elif current < previous:
+            entries = index['below']
+            lo = bisect_left(entries, (current, float('inf')))
+            hi = bisect_left(entries, (previous, float('inf')))
+        else:
+            return []
+        return [rule_id for _, rule_id in entries[lo:hi]]
+
+    def evaluate(self, snapshot, now=None):
+        """Reglas disparadas por `snapshot`: lista de (regla, valor anterior, valor actual)"""
+        now = now or datetime.utcnow()
+        fired = []
+        with self._lock:
+            for metric in RULE_METRICS:
+                current = snapshot.get(metric)
+                if current is None:
+                    continue
+                previous = self._previous.get(metric)
+                self._previous[metric] = current
+                if previous is None:
+                    continue
+                for rule_id in dict.fromkeys(self.crossed(metric, previous, current)):
+                    rule = self._rules[rule_id]
+                    last_fired = rule.get("last_fired_at")
+                    if last_fired and now - last_fired < timedelta(minutes=rule["cooldown_minutes"]):
+                        continue
+                    if rule["kind"] == 'change':
+                        self._discard(rule)
+                        rule["reference"] = current
+                        self._insert(rule)
+                    rule["last_fired_at"] = now
+                    fired.append((rule, previous, current))
+        return fired
+
+alert_rule_engine = AlertRuleEngine()
+
+def describe_alert_rule(rule):
+    label = RULE_METRICS.get(rule["metric"], rule["metric"])
+    unit = '%' if rule["metric"].startswith('brecha') else ' VES'
+    if rule["kind"] == 'above':
+        return f"{label} por encima de {rule['threshold']:,.2f}{unit}"
+    if rule["kind"] == 'below':
+        return f"{label} por debajo de {rule['threshold']:,.2f}{unit}"
+    return f"{label} se mueve más de {rule['threshold']:,.2f}{unit}"
+
+def format_rule_alert_message(data, fired):
+    """Mensaje con las reglas de un chat disparadas en un snapshot"""
+    lines = "\n".join(
+        f"• {describe_alert_rule(rule)}\n   `{previous:,.2f}` → `{current:,.2f}`"
+        for rule, previous, current in fired
+    )
+    return f"""🎯 *TUS ALERTAS*
+━━━━━━━━━━━━━━━━━━━━━
 
-            for chat_id in subscribers:
-                await send_telegram_message(bot, chat_id, message)
-                print(f"[{datetime.now()}] Notificacion BCV enviada a {chat_id}")
+{lines}
 
-            # Actualizar ultimo BCV
-            save_last_bcv({
-                "bcv_usd": current_usd,
-                "bcv_eur": current_eur,
-                "timestamp": data.get("timestamp")
-            })
+🕐 _{venezuela_timestamp(data)} (Hora Venezuela)_
+"""
 
-    except Exception as e:
-        print(f"[{datetime.now()}] Error verificando actualizacion BCV: {e}")
+def dispatch_rule_alerts(snapshot):
+    """Evalua las reglas de usuario con cada snapshot y envia un mensaje por chat"""
+    fired = alert_rule_engine.evaluate(snapshot)
+    if not fired:
+        return
+    save_alert_rules_fired([rule for rule, _, _ in fired])
+
+    by_chat = {}
+    for item in fired:
+        by_chat.setdefault(item[0]["chat_id"], []).append(item)
+    messages = [(chat_id, format_rule_alert_message(snapshot, items)) for chat_id, items in by_chat.items()]
+
+    if _telegram_bot is None or _telegram_loop is None:
+        return
+    asyncio.run_coroutine_threadsafe(
+        telegram_broadcaster.deliver(_telegram_bot, messages, label="Alertas personalizadas"),
+        _telegram_loop
+    )
 
 def run_telegram_bot():
     """Ejecuta el bot de Telegram en un thread separado"""
@@ -740,14 +3285,50 @@ def run_telegram_bot():
         print("python-telegram-bot no instalado. Bot de Telegram desactivado.")
         return
 
-    async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        keyboard = [
+    def main_keyboard():
+        return [
             [InlineKeyboardButton("📊 Consultar Brecha", callback_data="brecha")],
             [
                 InlineKeyboardButton("🔔 Suscribirse", callback_data="subscribe"),
                 InlineKeyboardButton("🔕 Desuscribirse", callback_data="unsubscribe")
-            ]
+            ],
+            [InlineKeyboardButton("🎯 Mis alertas", callback_data="rules")]
+        ]
+
+    def rules_menu(chat_id):
+        """Texto y botones con las reglas de alerta del chat"""
+        rules = load_alert_rules(chat_id)
+        keyboard = [
+            [InlineKeyboardButton(f"🗑 {describe_alert_rule(rule)}", callback_data=f"rule_del:{rule['id']}")]
+            for rule in rules
         ]
+        if len(rules) < ALERT_RULES_PER_CHAT:
+            keyboard.append([InlineKeyboardButton("➕ Nueva alerta", callback_data="rule_new")])
+        keyboard.append([InlineKeyboardButton("⬅️ Volver", callback_data="menu")])
+        if rules:
+            text = ("🎯 *Tus alertas*\n\n"
+                    "Toca una alerta para eliminarla.")
+        else:
+            text = ("🎯 *Tus alertas*\n\n"
+                    "No tienes alertas. Crea una para recibir un aviso cuando "
+                    "una tasa o brecha cruce el valor que elijas.")
+        return text, InlineKeyboardMarkup(keyboard)
+
+    def create_rule(chat_id, metric, kind, value):
+        """Crea la regla pedida por el usuario y la agrega al motor"""
+        reference = None
+        if kind == 'change':
+            data = get_latest_snapshot() or {}
+            reference = data.get(metric)
+            if reference is None:
+                return None
+        rule = add_alert_rule(chat_id, metric, kind, value, reference=reference)
+        if rule:
+            alert_rule_engine.add(rule)
+        return rule
+
+    async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        keyboard = main_keyboard()
         await update.message.reply_text(
             "📈 *Bot Brecha Cambiaria Venezuela*\n\n"
             "Recibe notificaciones automaticas:\n"
@@ -763,33 +3344,26 @@ def run_telegram_bot():
         await query.answer()
         chat_id = query.message.chat_id
 
-        keyboard = [
-            [InlineKeyboardButton("📊 Consultar Brecha", callback_data="brecha")],
-            [
-                InlineKeyboardButton("🔔 Suscribirse", callback_data="subscribe"),
-                InlineKeyboardButton("🔕 Desuscribirse", callback_data="unsubscribe")
-            ]
-        ]
+        keyboard = main_keyboard()
         reply_markup = InlineKeyboardMarkup(keyboard)
 
         if query.data == "brecha":
             await query.edit_message_text("⏳ Consultando datos...")
             try:
-                data = get_latest_data()
-                if data.get("bcv_usd") is None:
+                data = get_latest_snapshot()
+                if not data or data.get("bcv_usd") is None:
                     await query.edit_message_text(
                         "❌ Error obteniendo datos. Intenta de nuevo.",
                         reply_markup=reply_markup
                     )
                     return
-                message = format_telegram_message(data)
+                message = render_snapshot_message(data)
                 await query.edit_message_text(message, parse_mode='Markdown', reply_markup=reply_markup)
             except Exception as e:
                 await query.edit_message_text(f"❌ Error: {str(e)}", reply_markup=reply_markup)
 
         elif query.data == "subscribe":
-            subscribers = load_subscribers()
-            if chat_id not in subscribers:
+            if not is_subscriber(chat_id):
                 add_subscriber(chat_id)
                 await query.edit_message_text(
                     "✅ *Suscrito exitosamente*\n\n"
@@ -806,8 +3380,7 @@ def run_telegram_bot():
                 )
 
         elif query.data == "unsubscribe":
-            subscribers = load_subscribers()
-            if chat_id in subscribers:
+            if is_subscriber(chat_id):
                 remove_subscriber(chat_id)
                 await query.edit_message_text(
                     "🔕 *Desuscrito exitosamente*\n\n"
@@ -821,24 +3394,96 @@ def run_telegram_bot():
                     reply_markup=reply_markup
                 )
 
-    async def scheduled_job_wrapper(context):
-        await send_scheduled_notification(context.bot)
+        elif query.data == "menu":
+            context.user_data.pop('pending_rule', None)
+            await query.edit_message_text("Usa las opciones de abajo:", reply_markup=reply_markup)
+
+        elif query.data == "rules":
+            context.user_data.pop('pending_rule', None)
+            text, markup = rules_menu(chat_id)
+            await query.edit_message_text(text, parse_mode='Markdown', reply_markup=markup)
+
+        elif query.data == "rule_new":
+            if len(load_alert_rules(chat_id)) >= ALERT_RULES_PER_CHAT:
+                text, markup = rules_menu(chat_id)
+                await query.edit_message_text(text, parse_mode='Markdown', reply_markup=markup)
+                return
+            keyboard = [
+                [InlineKeyboardButton(label, callback_data=f"rule_metric:{metric}")]
+                for metric, label in RULE_METRICS.items()
+            ]
+            keyboard.append([InlineKeyboardButton("⬅️ Volver", callback_data="rules")])
+            await query.edit_message_text(
+                "➕ *Nueva alerta*\n\n¿Sobre qué valor?",
+                parse_mode='Markdown',
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
 
-    async def brecha_check_wrapper(context):
-        await check_brecha_change(context.bot)
+        elif query.data.startswith("rule_metric:"):
+            metric = query.data.split(":", 1)[1]
+            if metric not in RULE_METRICS:
+                return
+            keyboard = [
+                [InlineKeyboardButton("📈 Sube por encima de...", callback_data=f"rule_kind:{metric}:above")],
+                [InlineKeyboardButton("📉 Baja por debajo de...", callback_data=f"rule_kind:{metric}:below")],
+                [InlineKeyboardButton("↕️ Se mueve más de...", callback_data=f"rule_kind:{metric}:change")],
+                [InlineKeyboardButton("⬅️ Volver", callback_data="rule_new")]
+            ]
+            await query.edit_message_text(
+                f"➕ *Nueva alerta: {RULE_METRICS[metric]}*\n\n¿Cuándo quieres el aviso?",
+                parse_mode='Markdown',
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+
+        elif query.data.startswith("rule_kind:"):
+            _, metric, kind = query.data.split(":", 2)
+            if metric not in RULE_METRICS or kind not in RULE_KINDS:
+                return
+            context.user_data['pending_rule'] = (metric, kind)
+            unit = "puntos de brecha" if metric.startswith('brecha') else "VES"
+            await query.edit_message_text(
+                f"✍️ Escribe el valor en {unit} (por ejemplo `650.50`).",
+                parse_mode='Markdown',
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Cancelar", callback_data="rules")]])
+            )
 
-    async def bcv_check_wrapper(context):
-        await check_bcv_update(context.bot)
+        elif query.data.startswith("rule_del:"):
+            try:
+                rule_id = int(query.data.split(":", 1)[1])
+            except ValueError:
+                return
+            if delete_alert_rule(chat_id, rule_id):
+                alert_rule_engine.remove(rule_id)
+            text, markup = rules_menu(chat_id)
+            await query.edit_message_text(text, parse_mode='Markdown', reply_markup=markup)
+
+    async def scheduled_job_wrapper(context):
+        await send_scheduled_notification(context.bot)
 
     async def ignore_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Ignora cualquier mensaje de texto y recuerda usar botones"""
-        keyboard = [
-            [InlineKeyboardButton("📊 Consultar Brecha", callback_data="brecha")],
-            [
-                InlineKeyboardButton("🔔 Suscribirse", callback_data="subscribe"),
-                InlineKeyboardButton("🔕 Desuscribirse", callback_data="unsubscribe")
-            ]
-        ]
+        pending = context.user_data.get('pending_rule')
+        if pending:
+            try:
+                value = float(update.message.text.strip().replace(',', '.'))
+            except ValueError:
+                await update.message.reply_text("❌ Escribe solo un número, por ejemplo 650.50")
+                return
+            metric, kind = pending
+            if kind == 'change' and value <= 0:
+                await update.message.reply_text("❌ El cambio debe ser mayor que cero")
+                return
+            context.user_data.pop('pending_rule', None)
+            rule = create_rule(update.effective_chat.id, metric, kind, value)
+            text, markup = rules_menu(update.effective_chat.id)
+            if rule:
+                text = f"✅ Alerta creada: {describe_alert_rule(rule)}\n\n" + text
+            else:
+                text = "❌ No se pudo crear la alerta. Intenta de nuevo.\n\n" + text
+            await update.message.reply_text(text, parse_mode='Markdown', reply_markup=markup)
+            return
+
+        keyboard = main_keyboard()
         await update.message.reply_text(
             "⚠️ Este bot solo funciona con botones.\n\nUsa las opciones de abajo:",
             reply_markup=InlineKeyboardMarkup(keyboard)
@@ -862,25 +3507,27 @@ def run_telegram_bot():
         job_queue.run_daily(scheduled_job_wrapper, time=dt_time(hour=18, minute=0), name='afternoon')
         job_queue.run_daily(scheduled_job_wrapper, time=dt_time(hour=2, minute=0), name='night')
 
-        # Verificar cambio de brecha cada hora
-        job_queue.run_repeating(brecha_check_wrapper, interval=3600, first=60, name='brecha_check')
-
-        # Verificar actualizacion del BCV cada 5 minutos
-        job_queue.run_repeating(bcv_check_wrapper, interval=300, first=30, name='bcv_check')
-
-        print("Bot de Telegram iniciado")
-        print("  - Notificaciones: 8:00 AM, 2:00 PM, 10:00 PM (Venezuela)")
-        print("  - Verificacion de brecha: cada hora")
-        print("  - Verificacion de BCV: cada 5 minutos")
+        global _telegram_stop
+        _telegram_stop = asyncio.Event()
 
         # Iniciar sin señales (compatible con threads)
         await application.initialize()
         await application.start()
         await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
 
-        # Mantener el bot corriendo
-        while True:
-            await asyncio.sleep(3600)
+        # Alertas de brecha y BCV con cada snapshot de update_prices_job()
+        attach_telegram_bot(application.bot, asyncio.get_running_loop())
+
+        print("Bot de Telegram iniciado")
+        print("  - Notificaciones: 8:00 AM, 2:00 PM, 10:00 PM (Venezuela)")
+        print("  - Alertas de brecha y BCV: con cada actualizacion de precios")
+
+        # Mantener el bot corriendo hasta que el proceso deje de ser lider
+        await _telegram_stop.wait()
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        print("Bot de Telegram detenido")
 
     def run_bot():
         loop = asyncio.new_event_loop()
@@ -894,69 +3541,640 @@ def run_telegram_bot():
     bot_thread.start()
     print("Bot de Telegram ejecutandose en thread separado")
 
+# ============== ELECCION DE LIDER ==============
+
+# Clave del advisory lock de PostgreSQL que identifica al lider
+LEADER_LOCK_KEY = 0x4252454348410001
+
+class LeaderLock:
+    """Garantiza que un solo proceso corra el scheduler de precios y el bot.
+
+    Con PostgreSQL usa pg_try_advisory_lock() sobre una conexion propia (fuera
+    del pool): el lock vive mientras la conexion siga abierta, asi que si el
+    proceso lider muere otro lo toma en el siguiente intento. Sin PostgreSQL
+    usa flock() sobre SCHEDULER_LOCK_FILE, que el sistema libera igual.
+    """
+
+    def __init__(self, key=LEADER_LOCK_KEY, lock_file=SCHEDULER_LOCK_FILE):
+        self.key = key
+        self.lock_file = lock_file
+        self._conn = None
+        self._file = None
+
+    def try_acquire(self):
+        if self.is_held():
+            return True
+        if DATABASE_URL:
+            return self._try_acquire_pg()
+        return self._try_acquire_file()
+
+    def _try_acquire_pg(self):
+        import psycopg2
+        conn = None
+        try:
+            conn = psycopg2.connect(
+                database_dsn(),
+                connect_timeout=10, keepalives=1, keepalives_idle=30,
+                keepalives_interval=10, keepalives_count=3
+            )
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute('SELECT pg_try_advisory_lock(%s)', (self.key,))
+                acquired = cur.fetchone()[0]
+        except Exception as e:
+            print(f"Error intentando tomar el lock de lider: {e}")
+            # leadership_job reintenta en cada intervalo: no dejar la conexion abierta
+            if conn is not None:
+                conn.close()
+            return False
+        if not acquired:
+            conn.close()
+            return False
+        self._conn = conn
+        return True
+
+    def _try_acquire_file(self):
+        if fcntl is None:
+            # Sin flock (Windows) no hay forma de coordinar: cada proceso es lider
+            self._file = True
+            return True
+        lock_file = open(self.lock_file, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        return True
+
+    def is_held(self):
+        """True si el lock sigue tomado; con PostgreSQL verifica la conexion"""
+        if self._file is not None:
+            return True
+        if self._conn is None:
+            return False
+        try:
+            with self._conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            return True
+        except Exception:
+            self.release()
+            return False
+
+    def release(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+        if self._file is not None:
+            if self._file is not True:
+                self._file.close()
+            self._file = None
+
+leader_lock = LeaderLock()
+_is_leader = False
+
+def is_leader():
+    return _is_leader
+
+def refresh_snapshot_job():
+    """En procesos seguidores: toma el ultimo registro que guardo el lider"""
+    history_cache.catch_up()
+    latest = load_latest_entry()
+    current = _latest_snapshot
+    if latest and (current is None or entry_datetime(latest) > entry_datetime(current)):
+        set_latest_snapshot(latest)
+
+def receive_snapshot(snapshot):
+    """Snapshot recibido por el canal: lo publica en este proceso y pone al dia el cache"""
+    if snapshot is None:
+        refresh_snapshot_job()
+        return
+    current = _latest_snapshot
+    if current is None or entry_datetime(snapshot) > entry_datetime(current):
+        # Primero el historial: las respuestas cacheadas para este snapshot ya lo incluyen
+        history_cache.catch_up()
+        set_latest_snapshot(snapshot)
+
+def become_leader(scheduler):
+    global _is_leader
+    _is_leader = True
+    print(f"Proceso {os.getpid()} es el lider: scheduler de precios y bot de Telegram")
+    snapshot_events.subscribe(snapshot_channel.publish)
+    if scheduler.get_job('refresh_snapshot'):
+        scheduler.remove_job('refresh_snapshot')
+    scheduler.add_job(func=update_prices_job, trigger="interval", seconds=PRICE_UPDATE_SECONDS, id='update_prices')
+    print(f"Scheduler de precios iniciado: actualizacion cada {PRICE_UPDATE_SECONDS} segundos")
+    history_cache.catch_up()
+    update_prices_job()
+    run_telegram_bot()
+
+def become_follower(scheduler):
+    global _is_leader
+    if _is_leader:
+        print(f"Proceso {os.getpid()} perdio el lock de lider")
+        snapshot_events.unsubscribe(snapshot_channel.publish)
+        detach_telegram_bot()
+    _is_leader = False
+    snapshot_channel.start_listener(receive_snapshot)
+    if scheduler.get_job('update_prices'):
+        scheduler.remove_job('update_prices')
+    if not scheduler.get_job('refresh_snapshot'):
+        scheduler.add_job(func=refresh_snapshot_job, trigger="interval",
+                          seconds=SNAPSHOT_REFRESH_SECONDS, id='refresh_snapshot')
+
+def leadership_job(scheduler):
+    """Revisa periodicamente el lock: el seguidor intenta tomarlo, el lider verifica que lo conserva"""
+    if _is_leader:
+        if not leader_lock.is_held():
+            become_follower(scheduler)
+    elif leader_lock.try_acquire():
+        become_leader(scheduler)
+
+# ============== ESTADISTICAS ==============
+
+# Contadores de ticks del lider; se persisten en cada tick para que los
+# procesos web (y el lider tras un reinicio) los lean sin recalcular nada
+_tick_stats = None
+_tick_stats_lock = threading.Lock()
+
+def _empty_tick_stats():
+    return {"ticks": 0, "complete": 0, "partial": 0, "failed": 0,
+            "last_tick_at": None, "last_tick_ms": None, "last_status": None}
+
+def load_tick_stats():
+    """Carga los contadores de ticks guardados"""
+    if get_db_pool():
+        try:
+            with db_cursor() as cur:
+                cur.execute("SELECT value FROM app_settings WHERE key = 'tick_stats'")
+                row = cur.fetchone()
+            return json.loads(row[0]) if row else _empty_tick_stats()
+        except Exception as e:
+            print(f"Error cargando estadisticas de ticks: {e}")
+            return _empty_tick_stats()
+
+    # Fallback a JSON
+    if os.path.exists(TICK_STATS_FILE):
+        try:
+            with open(TICK_STATS_FILE, 'r') as f:
+                return json.load(f)
+        except:
+            return _empty_tick_stats()
+    return _empty_tick_stats()
+
+def save_tick_stats(stats):
+    """Guarda los contadores de ticks"""
+    if get_db_pool():
+        try:
+            with db_cursor() as cur:
+                cur.execute('''
+                    INSERT INTO app_settings (key, value, updated_at)
+                    VALUES ('tick_stats', %s, CURRENT_TIMESTAMP)
+                    ON CONFLICT (key) DO UPDATE SET value = %s, updated_at = CURRENT_TIMESTAMP
+                ''', (json.dumps(stats), json.dumps(stats)))
+            return True
+        except Exception as e:
+            print(f"Error guardando estadisticas de ticks: {e}")
+            return False
+
+    # Fallback a JSON
+    tmp_path = TICK_STATS_FILE + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(stats, f)
+    os.replace(tmp_path, TICK_STATS_FILE)
+    return True
+
+def record_tick(data, elapsed_ms):
+    """Cuenta un tick del scheduler: completo si llegaron todas las fuentes,
+    parcial si falto alguna y fallido si no hubo datos o hubo una excepcion"""
+    global _tick_stats
+    if data is None:
+        status = 'failed'
+    elif all(data.get(key) is not None for key in ('bcv_usd', 'bcv_eur', 'usdt_avg')):
+        status = 'complete'
+    elif any(data.get(key) is not None for key in ('bcv_usd', 'bcv_eur', 'usdt_avg')):
+        status = 'partial'
+    else:
+        status = 'failed'
+
+    with _tick_stats_lock:
+        if _tick_stats is None:
+            _tick_stats = load_tick_stats()
+        stats = dict(_tick_stats)
+        stats["ticks"] += 1
+        stats[status] += 1
+        stats["last_tick_at"] = datetime.utcnow().isoformat() + 'Z'
+        stats["last_tick_ms"] = round(elapsed_ms, 1)
+        stats["last_status"] = status
+        _tick_stats = stats
+    save_tick_stats(stats)
+    _stats_cache["expires_at"] = 0
+    return status
+
+def tick_summary(stats):
+    """Contadores de ticks con la tasa de exito ya calculada"""
+    summary = dict(stats or _empty_tick_stats())
+    summary["success_rate"] = round(summary["complete"] / summary["ticks"], 3) if summary["ticks"] else None
+    return summary
+
+# Resultado de la ultima consulta de /api/stats, reutilizado STATS_CACHE_SECONDS
+_stats_cache = {"expires_at": 0, "value": None}
+_stats_cache_lock = threading.Lock()
+
+def _load_stats_summary():
+    """Conteo, extremos del historial, suscriptores eliminados y ticks.
+
+    Con el cache columnar el conteo y los extremos salen de la memoria; sin el
+    cache se piden en una sola consulta junto con los contadores guardados en
+    app_settings. Sin PostgreSQL el historial JSONL ya lleva cuenta, primero y
+    ultimo registro, asi que ningun camino recorre el historial.
+    """
+    summary = {"total_records": 0, "oldest_record": None, "newest_record": None}
+    view = history_cache.view()
+    if view is not None:
+        summary["total_records"] = len(view[0])
+        if summary["total_records"]:
+            summary["oldest_record"] = epoch_us_to_iso(view[0][0])
+            summary["newest_record"] = epoch_us_to_iso(view[0][-1])
+
+    if get_db_pool():
+        try:
+            with db_cursor() as cur:
+                settings_sql = '''
+                    (SELECT value FROM app_settings WHERE key = 'pruned_subscribers'),
+                    (SELECT value FROM app_settings WHERE key = 'tick_stats')
+                '''
+                if view is not None:
+                    cur.execute('SELECT ' + settings_sql)
+                    pruned, ticks = cur.fetchone()
+                else:
+                    cur.execute('''
+                        SELECT count(*), min(timestamp), max(timestamp),
+                    ''' + settings_sql + 'FROM price_history')
+                    total, oldest, newest, pruned, ticks = cur.fetchone()
+                    summary["total_records"] = total
+                    summary["oldest_record"] = format_timestamp(oldest)
+                    summary["newest_record"] = format_timestamp(newest)
+            summary["pruned_subscribers"] = int(pruned) if pruned else 0
+            summary["ticks"] = tick_summary(json.loads(ticks) if ticks else None)
+            return summary
+        except Exception as e:
+            print(f"Error cargando estadisticas de PostgreSQL: {e}")
+
+    # Fallback a JSON
+    if view is None:
+        summary["total_records"] = len(history_store)
+        first, last = history_store.first(), history_store.last()
+        summary["oldest_record"] = first.get('timestamp') if first else None
+        summary["newest_record"] = last.get('timestamp') if last else None
+    summary["pruned_subscribers"] = load_pruned_subscribers()
+    summary["ticks"] = tick_summary(load_tick_stats())
+    return summary
+
+def stats_summary():
+    """Resumen para /api/stats, cacheado STATS_CACHE_SECONDS"""
+    now = time.monotonic()
+    if _stats_cache["value"] is not None and now < _stats_cache["expires_at"]:
+        return _stats_cache["value"]
+    with _stats_cache_lock:
+        if _stats_cache["value"] is None or time.monotonic() >= _stats_cache["expires_at"]:
+            _stats_cache["value"] = _load_stats_summary()
+            _stats_cache["expires_at"] = time.monotonic() + STATS_CACHE_SECONDS
+        return _stats_cache["value"]
+
 # ============== JOBS DEL SCHEDULER ==============
 
+# El job del scheduler y /api/refresh no corren un tick a la vez
+_update_prices_lock = threading.Lock()
+
 def update_prices_job():
-    print(f"[{datetime.now().isoformat()}] Actualizando precios...")
-    try:
-        current_data = fetch_and_calculate_prices()
-        save_history_entry(current_data)
-        print(f"[{datetime.now().isoformat()}] Precios actualizados")
-    except Exception as e:
-        print(f"[{datetime.now().isoformat()}] Error: {e}")
+    """Un tick: consulta las fuentes, guarda y publica el snapshot. Retorna el snapshot o None"""
+    with _update_prices_lock:
+        print(f"[{datetime.now().isoformat()}] Actualizando precios...")
+        started = time.monotonic()
+        current_data = None
+        try:
+            current_data = fetch_and_calculate_prices()
+            record_tick(current_data, (time.monotonic() - started) * 1000)
+            # Se publica lo que quedo guardado, igual a lo que leen los seguidores
+            current_data = save_history_entry(current_data) or current_data
+            set_latest_snapshot(current_data)
+            render_snapshot_message(current_data)
+            snapshot_events.publish(current_data)
+            print(f"[{datetime.now().isoformat()}] Precios actualizados")
+            return current_data
+        except Exception as e:
+            print(f"[{datetime.now().isoformat()}] Error: {e}")
+            if current_data is None:
+                record_tick(None, (time.monotonic() - started) * 1000)
+            return None
+
+# ============== FORMATOS DEL HISTORIAL ==============
+
+HISTORY_FORMATS = ('json', 'columnar', 'binary')
+
+# format=binary: cabecera (magia, registros, total, metricas), luego los
+# timestamps en milisegundos epoch como float64 y una columna float32 por
+# metrica en el orden de METRICS; NaN es un valor faltante. Little-endian.
+HISTORY_BINARY_MAGIC = b'BCH1'
+HISTORY_BINARY_HEADER = struct.Struct('<4sIII')
+
+def _column_to_list(column):
+    values = column.tolist()
+    if np.isnan(column).any():
+        values = [None if value != value else value for value in values]
+    return values
+
+def columnar_history_payload(timestamps, columns):
+    """Historial como un arreglo por metrica y los timestamps como base + diferencias en ms"""
+    ms = timestamps // 1000
+    return {
+        "timestamps": {
+            "base": int(ms[0]) if len(ms) else None,
+            "deltas": np.diff(ms, prepend=ms[:1]).tolist()
+        },
+        "columns": {metric: _column_to_list(columns[metric]) for metric in METRICS}
+    }
+
+def binary_history_payload(timestamps, columns, total):
+    """Historial empaquetado para format=binary (ver HISTORY_BINARY_HEADER)"""
+    parts = [
+        HISTORY_BINARY_HEADER.pack(HISTORY_BINARY_MAGIC, len(timestamps), total, len(METRICS)),
+        (timestamps // 1000).astype('<f8').tobytes()
+    ]
+    parts.extend(columns[metric].astype('<f4').tobytes() for metric in METRICS)
+    return b''.join(parts)
+
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+def export_csv_lines(batches):
+    """Cabecera y un bloque de lineas CSV por lote"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(('timestamp',) + METRICS)
+    yield buffer.getvalue()
+    for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([entry['timestamp']] + [entry.get(m) for m in METRICS] for entry in batch)
+        yield buffer.getvalue()
+
+def export_ndjson_lines(batches):
+    """Un bloque de lineas JSON (un registro por linea) por lote"""
+    for batch in batches:
+        yield ''.join(json.dumps(entry) + '\n' for entry in batch)
+
+# ============== COMPRESION ==============
+
+# Extension del archivo precomprimido por codificacion
+COMPRESSED_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+# Archivos de static/ que se precomprimen (las imagenes ya vienen comprimidas)
+PRECOMPRESS_EXTENSIONS = ('.html', '.js', '.json', '.xml', '.txt', '.css', '.svg')
+
+# Las imagenes no cambian en el mismo nombre; el resto se revalida con ETag
+STATIC_IMAGE_MAX_AGE = 7 * 24 * 3600
+
+def negotiate_encoding():
+    """Codificacion preferida que acepta el cliente: 'br', 'gzip' o None"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+def compress_body(body, encoding, static=False):
+    """Comprime `body`; los archivos estaticos usan el nivel maximo porque se comprimen una vez"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=11 if static else 5)
+    return gzip.compress(body, compresslevel=9 if static else 6, mtime=0)
+
+def precompress_static(directory=None, force=False):
+    """Escribe las variantes .gz y .br de los archivos de texto de `directory`.
+
+    Solo rehace una variante si falta o es mas vieja que el original. Se
+    escribe a un temporal y se renombra, asi varios workers pueden llamarla a
+    la vez al arrancar.
+    """
+    directory = directory or app.static_folder
+    written = []
+    encodings = [e for e in COMPRESSED_SUFFIXES if e != 'br' or brotli is not None]
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not name.endswith(PRECOMPRESS_EXTENSIONS) or not os.path.isfile(path):
+            continue
+        source_mtime = os.path.getmtime(path)
+        body = None
+        for encoding in encodings:
+            target = path + COMPRESSED_SUFFIXES[encoding]
+            if not force and os.path.exists(target) and os.path.getmtime(target) >= source_mtime:
+                continue
+            if body is None:
+                with open(path, 'rb') as f:
+                    body = f.read()
+            tmp_path = f"{target}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(compress_body(body, encoding, static=True))
+            os.replace(tmp_path, target)
+            written.append(target)
+    return written
+
+def send_static(filename):
+    """Sirve un archivo de static/, usando su variante precomprimida si el cliente la acepta"""
+    response = None
+    if filename.endswith(PRECOMPRESS_EXTENSIONS):
+        encoding = negotiate_encoding()
+        path = os.path.join(app.static_folder, filename)
+        variant = path + COMPRESSED_SUFFIXES[encoding] if encoding else None
+        if variant and os.path.exists(variant) and os.path.getmtime(variant) >= os.path.getmtime(path):
+            response = send_from_directory(app.static_folder, filename + COMPRESSED_SUFFIXES[encoding],
+                                           mimetype=mimetypes.guess_type(filename)[0])
+            response.headers['Content-Encoding'] = encoding
+        if response is None:
+            response = send_from_directory(app.static_folder, filename)
+        response.vary.add('Accept-Encoding')
+        response.cache_control.no_cache = True
+    else:
+        response = send_from_directory(app.static_folder, filename, max_age=STATIC_IMAGE_MAX_AGE)
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Comprime respuestas JSON desde COMPRESS_MIN_BYTES (las de cached_response ya vienen comprimidas)"""
+    if (response.mimetype != 'application/json' or response.status_code != 200
+            or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if encoding:
+        response.set_data(compress_body(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+    return response
+
+# ============== CACHE HTTP ==============
+
+class ResponseCache:
+    """Cuerpos de respuesta ya serializados por (endpoint, query, codificacion).
+
+    Cada entrada lleva la generacion (id del snapshot) con la que se genero y
+    solo sirve mientras esa siga siendo la actual; set_latest_snapshot() vacia
+    el cache al publicar un snapshot nuevo. Se descartan las entradas menos
+    usadas por encima de `size`.
+    """
+
+    def __init__(self, size=RESPONSE_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, generation):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != generation:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, generation, body):
+        with self._lock:
+            self._entries[key] = (generation, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+response_cache = ResponseCache()
+
+def snapshot_generation():
+    """Id del snapshot actual (0 si todavia no hay datos)"""
+    snapshot = get_latest_snapshot()
+    if not snapshot or not snapshot.get('timestamp'):
+        return 0
+    return snapshot_event_id(snapshot)
+
+def seconds_until_next_tick(generation):
+    """Segundos hasta el proximo tick esperado segun el timestamp del snapshot"""
+    if not generation:
+        return 0
+    next_tick = generation / 1000 + PRICE_UPDATE_SECONDS
+    return max(int(next_tick - time.time()), 0)
+
+def cached_response(view):
+    """Cachea la respuesta de `view` hasta el proximo snapshot.
+
+    La respuesta lleva un ETag calculado con el snapshot, el endpoint y la
+    query, y un Cache-Control que vence cuando se espera el proximo tick; un
+    If-None-Match que coincide recibe 304 sin ejecutar la vista. Solo se
+    cachean las respuestas 200, tambien ya comprimidas por codificacion, de
+    modo que cada snapshot se comprime una vez y no una vez por peticion. El
+    ETag es debil porque las variantes comprimidas comparten el mismo.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        generation = snapshot_generation()
+        query = '&'.join(f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))
+        key = (request.endpoint, query)
+        etag = hashlib.sha1(f"{generation}:{request.endpoint}?{query}".encode()).hexdigest()[:20]
+
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            cached = response_cache.get(key + (None,), generation)
+            if cached is None:
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                cached = (response.mimetype, response.get_data())
+                response_cache.put(key + (None,), generation, cached)
+            mimetype, body = cached
+            encoding = negotiate_encoding() if len(body) >= COMPRESS_MIN_BYTES else None
+            if encoding:
+                compressed = response_cache.get(key + (encoding,), generation)
+                if compressed is None:
+                    compressed = compress_body(body, encoding)
+                    response_cache.put(key + (encoding,), generation, compressed)
+                response = Response(compressed, mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+            else:
+                response = Response(body, mimetype=mimetype)
+
+        response.set_etag(etag, weak=True)
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.max_age = seconds_until_next_tick(generation)
+        return response
+    return wrapper
 
 # ============== RUTAS API ==============
 
 @app.route('/')
 def index():
-    return send_from_directory('static', 'index.html')
+    return send_static('index.html')
 
 @app.route('/sw.js')
 def service_worker():
-    return send_from_directory('static', 'sw.js')
+    return send_static('sw.js')
 
 @app.route('/sitemap.xml')
 def sitemap():
-    return send_from_directory('static', 'sitemap.xml')
+    return send_static('sitemap.xml')
 
 @app.route('/robots.txt')
 def robots():
-    return send_from_directory('static', 'robots.txt')
+    return send_static('robots.txt')
 
 @app.route('/api/stats')
 def get_stats():
-    subscribers = load_subscribers()
-    history = load_history()
-
-    oldest = None
-    newest = None
-    if history:
-        oldest = history[0].get('timestamp')
-        newest = history[-1].get('timestamp')
+    summary = stats_summary()
+    newest = summary["newest_record"]
+    if HISTORY_STORAGE_MODE == 'changes':
+        # El ultimo tick puede no estar guardado si nada cambio
+        latest = get_latest_snapshot()
+        if latest and latest.get('timestamp') and (
+                newest is None or parse_iso_datetime(latest['timestamp']) > parse_iso_datetime(newest)):
+            newest = latest['timestamp']
 
     return jsonify({
-        "subscribers": len(subscribers),
-        "total_records": len(history),
-        "oldest_record": oldest,
+        "subscribers": count_subscribers(),
+        "pruned_subscribers": summary["pruned_subscribers"],
+        "total_records": summary["total_records"],
+        "oldest_record": summary["oldest_record"],
         "newest_record": newest,
-        "database": "PostgreSQL" if get_db_connection() else "JSON"
+        "database": "PostgreSQL" if get_db_pool() else "JSON",
+        "storage_mode": HISTORY_STORAGE_MODE,
+        "ticks": summary["ticks"],
+        "upstreams": upstream_stats()
     })
 
 @app.route('/og-image.jpg')
 def og_image():
-    return send_from_directory('static', 'og-image.jpg')
+    return send_static('og-image.jpg')
 
 @app.route('/favicon.png')
 def favicon():
-    return send_from_directory('static', 'favicon.png')
+    return send_static('favicon.png')
 
 @app.route('/favicon.ico')
 def favicon_ico():
-    return send_from_directory('static', 'favicon.png')
+    return send_static('favicon.png')
 
 @app.route('/openapi.json')
 def openapi_spec():
-    return send_from_directory('static', 'openapi.json')
+    return send_static('openapi.json')
 
 @app.route('/api')
 def api_docs():
@@ -983,10 +4201,11 @@ def api_docs():
 </html>'''
 
 @app.route('/api/prices')
+@cached_response
 def get_prices():
-    history = load_history()
-    if history:
-        return jsonify(history[-1])
+    snapshot = get_latest_snapshot()
+    if snapshot:
+        return jsonify(snapshot)
     return jsonify({
         "timestamp": None, "bcv_usd": None, "bcv_eur": None,
         "usdt_avg": None, "brecha_usdt_usd": None,
@@ -994,24 +4213,77 @@ def get_prices():
     })
 
 @app.route('/api/latest')
+@cached_response
 def get_latest():
-    history = load_history()
-    if history:
-        return jsonify(history[-1])
+    snapshot = get_latest_snapshot()
+    if snapshot:
+        return jsonify(snapshot)
     return jsonify({
         "timestamp": None, "bcv_usd": None, "bcv_eur": None,
         "usdt_avg": None, "brecha_usdt_usd": None,
         "brecha_usdt_eur": None, "brecha_eur_usd": None
     })
 
+@app.route('/api/stream')
+def stream_prices():
+    """Server-Sent Events con cada snapshot nuevo (204 si el worker no es gevent, ver SSE_ENABLED)"""
+    if not SSE_ENABLED:
+        # EventSource no reconecta tras un 204: el frontend sigue con polling
+        return Response(status=204)
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+
+    # Asegura que el stream conozca el snapshot actual (arranque en frio)
+    get_latest_snapshot()
+
+    def generate():
+        last_id = last_event_id
+        yield "retry: 5000\n\n"
+        if last_id is None:
+            latest = snapshot_stream.latest()
+            last_id = 0
+            if latest:
+                last_id = latest[0]
+                yield f"id: {latest[0]}\nevent: snapshot\ndata: {latest[1]}\n\n"
+
+        started = time.monotonic()
+        while True:
+            events = snapshot_stream.wait(last_id, SSE_HEARTBEAT_SECONDS)
+            for event_id, payload in events:
+                last_id = event_id
+                yield f"id: {event_id}\nevent: snapshot\ndata: {payload}\n\n"
+            if not events:
+                yield ": ping\n\n"
+            if SSE_MAX_STREAM_SECONDS and time.monotonic() - started >= SSE_MAX_STREAM_SECONDS:
+                return
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/api/refresh', methods=['POST'])
 def refresh_prices():
-    try:
-        current_data = fetch_and_calculate_prices()
-        save_history_entry(current_data)
-        return jsonify({"success": True, "data": current_data})
-    except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
+    """Fuerza un tick en el proceso lider; los demas responden con el ultimo snapshot.
+
+    Solo el lider consulta las fuentes y escribe el historial; el snapshot
+    nuevo llega a los demas procesos por el canal de snapshots.
+    """
+    if not is_leader():
+        return jsonify({"success": True, "refreshed": False, "data": get_latest_snapshot()})
+    current_data = update_prices_job()
+    if current_data is None:
+        return jsonify({"success": False, "error": "No se pudieron actualizar los precios"}), 500
+    return jsonify({"success": True, "refreshed": True, "data": current_data})
+
+def entry_datetime(entry):
+    """Fecha de un registro del historial como datetime UTC sin timezone"""
+    return parse_iso_datetime(entry['timestamp'])
 
 def parse_iso_datetime(date_string):
     try:
@@ -1032,55 +4304,181 @@ def parse_iso_datetime(date_string):
         return datetime.now()
 
 @app.route('/api/history')
+@cached_response
 def get_history():
-    history = load_history()
     start = request.args.get('start')
     end = request.args.get('end')
-    limit = request.args.get('limit', 100, type=int)
-    offset = request.args.get('offset', 0, type=int)
+    limit = max(request.args.get('limit', 100, type=int), 0)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    output = request.args.get('format', 'json')
+    if output not in HISTORY_FORMATS:
+        return jsonify({"error": f"Formato invalido. Opciones: {', '.join(HISTORY_FORMATS)}"}), 400
+
+    resolution = request.args.get('resolution')
+    start_dt = parse_iso_datetime(start) if start else None
+    end_dt = parse_iso_datetime(end) if end else None
+
+    if resolution:
+        # Historial submuestreado: un registro por bucket con los valores de cierre
+        if resolution not in AGGREGATE_RESOLUTIONS:
+            return jsonify({
+                "error": f"Resolucion invalida. Opciones: {', '.join(AGGREGATE_RESOLUTIONS)}"
+            }), 400
+        buckets = query_aggregated_history(AGGREGATE_RESOLUTIONS[resolution], start=start_dt, end=end_dt)
+        history = [
+            {"timestamp": b["timestamp"], **{m: b[m]["close"] for m in METRICS}}
+            for b in buckets
+        ]
+        total = len(history)
+        page_end = max(total - offset, 0)
+        history = history[max(page_end - limit, 0):page_end]
+        if output == 'json':
+            return jsonify({"data": history, "total": total, "limit": limit, "offset": offset})
+        timestamps, columns = entries_to_arrays(history)
+    elif output == 'json':
+        history, total = query_history(start=start_dt, end=end_dt, limit=limit, offset=offset)
+        if HISTORY_STORAGE_MODE == 'changes':
+            history = reconstruct_step_series(
+                history, start_dt, end_dt,
+                include_start=offset + limit >= total,
+                include_end=offset == 0
+            )
+        return jsonify({"data": history, "total": total, "limit": limit, "offset": offset})
+    else:
+        timestamps, columns, total = query_history_columns(start=start_dt, end=end_dt, limit=limit, offset=offset)
+        if HISTORY_STORAGE_MODE == 'changes':
+            timestamps, columns = reconstruct_step_columns(
+                timestamps, columns, start_dt, end_dt,
+                include_start=offset + limit >= total,
+                include_end=offset == 0
+            )
 
-    if start or end:
-        filtered = []
-        for entry in history:
-            if not entry.get('timestamp'):
-                continue
-            entry_time = parse_iso_datetime(entry['timestamp'])
-            if start and entry_time < parse_iso_datetime(start):
-                continue
-            if end and entry_time > parse_iso_datetime(end):
-                continue
-            filtered.append(entry)
-        history = filtered
+    if output == 'binary':
+        return Response(binary_history_payload(timestamps, columns, total), mimetype='application/octet-stream')
+    return jsonify({"format": "columnar", **columnar_history_payload(timestamps, columns),
+                    "total": total, "limit": limit, "offset": offset})
 
-    total = len(history)
+@app.route('/api/history/aggregate')
+@cached_response
+def get_history_aggregate():
+    start = request.args.get('start')
+    end = request.args.get('end')
+    requested = request.args.get('resolution')
+    if requested and requested not in AGGREGATE_RESOLUTIONS:
+        return jsonify({
+            "error": f"Resolucion invalida. Opciones: {', '.join(AGGREGATE_RESOLUTIONS)}"
+        }), 400
+
+    start_dt = parse_iso_datetime(start) if start else None
+    end_dt = parse_iso_datetime(end) if end else None
+    resolution = choose_resolution(requested, start_dt, end_dt)
+
+    buckets = query_aggregated_history(AGGREGATE_RESOLUTIONS[resolution], start=start_dt, end=end_dt)
+    return jsonify({"data": buckets, "resolution": resolution, "total": len(buckets)})
+
+_export_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENT)
+
+@app.route('/api/export')
+def export_history():
+    """Historial completo o por rango en CSV o NDJSON, enviado por lotes"""
+    output = request.args.get('format', 'csv')
+    if output not in EXPORT_FORMATS:
+        return jsonify({"error": f"Formato invalido. Opciones: {', '.join(EXPORT_FORMATS)}"}), 400
+    start = request.args.get('start')
+    end = request.args.get('end')
+    after = request.args.get('after')
+    start_dt = parse_iso_datetime(start) if start else None
+    end_dt = parse_iso_datetime(end) if end else None
+    after_dt = parse_iso_datetime(after) if after else None
 
-    # Si hay más registros que el límite, tomar los más recientes
-    if len(history) > limit:
-        history = history[-limit:]
-    elif offset > 0:
-        history = history[offset:offset + limit]
+    if not _export_slots.acquire(blocking=False):
+        response = jsonify({"error": "Demasiadas exportaciones en curso, intenta de nuevo en un momento"})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
 
-    return jsonify({"data": history, "total": total, "limit": limit, "offset": offset})
+    try:
+        batches = iter_history_range(start=start_dt, end=end_dt, after=after_dt)
+        lines = export_csv_lines(batches) if output == 'csv' else export_ndjson_lines(batches)
+        filename = f"historial-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.{output}"
+        response = Response(
+            stream_with_context(lines),
+            mimetype=EXPORT_FORMATS[output],
+            headers={"Content-Disposition": f'attachment; filename="{filename}"',
+                     "X-Accel-Buffering": "no"}
+        )
+        # El servidor cierra la respuesta al terminar la descarga o si el cliente se va
+        response.call_on_close(_export_slots.release)
+    except BaseException:
+        _export_slots.release()
+        raise
+    return response
 
 # ============== INICIALIZACION ==============
 
 os.makedirs('static', exist_ok=True)
 
 def init_scheduler():
+    """Scheduler del proceso; solo el lider actualiza precios y corre el bot"""
     scheduler = BackgroundScheduler()
-    scheduler.add_job(func=update_prices_job, trigger="interval", seconds=60)
+    scheduler.add_job(func=reload_subscribers, trigger="interval", seconds=SUBSCRIBERS_RELOAD_SECONDS)
+    if APP_ROLE == 'web':
+        scheduler.start()
+        atexit.register(lambda: scheduler.shutdown())
+        print(f"Proceso {os.getpid()} (APP_ROLE=web): solo sirve HTTP")
+        become_follower(scheduler)
+        return scheduler
+
+    scheduler.add_job(func=leadership_job, args=[scheduler], trigger="interval",
+                      seconds=LEADER_RETRY_SECONDS, id='leadership')
     scheduler.start()
-    print("Scheduler de precios iniciado: actualizacion cada 60 segundos")
-    update_prices_job()
     atexit.register(lambda: scheduler.shutdown())
+
+    if leader_lock.try_acquire():
+        become_leader(scheduler)
+    else:
+        print(f"Proceso {os.getpid()} es seguidor: solo sirve HTTP")
+        become_follower(scheduler)
     return scheduler
 
 def init_app():
     """Inicializa base de datos, scheduler y bot de Telegram"""
     init_database()
-    scheduler = init_scheduler()
-    run_telegram_bot()
-    return scheduler
+    if APP_ROLE != 'worker':
+        try:
+            precompress_static()
+        except OSError as e:
+            print(f"No se pudieron precomprimir los archivos estaticos: {e}")
+    history_cache.catch_up()
+    reload_subscribers()
+    return init_scheduler()
+
+@app.cli.command('backfill-rollups')
+def backfill_rollups_command():
+    """Llena los rollups por hora y por dia con el historial existente"""
+    if not init_database():
+        print("Los rollups solo existen con PostgreSQL")
+        return
+    for table, rows in backfill_rollups().items():
+        print(f"{table}: {rows} buckets")
+
+@app.cli.command('migrate-history-json')
+@click.option('--force', is_flag=True, help='Reemplaza un historial JSONL existente')
+def migrate_history_json_command(force):
+    """Convierte price_history.json al historial append-only price_history.jsonl"""
+    migrated = migrate_history_json(force=force)
+    print(f"{migrated} registros migrados a {HISTORY_LOG_FILE} (original en {HISTORY_FILE}.bak)")
+
+@app.cli.command('precompress-static')
+@click.option('--force', is_flag=True, help='Rehace las variantes aunque esten al dia')
+def precompress_static_command(force):
+    """Genera las variantes .gz y .br de static/ (tambien se hace al arrancar)"""
+    written = precompress_static(force=force)
+    for path in written:
+        print(f"{path}: {os.path.getsize(path)} bytes")
+    if brotli is None:
+        print("brotli no esta instalado: solo se generaron variantes .gz")
+    print(f"{len(written)} archivos escritos")
 
 # Detectar entorno
 is_gunicorn = "gunicorn" in os.environ.get("SERVER_SOFTWARE", "")
@@ -0,0 +1,39 @@
+"""Compara el tiempo de parseo por tick de una copia guardada de la pagina del BCV.
+
+    curl -k https://www.bcv.org.ve/ -o bcv.html
+    python scripts/bench_bcv_parser.py bcv.html
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import parse_bcv_prices_regex, parse_bcv_prices_soup
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('html_file', help='Pagina del BCV guardada')
+    parser.add_argument('--iterations', type=int, default=50, help='Repeticiones por parser')
+    args = parser.parse_args()
+
+    with open(args.html_file, encoding='utf-8', errors='replace') as f:
+        html = f.read()
+
+    parsers = [
+        ("regex", parse_bcv_prices_regex),
+        ("soup + SoupStrainer", parse_bcv_prices_soup),
+        ("soup completo (html.parser)", lambda h: parse_bcv_prices_soup(h, strainer=False)),
+    ]
+    for name, parse in parsers:
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            prices = parse(html)
+        elapsed_ms = (time.perf_counter() - started) * 1000 / args.iterations
+        print(f"{name:30s} {elapsed_ms:8.2f} ms/tick  usd={prices['usd']} eur={prices['eur']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Compara AlertRuleEngine con recorrer todas las reglas en cada tick.
+
+    python scripts/bench_rules.py --rules 100000
+
+La equivalencia de resultados se prueba en tests/test_alert_rules.py.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import RULE_KINDS, RULE_METRICS, AlertRuleEngine
+
+START_VALUES = {'usdt_avg': 600.0, 'bcv_usd': 200.0, 'bcv_eur': 230.0,
+                'brecha_usdt_usd': 200.0, 'brecha_usdt_eur': 160.0}
+
+
+def make_rules(rule_count, seed):
+    """Reglas sinteticas con umbrales cerca de los valores iniciales"""
+    rng = random.Random(seed)
+    metrics = list(RULE_METRICS)
+    rules = []
+    for rule_id in range(1, rule_count + 1):
+        metric = rng.choice(metrics)
+        kind = rng.choice(RULE_KINDS)
+        base = START_VALUES[metric]
+        if kind == 'change':
+            threshold, reference = round(rng.uniform(0.5, 10), 2), base
+        else:
+            threshold, reference = round(base * rng.uniform(0.9, 1.1), 2), None
+        rules.append({"id": rule_id, "chat_id": rule_id % 5000, "metric": metric, "kind": kind,
+                      "threshold": threshold, "reference": reference,
+                      "cooldown_minutes": 0, "last_fired_at": None})
+    return rules
+
+
+def make_snapshots(ticks, seed):
+    """Caminata aleatoria de los precios, redondeada a centavos"""
+    rng = random.Random(seed)
+    snapshots = []
+    values = dict(START_VALUES)
+    for _ in range(ticks):
+        for metric in RULE_METRICS:
+            values[metric] = round(values[metric] * (1 + rng.gauss(0, 0.0005)), 2)
+        snapshots.append(dict(values))
+    return snapshots
+
+
+def linear_evaluate(rules, previous, snapshot):
+    """Revisa todas las reglas; ids de las disparadas (sin cooldown)"""
+    fired = []
+    for rule in rules:
+        p, c = previous[rule["metric"]], snapshot[rule["metric"]]
+        if rule["kind"] == 'change':
+            upper = round(rule["reference"] + rule["threshold"], 2)
+            lower = round(rule["reference"] - rule["threshold"], 2)
+            if p <= upper < c or c < lower <= p:
+                rule["reference"] = c
+                fired.append(rule["id"])
+        elif (rule["kind"] == 'above' and p <= rule["threshold"] < c) or \
+             (rule["kind"] == 'below' and c < rule["threshold"] <= p):
+            fired.append(rule["id"])
+    return sorted(fired)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rules', type=int, default=100000, help='Numero de reglas sinteticas')
+    parser.add_argument('--ticks', type=int, default=1000, help='Snapshots simulados')
+    parser.add_argument('--seed', type=int, default=1, help='Semilla del generador aleatorio')
+    args = parser.parse_args()
+
+    snapshots = make_snapshots(args.ticks, args.seed)
+
+    linear_rules = make_rules(args.rules, args.seed)
+    started = time.perf_counter()
+    linear_fired = []
+    previous = START_VALUES
+    for snapshot in snapshots:
+        linear_fired.append(linear_evaluate(linear_rules, previous, snapshot))
+        previous = snapshot
+    linear_ms = (time.perf_counter() - started) * 1000 / args.ticks
+
+    engine = AlertRuleEngine()
+    started = time.perf_counter()
+    engine.load(make_rules(args.rules, args.seed), previous=START_VALUES)
+    load_ms = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    engine_fired = [sorted(rule["id"] for rule, _, _ in engine.evaluate(snapshot)) for snapshot in snapshots]
+    engine_ms = (time.perf_counter() - started) * 1000 / args.ticks
+
+    total = sum(len(f) for f in engine_fired)
+    print(f"{args.rules} reglas, {args.ticks} ticks, {total} disparos (carga del indice: {load_ms:.0f} ms)")
+    print(f"recorrer todas  {linear_ms:10.3f} ms/tick")
+    print(f"indice ordenado {engine_ms:10.3f} ms/tick")
+    if engine_fired != linear_fired:
+        sys.exit("El motor y el recorrido completo dispararon reglas distintas")
+    print("Resultados identicos")
+
+
+if __name__ == '__main__':
+    main()
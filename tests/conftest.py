@@ -0,0 +1,68 @@
+import importlib
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def load_app(tmp_path, monkeypatch):
+    """Importa app.py de cero, con el directorio de trabajo en tmp_path y las variables dadas"""
+    def load(**env):
+        monkeypatch.chdir(tmp_path)
+        # Vacio (no ausente) para que load_dotenv no tome un DATABASE_URL del .env local
+        monkeypatch.setenv('DATABASE_URL', '')
+        for key, value in env.items():
+            monkeypatch.setenv(key, str(value))
+        sys.modules.pop('app', None)
+        return importlib.import_module('app')
+
+    yield load
+    module = sys.modules.pop('app', None)
+    if module is not None:
+        module.close_db_pool()
+
+
+@pytest.fixture
+def pg_url():
+    """Base de datos de pruebas (TEST_DATABASE_URL), vaciada antes de cada prueba"""
+    url = os.environ.get('TEST_DATABASE_URL')
+    if not url:
+        pytest.skip("TEST_DATABASE_URL no definida")
+    psycopg2 = pytest.importorskip('psycopg2')
+    conn = psycopg2.connect(url)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("SELECT tablename FROM pg_tables WHERE schemaname = 'public'")
+        for (table,) in cur.fetchall():
+            cur.execute(f'DROP TABLE "{table}" CASCADE')
+    conn.close()
+    return url
+
+
+def make_tick(moment, usdt=600.0, usd=200.0, eur=230.0):
+    """Registro de precios como los que arma fetch_and_calculate_prices()"""
+    return {
+        "timestamp": moment.isoformat() + 'Z',
+        "bcv_usd": usd,
+        "bcv_eur": eur,
+        "usdt_avg": usdt,
+        "brecha_usdt_usd": round((usdt - usd) / usd * 100, 2),
+        "brecha_usdt_eur": round((usdt - eur) / eur * 100, 2),
+        "brecha_eur_usd": round((eur - usd) / usd * 100, 2),
+    }
+
+
+@pytest.fixture
+def tick():
+    return make_tick
+
+
+@pytest.fixture
+def t0():
+    return datetime(2025, 1, 1, 12, 0)
@@ -0,0 +1,106 @@
+import asyncio
+import threading
+from datetime import timedelta
+
+import pytest
+
+
+def replay(app, series, monkeypatch):
+    """Publica la serie como lo hace update_prices_job() y devuelve (alerta, timestamp) disparados"""
+    fired = []
+    current = {}
+
+    def dispatch_broadcast(message, label):
+        fired.append((label, current["timestamp"]))
+        return True
+
+    monkeypatch.setattr(app, 'dispatch_broadcast', dispatch_broadcast)
+    app.snapshot_events.subscribe(app.dispatch_snapshot_alerts)
+    for snapshot in series:
+        current = snapshot
+        app.snapshot_events.publish(snapshot)
+    app.snapshot_events.unsubscribe(app.dispatch_snapshot_alerts)
+    return fired
+
+
+def test_replayed_series_fires_alerts_on_expected_ticks(load_app, tick, t0, monkeypatch):
+    app = load_app()
+    minute = timedelta(minutes=1)
+    series = [
+        tick(t0, usdt=600),                    # brecha 200%: referencia inicial
+        tick(t0 + minute, usdt=606),           # 203%
+        tick(t0 + 2 * minute, usdt=612),       # 206%: +6 puntos
+        tick(t0 + 3 * minute, usdt=614),       # 207%
+        tick(t0 + 4 * minute, usdt=614, usd=201),  # nueva tasa BCV, brecha 205.47%
+        tick(t0 + 5 * minute, usdt=590, usd=201),  # 193.53%: -12 puntos
+    ]
+
+    fired = replay(app, series, monkeypatch)
+
+    assert fired == [
+        ("Alerta de brecha", series[2]["timestamp"]),
+        ("Notificacion BCV", series[4]["timestamp"]),
+        ("Alerta de brecha", series[5]["timestamp"]),
+    ]
+
+    # Otro proceso retoma desde el estado guardado sin repetir alertas
+    app = load_app()
+    assert replay(app, [tick(t0 + 6 * minute, usdt=592, usd=201)], monkeypatch) == []
+    assert replay(app, [tick(t0 + 7 * minute, usdt=605, usd=201)], monkeypatch) == [
+        ("Alerta de brecha", (t0 + 7 * minute).isoformat() + 'Z'),
+    ]
+
+
+class RecordingBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+@pytest.fixture
+def telegram_loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(timeout=5)
+    loop.close()
+
+
+def test_alert_waits_for_the_first_subscriber(load_app, tick, t0, telegram_loop, monkeypatch):
+    app = load_app()
+    bot = RecordingBot()
+    monkeypatch.setattr(app, '_telegram_bot', bot)
+    monkeypatch.setattr(app, '_telegram_loop', telegram_loop)
+    dispatched = []
+    dispatch_broadcast = app.dispatch_broadcast
+
+    def recording_dispatch(message, label):
+        future = dispatch_broadcast(message, label)
+        if future is not None:
+            dispatched.append(future)
+        return future
+
+    monkeypatch.setattr(app, 'dispatch_broadcast', recording_dispatch)
+    app.snapshot_events.subscribe(app.dispatch_snapshot_alerts)
+    minute = timedelta(minutes=1)
+    try:
+        # Sin suscriptores: la brecha cruza el umbral y el BCV cambia
+        app.snapshot_events.publish(tick(t0, usdt=600))
+        app.snapshot_events.publish(tick(t0 + minute, usdt=620, usd=201))
+        assert dispatched == []
+
+        assert app.add_subscriber(42)
+        app.snapshot_events.publish(tick(t0 + 2 * minute, usdt=621, usd=201))
+        for future in dispatched:
+            future.result(timeout=5)
+    finally:
+        app.snapshot_events.unsubscribe(app.dispatch_snapshot_alerts)
+
+    # Las dos alertas pendientes llegan al primer suscriptor, una sola vez
+    assert len(bot.sent) == 2
+    assert {chat_id for chat_id, _ in bot.sent} == {42}
+    assert app.load_last_brecha()["timestamp"] == tick(t0 + 2 * minute)["timestamp"]
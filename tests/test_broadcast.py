@@ -0,0 +1,65 @@
+import asyncio
+import time
+from bisect import bisect_left
+
+import pytest
+
+
+class FakeBot:
+    """Bot de Telegram simulado que anota cuando recibe cada mensaje"""
+
+    def __init__(self, latency=0.0, blocked=(), missing=(), flood_on=()):
+        self.latency = latency
+        self.blocked = set(blocked)
+        self.missing = set(missing)
+        self.flood_on = set(flood_on)
+        self.received = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        from telegram.error import BadRequest, Forbidden, RetryAfter
+        self.received.append((time.monotonic(), chat_id))
+        await asyncio.sleep(self.latency)
+        if chat_id in self.flood_on:
+            self.flood_on.discard(chat_id)
+            raise RetryAfter(1)
+        if chat_id in self.blocked:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        if chat_id in self.missing:
+            raise BadRequest("Chat not found")
+
+
+def peak_per_second(times):
+    """Maximo de mensajes en cualquier ventana de un segundo"""
+    times = sorted(times)
+    return max((bisect_left(times, t + 1) - i for i, t in enumerate(times)), default=0)
+
+
+def test_broadcast_respects_global_rate(load_app):
+    app = load_app()
+    bot = FakeBot(latency=0.01)
+    broadcaster = app.TelegramBroadcaster(rate=25, chat_interval=0, concurrency=30)
+
+    stats = asyncio.run(broadcaster.broadcast(bot, range(60), "Prueba"))
+
+    assert stats["sent"] == 60
+    assert peak_per_second([t for t, _ in bot.received]) <= 25
+
+
+def test_broadcast_prunes_dead_chats(load_app):
+    pytest.importorskip('telegram')
+    app = load_app()
+    for chat_id in range(1, 11):
+        assert app.add_subscriber(chat_id)
+    bot = FakeBot(blocked={3, 7}, missing={9}, flood_on={5})
+    broadcaster = app.TelegramBroadcaster(rate=25, chat_interval=0, prune=app.prune_subscribers)
+
+    stats = asyncio.run(broadcaster.broadcast(bot, app.load_subscribers(), "Prueba"))
+
+    assert stats["total"] == 10
+    assert stats["sent"] == 7
+    assert stats["dead"] == stats["pruned"] == 3
+    assert stats["retried"] == stats["rate_limited"] == 1
+    assert [chat_id for _, chat_id in bot.received].count(5) == 2
+    assert sorted(app.load_subscribers()) == [1, 2, 4, 5, 6, 8, 10]
+    assert sorted(app.fetch_subscribers()) == [1, 2, 4, 5, 6, 8, 10]
+    assert app.load_pruned_subscribers() == 3
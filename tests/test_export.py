@@ -0,0 +1,52 @@
+from datetime import timedelta
+
+
+def test_export_does_not_hold_pool_connections(load_app, pg_url, tick, t0):
+    app = load_app(DATABASE_URL=pg_url, DB_POOL_MAX=1)
+    app.init_database()
+    for minute in range(3):
+        assert app.save_history_entry(tick(t0 + timedelta(minutes=minute), usdt=600 + minute))
+
+    batches = app.iter_history_range(batch_size=2)
+    assert len(next(batches)) == 2
+    # Con la descarga a medias, el pool (de una sola conexion) sigue libre
+    assert len(app.load_history()) == 3
+    assert len(next(batches)) == 1
+    batches.close()
+
+
+def test_export_over_limit_returns_503(load_app, tick, t0):
+    app = load_app(EXPORT_MAX_CONCURRENT=1)
+    assert app.save_history_entry(tick(t0))
+    client = app.app.test_client()
+
+    first = client.get('/api/export?format=ndjson')
+    assert first.status_code == 200
+    second = client.get('/api/export?format=ndjson')
+    assert second.status_code == 503
+    assert second.headers['Retry-After']
+
+    first.close()
+    third = client.get('/api/export?format=ndjson')
+    assert third.status_code == 200
+    assert third.get_data(as_text=True).count('\n') == 1
+    third.close()
+
+
+def test_export_releases_slot_when_setup_fails(load_app, monkeypatch):
+    app = load_app(EXPORT_MAX_CONCURRENT=1)
+    client = app.app.test_client()
+
+    export_ndjson_lines = app.export_ndjson_lines
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("fallo armando la exportacion")
+
+    monkeypatch.setattr(app, 'export_ndjson_lines', broken)
+    for _ in range(2):
+        assert client.get('/api/export?format=ndjson').status_code == 500
+
+    monkeypatch.setattr(app, 'export_ndjson_lines', export_ndjson_lines)
+    response = client.get('/api/export?format=ndjson')
+    assert response.status_code == 200
+    response.close()
@@ -0,0 +1,40 @@
+import threading
+from datetime import timedelta
+
+
+def test_rebuild_hides_cache_until_synced(load_app, tick, t0, monkeypatch):
+    app = load_app()
+    cache = app.history_cache
+    for minute in range(3):
+        assert app.save_history_entry(tick(t0 + timedelta(minutes=minute), usdt=600 + minute))
+    cache.catch_up()
+    assert len(cache.view()[0]) == 3
+
+    # La fuente de verdad ahora tiene otra historia, mas corta: hay que reconstruir
+    source = [tick(t0 - timedelta(days=1, minutes=m), usdt=500 + m) for m in (2, 1)]
+    late = tick(t0 - timedelta(days=1) + timedelta(minutes=5), usdt=555)
+    other = app.ColumnarHistoryCache(app.HISTORY_CACHE_DIR)
+    seen = []
+
+    def fake_iter(after=None, batch_size=50000):
+        rows = [e for e in source if after is None or app.entry_datetime(e) > after]
+        if rows and after is None:
+            # En medio de la reconstruccion, otro proceso y otro hilo leen el cache
+            reader = threading.Thread(target=lambda: seen.append(cache.view()))
+            reader.start()
+            reader.join(timeout=2)
+            assert not reader.is_alive(), "view() quedo esperando a catch_up()"
+            seen.append(other.view())
+            # Un registro nuevo llega mientras tanto; append() no escribe aun
+            source.append(late)
+            cache.append(late)
+        if rows:
+            yield rows
+
+    monkeypatch.setattr(app, 'load_latest_entry', lambda: source[-1])
+    monkeypatch.setattr(app, 'iter_history_after', fake_iter)
+    cache.catch_up()
+
+    assert seen == [None, None]
+    view = other.view()
+    assert [cache.entry_at(view, i) for i in range(len(view[0]))] == source
@@ -0,0 +1,56 @@
+from datetime import timedelta
+
+
+def test_failed_rollup_rolls_back_history_row(load_app, pg_url, tick, t0, monkeypatch):
+    app = load_app(DATABASE_URL=pg_url)
+    app.init_database()
+    app.history_cache.catch_up()
+
+    first = tick(t0)
+    assert app.save_history_entry(first)
+
+    update_rollups = app.update_rollups
+
+    def broken_rollups(cur, data):
+        raise RuntimeError("rollup roto")
+
+    monkeypatch.setattr(app, 'update_rollups', broken_rollups)
+    assert not app.save_history_entry(tick(t0 + timedelta(minutes=1), usdt=610))
+    assert [e['timestamp'] for e in app.load_history()] == [first['timestamp']]
+
+    monkeypatch.setattr(app, 'update_rollups', update_rollups)
+    third = tick(t0 + timedelta(minutes=2), usdt=620)
+    assert app.save_history_entry(third)
+
+    stored = app.load_history()
+    assert [e['timestamp'] for e in stored] == [first['timestamp'], third['timestamp']]
+    view = app.history_cache.view()
+    assert [app.history_cache.entry_at(view, i) for i in range(len(view[0]))] == stored
+    with app.db_cursor() as cur:
+        cur.execute('SELECT COALESCE(SUM(samples), 0) FROM price_rollup_hourly')
+        assert cur.fetchone()[0] == 2
+
+
+def test_leader_publishes_the_stored_row(load_app, pg_url, tick, t0, monkeypatch):
+    app = load_app(DATABASE_URL=pg_url, HISTORY_STORAGE_MODE='changes')
+    app.init_database()
+    app.history_cache.catch_up()
+    fetched = dict(tick(t0), bcv_usd=200.50500000, bcv_eur=230.12499999)
+    monkeypatch.setattr(app, 'fetch_and_calculate_prices', lambda: dict(fetched))
+    published = []
+    app.snapshot_events.subscribe(published.append)
+
+    snapshot = app.update_prices_job()
+
+    # El lider publica lo mismo que leen los seguidores y /api/history
+    assert (snapshot["bcv_usd"], snapshot["bcv_eur"]) == (200.51, 230.12)
+    assert published == [snapshot]
+    assert app.get_latest_snapshot() == snapshot == app.load_latest_entry()
+    assert app.load_history() == [snapshot]
+    assert app._last_stored_entry == snapshot
+
+    # Un tick sin cambios no se guarda, pero se publica con el mismo redondeo
+    fetched["timestamp"] = tick(t0 + timedelta(minutes=1))["timestamp"]
+    snapshot = app.update_prices_job()
+    assert (snapshot["bcv_usd"], snapshot["bcv_eur"]) == (200.51, 230.12)
+    assert len(app.load_history()) == 1
@@ -0,0 +1,42 @@
+import json
+from datetime import timedelta
+
+
+def _line(entry):
+    return (json.dumps(entry, separators=(',', ':')) + '\n').encode()
+
+
+def test_reader_skips_incomplete_tail_without_truncating(load_app, tick, t0, tmp_path):
+    app = load_app()
+    path = tmp_path / 'history.jsonl'
+    entries = [tick(t0 + timedelta(minutes=i), usdt=600 + i) for i in range(3)]
+    in_flight = _line(entries[2])
+    path.write_bytes(_line(entries[0]) + _line(entries[1]) + in_flight[:10])
+
+    reader = app.JsonlHistoryStore(str(path), str(tmp_path / 'history.idx'), stride=2)
+    assert len(reader) == 2
+    assert reader.last() == entries[1]
+    assert path.read_bytes().endswith(in_flight[:10])
+    assert not (tmp_path / 'history.idx').exists()
+
+    # El escritor termina su append: el lector incorpora la linea
+    with open(path, 'ab') as f:
+        f.write(in_flight[10:])
+    assert len(reader) == 3
+    assert reader.read_rows(0, 3) == entries
+
+
+def test_writer_discards_incomplete_tail_before_appending(load_app, tick, t0, tmp_path):
+    app = load_app()
+    path = tmp_path / 'history.jsonl'
+    index_path = tmp_path / 'history.idx'
+    entries = [tick(t0 + timedelta(minutes=i), usdt=600 + i) for i in range(4)]
+    path.write_bytes(_line(entries[0]) + _line(entries[1]) + _line(entries[2])[:10])
+
+    writer = app.JsonlHistoryStore(str(path), str(index_path), stride=2)
+    writer.append(entries[3])
+
+    reopened = app.JsonlHistoryStore(str(path), str(index_path), stride=2)
+    assert reopened.read_rows(0, len(reopened)) == [entries[0], entries[1], entries[3]]
+    assert index_path.stat().st_size == 2 * app.JsonlHistoryStore.INDEX_RECORD.size
+    assert reopened.position(app.entry_datetime(entries[3])) == 2
@@ -0,0 +1,34 @@
+import pytest
+
+
+class BrokenConnection:
+    """Conexion que abre bien pero falla al consultar"""
+
+    def __init__(self):
+        self.autocommit = False
+        self.closed = False
+
+    def cursor(self):
+        raise RuntimeError("conexion rota")
+
+    def close(self):
+        self.closed = True
+
+
+def test_failed_pg_attempt_closes_its_connection(load_app, monkeypatch):
+    psycopg2 = pytest.importorskip('psycopg2')
+    app = load_app(DATABASE_URL='postgresql://localhost/no-existe')
+    connections = []
+
+    def connect(*args, **kwargs):
+        connections.append(BrokenConnection())
+        return connections[-1]
+
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+    lock = app.LeaderLock()
+    for _ in range(3):
+        assert not lock.try_acquire()
+
+    assert len(connections) == 3
+    assert all(conn.closed for conn in connections)
+    assert not lock.is_held()
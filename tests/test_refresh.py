@@ -0,0 +1,30 @@
+def test_follower_refresh_serves_cached_snapshot(load_app, tick, t0, monkeypatch):
+    app = load_app()
+    snapshot = tick(t0)
+    app.set_latest_snapshot(snapshot)
+
+    def no_upstreams():
+        raise AssertionError("un seguidor no debe consultar las fuentes")
+
+    monkeypatch.setattr(app, 'fetch_and_calculate_prices', no_upstreams)
+    response = app.app.test_client().post('/api/refresh')
+
+    assert response.status_code == 200
+    assert response.get_json() == {"success": True, "refreshed": False, "data": snapshot}
+    assert app.load_history() == []
+
+
+def test_leader_refresh_runs_a_tick_and_publishes(load_app, tick, t0, monkeypatch):
+    app = load_app()
+    monkeypatch.setattr(app, '_is_leader', True)
+    fresh = tick(t0, usdt=650)
+    monkeypatch.setattr(app, 'fetch_and_calculate_prices', lambda: dict(fresh))
+    published = []
+    app.snapshot_events.subscribe(published.append)
+
+    response = app.app.test_client().post('/api/refresh')
+
+    assert response.get_json() == {"success": True, "refreshed": True, "data": fresh}
+    assert app.load_history() == [fresh]
+    assert published == [fresh]
+    assert app.get_latest_snapshot() == fresh
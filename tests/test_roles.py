@@ -0,0 +1,118 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from conftest import ROOT
+
+BCV_HTML = (
+    '<div id="dolar"><strong> 200,50000000 </strong></div>'
+    '<div id="euro"><strong> 230,25000000 </strong></div>'
+).encode()
+BINANCE_JSON = json.dumps({"data": [
+    {"adv": {"price": str(600 + i), "surplusAmount": "500"}} for i in range(6)
+]}).encode()
+
+
+@pytest.fixture
+def upstream():
+    """BCV y Binance simulados; anota la ruta de cada peticion"""
+    paths = []
+
+    class FakeUpstream(BaseHTTPRequestHandler):
+        def _reply(self, body, content_type):
+            paths.append(self.path)
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self._reply(BCV_HTML, 'text/html')
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self._reply(BINANCE_JSON, 'application/json')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeUpstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}", paths
+    server.shutdown()
+    server.server_close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_snapshot(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            response = requests.get(url, timeout=5)
+            if response.ok and response.json().get("bcv_usd") == 200.5:
+                return response.json()
+        except (requests.RequestException, ValueError):
+            pass
+        time.sleep(0.5)
+    return None
+
+
+def test_web_role_serves_worker_snapshot_without_upstream_calls(upstream, tmp_path):
+    pytest.importorskip('gunicorn')
+    base_url, paths = upstream
+    web_port = free_port()
+    env = dict(os.environ, TELEGRAM_BOT_TOKEN='', DATABASE_URL='', PYTHONPATH=ROOT, PYTHONUNBUFFERED='1')
+    env.pop('SERVER_SOFTWARE', None)
+
+    def role_env(role):
+        # Cada rol consulta sus propias rutas, para saber quien hizo cada peticion
+        return dict(env, APP_ROLE=role, BCV_URL=f"{base_url}/{role}/bcv",
+                    BINANCE_P2P_URL=f"{base_url}/{role}/binance")
+
+    processes = []
+    try:
+        processes.append(subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', 'app:app', '--workers', '2',
+             '--bind', f'127.0.0.1:{web_port}'],
+            cwd=tmp_path, env=role_env('web'),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        ))
+        processes.append(subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'worker.py')],
+            cwd=tmp_path, env=role_env('worker'),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        ))
+
+        web_url = f"http://127.0.0.1:{web_port}"
+        snapshot = wait_for_snapshot(f"{web_url}/api/latest")
+        assert snapshot is not None, "El proceso web no recibio el snapshot del worker"
+        assert snapshot["usdt_avg"] > 600
+
+        refreshed = requests.post(f"{web_url}/api/refresh", timeout=10).json()
+        assert refreshed["refreshed"] is False
+        assert refreshed["data"]["bcv_usd"] == 200.5
+
+        assert any(path.startswith('/worker/') for path in paths)
+        assert [path for path in paths if path.startswith('/web/')] == []
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
@@ -0,0 +1,57 @@
+from datetime import timedelta
+
+import pytest
+
+
+@pytest.fixture(params=['json', 'json-cache', 'postgresql'])
+def changes_app(request, load_app, tick, t0):
+    """Historial por cambios: 600 desde las 12:00, 601 desde las 13:40, ultimo tick 13:50"""
+    env = {'HISTORY_STORAGE_MODE': 'changes', 'HISTORY_HEARTBEAT_MINUTES': 1440,
+           'HISTORY_CACHE_ENABLED': '1' if request.param == 'json-cache' else '0'}
+    if request.param == 'postgresql':
+        env['DATABASE_URL'] = request.getfixturevalue('pg_url')
+    app = load_app(**env)
+    app.init_database()
+    app.history_cache.catch_up()
+    for minutes in range(0, 110, 5):
+        app.save_history_entry(tick(t0 + timedelta(minutes=minutes), usdt=600 if minutes < 100 else 601))
+    app.set_latest_snapshot(tick(t0 + timedelta(minutes=110), usdt=601))
+    assert len(app.load_history()) == 2
+    return app
+
+
+def test_history_reconstructs_the_step_series(changes_app, t0):
+    response = changes_app.app.test_client().get(
+        f"/api/history?start={(t0 + timedelta(minutes=30)).isoformat()}Z&end={(t0 + timedelta(hours=3)).isoformat()}Z"
+    )
+    history = response.get_json()["data"]
+    assert [(e["timestamp"][11:16], e["usdt_avg"]) for e in history] == [
+        ("12:30", 600.0), ("13:40", 601.0), ("13:50", 601.0),
+    ]
+
+
+def test_aggregate_carries_values_into_buckets(changes_app, t0):
+    buckets = changes_app.query_aggregated_history(1800, start=t0, end=t0 + timedelta(hours=3))
+
+    summary = [
+        (b["timestamp"][11:16], b["count"],
+         tuple(b["usdt_avg"][k] for k in ("open", "high", "low", "close")))
+        for b in buckets
+    ]
+    assert summary == [
+        ("12:00", 1, (600.0, 600.0, 600.0, 600.0)),
+        ("12:30", 0, (600.0, 600.0, 600.0, 600.0)),
+        ("13:00", 0, (600.0, 600.0, 600.0, 600.0)),
+        # 600 vale hasta las 13:40, cuando se guarda 601
+        ("13:30", 1, (600.0, 601.0, 600.0, 601.0)),
+    ]
+    assert all("first_at" not in b for b in buckets)
+
+
+def test_aggregate_starting_mid_step(changes_app, t0):
+    buckets = changes_app.query_aggregated_history(1800, start=t0 + timedelta(minutes=50))
+
+    assert [(b["timestamp"][11:16], b["count"], b["usdt_avg"]["open"], b["usdt_avg"]["close"])
+            for b in buckets] == [
+        ("12:30", 0, 600.0, 600.0), ("13:00", 0, 600.0, 600.0), ("13:30", 1, 600.0, 601.0),
+    ]
@@ -0,0 +1,23 @@
+def test_stream_sends_current_snapshot(load_app, tick, t0):
+    app = load_app()
+    snapshot = tick(t0)
+    app.set_latest_snapshot(snapshot)
+
+    response = app.app.test_client().get('/api/stream', buffered=False)
+    chunks = iter(response.response)
+    assert next(chunks) == b"retry: 5000\n\n"
+    event = next(chunks).decode()
+    response.close()
+
+    assert response.mimetype == 'text/event-stream'
+    assert event.startswith(f"id: {app.snapshot_event_id(snapshot)}\nevent: snapshot\n")
+
+
+def test_stream_is_disabled_on_sync_gunicorn_workers(load_app, monkeypatch):
+    app = load_app()
+    # Lo que calcula SSE_ENABLED bajo gunicorn sin gevent
+    monkeypatch.setattr(app, 'SSE_ENABLED', False)
+
+    response = app.app.test_client().get('/api/stream')
+    assert response.status_code == 204
+    assert response.data == b''
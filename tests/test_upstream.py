@@ -0,0 +1,166 @@
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+
+class StandIn:
+    """Fuente simulada con http.server: cada peticion consume el siguiente paso del guion.
+
+    Un paso es un codigo HTTP o ('sleep', segundos) para responder 200 tarde;
+    sin guion responde 200.
+    """
+
+    def __init__(self):
+        self.script = deque()
+        self.arrivals = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stand_in.arrivals.append(time.monotonic())
+                step = stand_in.script.popleft() if stand_in.script else 200
+                status = 200
+                if isinstance(step, tuple):
+                    time.sleep(step[1])
+                else:
+                    status = step
+                body = b'{"ok": true}'
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except OSError:
+                    # El cliente ya se fue por timeout
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/"
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stand_in():
+    server = StandIn()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def app(load_app, monkeypatch):
+    app = load_app()
+    # Sin jitter, para que los tiempos de espera sean exactos
+    monkeypatch.setattr(app.random, 'uniform', lambda a, b: 1.0)
+    return app
+
+
+def gaps(arrivals):
+    return [b - a for a, b in zip(arrivals, arrivals[1:])]
+
+
+def test_retries_5xx_with_exponential_backoff(app, stand_in):
+    client = app.UpstreamClient('test', retries=3, backoff=0.1, backoff_max=0.15)
+    stand_in.script.extend([503, 502, 500])
+
+    response = client.get(stand_in.url, timeout=2)
+
+    assert response.status_code == 200
+    assert len(stand_in.arrivals) == 4
+    # 0.1, 0.2 limitado por backoff_max a 0.15, 0.15
+    for gap, delay in zip(gaps(stand_in.arrivals), [0.1, 0.15, 0.15]):
+        assert delay <= gap < delay + 0.1
+    stats = client.stats()
+    assert (stats["requests"], stats["errors"], stats["retries"]) == (4, 3, 3)
+    assert stats["circuit"] == 'closed'
+
+
+def test_gives_up_after_retries(app, stand_in):
+    client = app.UpstreamClient('test', retries=2, backoff=0.01)
+    stand_in.script.extend([500, 500, 500, 500])
+
+    with pytest.raises(requests.HTTPError):
+        client.get(stand_in.url, timeout=2)
+
+    assert len(stand_in.arrivals) == 3
+    assert client.breaker.failures == 1
+
+
+def test_retries_timeouts(app, stand_in):
+    client = app.UpstreamClient('test', retries=1, backoff=0.01)
+    stand_in.script.append(('sleep', 0.5))
+
+    response = client.get(stand_in.url, timeout=0.2)
+
+    assert response.status_code == 200
+    assert len(stand_in.arrivals) == 2
+    stats = client.stats()
+    assert (stats["errors"], stats["retries"]) == (1, 1)
+    assert 'timed out' in stats["last_error"].lower()
+
+
+def test_deadline_skips_backoff_that_would_not_fit(app, stand_in):
+    client = app.UpstreamClient('test', retries=3, backoff=1.0)
+    stand_in.script.extend([503, 503])
+
+    with pytest.raises(requests.HTTPError):
+        client.get(stand_in.url, deadline=time.monotonic() + 0.5)
+
+    assert len(stand_in.arrivals) == 1
+
+
+def test_breaker_opens_after_threshold_failures(app, stand_in):
+    client = app.UpstreamClient('test', retries=0, failure_threshold=3, reset_timeout=60)
+    stand_in.script.extend([500, 500, 500])
+
+    for _ in range(3):
+        with pytest.raises(requests.HTTPError):
+            client.get(stand_in.url, timeout=2)
+    assert client.breaker.state == 'open'
+
+    with pytest.raises(app.CircuitOpenError):
+        client.get(stand_in.url, timeout=2)
+    assert len(stand_in.arrivals) == 3
+    assert client.stats()["rejected"] == 1
+
+
+def test_breaker_half_opens_after_cooldown(app, stand_in):
+    client = app.UpstreamClient('test', retries=0, failure_threshold=2, reset_timeout=0.2)
+    stand_in.script.extend([500, 500])
+    for _ in range(2):
+        with pytest.raises(requests.HTTPError):
+            client.get(stand_in.url, timeout=2)
+    assert client.breaker.state == 'open'
+
+    time.sleep(0.25)
+    assert client.breaker.state == 'half-open'
+    # La prueba que falla vuelve a abrir el circuito de inmediato
+    stand_in.script.append(503)
+    with pytest.raises(requests.HTTPError):
+        client.get(stand_in.url, timeout=2)
+    assert client.breaker.state == 'open'
+    with pytest.raises(app.CircuitOpenError):
+        client.get(stand_in.url, timeout=2)
+
+    time.sleep(0.25)
+    # Solo una peticion de prueba pasa mientras esta medio abierto
+    assert client.breaker.allow()
+    assert not client.breaker.allow()
+    client.breaker.record_failure()
+
+    time.sleep(0.25)
+    response = client.get(stand_in.url, timeout=2)
+    assert response.status_code == 200
+    assert client.breaker.state == 'closed'
+    assert len(stand_in.arrivals) == 4
@@ -0,0 +1,22 @@
+"""Proceso worker: actualiza precios y corre el bot de Telegram.
+
+Se usa junto a procesos web con APP_ROLE=web (ver Procfile). El worker gana
+la eleccion de lider, guarda el historial y publica cada snapshot por el
+canal de snapshots; los procesos web solo leen ese snapshot.
+"""
+import os
+import signal
+import threading
+
+os.environ.setdefault('APP_ROLE', 'worker')
+
+from app import init_app
+
+
+if __name__ == '__main__':
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+    init_app()
+    print(f"Worker iniciado (pid {os.getpid()})")
+    stop.wait()